@@ -1,18 +1,19 @@
-import os, json, logging, glob, socket, platform, shutil, ntpath, posixpath, re, requests, subprocess, time, sys
-from concurrent.futures import ThreadPoolExecutor, as_completed
+import os, json, logging, glob, socket, platform, shutil, ntpath, posixpath, re, requests, subprocess, time, sys, threading, bisect, random, errno, stat, queue, signal, importlib.util, functools, atexit
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
 from datetime import datetime, timedelta
+from email.utils import parsedate_to_datetime
 from logging.handlers import RotatingFileHandler
 from pathlib import Path
+from urllib.parse import urlparse
 from plexapi.server import PlexServer
 from plexapi.video import Episode
 from plexapi.video import Movie
-from plexapi.myplex import MyPlexAccount
 from plexapi.exceptions import NotFound
-from plexapi.exceptions import BadRequest
 
 print("*** PlexCache ***")
 
-script_folder = "/mnt/user/system/plexcache/" # Folder path for the PlexCache script storing the settings, watchlist & watched cache files
+script_folder = os.environ.get("PLEXCACHE_FOLDER", "/mnt/user/system/plexcache/") # Folder path for the PlexCache script storing the settings, watchlist & watched cache files (the PLEXCACHE_FOLDER environment variable overrides it)
 logs_folder = script_folder # Change this if you want your logs in a different folder
 log_level = "" # Set the desired logging level for webhook notifications. Defaults to INFO when left empty. (Options: debug, info, warning, error, critical)
 max_log_files = 5 # Maximum number of log files to keep
@@ -26,16 +27,22 @@ webhook_level = ""
 
 webhook_url = ""  # Your webhook URL, leave empty for no notifications.
 webhook_headers = {} # Leave empty for Discord, otherwise edit it accordingly. (Slack example: "Content-Type": "application/json" "Authorization": "Bearer YOUR_SLACK_TOKEN" })
+notification_interval = 60 # Minimum seconds between two notifications, the messages logged meanwhile are sent together in one digest
 
 settings_filename = os.path.join(script_folder, "plexcache_settings.json")
 watchlist_cache_file = Path(os.path.join(script_folder, "plexcache_watchlist_cache.json"))
 watched_cache_file = Path(os.path.join(script_folder, "plexcache_watched_cache.json"))
+guid_index_file = Path(os.path.join(script_folder, "plexcache_guid_index.json"))
+state_db_file = Path(os.path.join(script_folder, "plexcache_state.db"))
+account_cache_file = Path(os.path.join(script_folder, "plexcache_account_cache.json"))
+run_report_file = Path(os.path.join(script_folder, "plexcache_run_report.json"))
 mover_cache_exclude_file = Path(os.path.join(script_folder, "plexcache_mover_files_to_exclude.txt"))
-if os.path.exists(mover_cache_exclude_file):
-    os.remove(mover_cache_exclude_file)  # Remove the existing 
+if os.path.exists(mover_cache_exclude_file) and "--sessions-only" not in sys.argv:
+    os.remove(mover_cache_exclude_file)  # Remove the existing, a --sessions-only run only adds the next episodes to it
 
 RETRY_LIMIT = 3
 DELAY = 5  # in seconds
+SNAPSHOT_WORKERS = 16  # Directories listed in parallel when taking a snapshot of the files metadata
 permissions= 0o777 
 
 log_file_pattern = "plexcache_log_*.log"
@@ -47,79 +54,136 @@ logging.addLevelName(SUMMARY, 'SUMMARY')
 
 start_time = time.time()  # record start time
 
-class UnraidHandler(logging.Handler):
+NOTIFICATION_SHUTDOWN_TIMEOUT = 30  # Seconds given to the last notifications when the script ends
+WEBHOOK_TIMEOUT = (5, 15)  # Connect and read timeouts of the webhook requests, in seconds
+WEBHOOK_MESSAGE_LIMIT = 2000  # Characters of a webhook message (Discord's limit)
+UNRAID_MESSAGE_LIMIT = 2000
+
+# Base of the notification handlers: emit() only queues the message, and a background thread sends them
+# The messages logged within the interval after a notification are sent together in one digest, so that an error storm
+# neither floods the notifications nor blocks the threads logging the errors. close() sends what is still queued.
+class NotificationHandler(logging.Handler):
     SUMMARY = SUMMARY
-    def __init__(self):
+    def __init__(self, interval):
         super().__init__()
+        self.interval = interval
+        self._queue = queue.Queue()
+        self._last_sent = 0
+        self._thread = threading.Thread(target=self._run, name=type(self).__name__, daemon=True)
+        self._thread.start()
+
+    def emit(self, record):
+        # The logs of the notifications themselves (e.g. of urllib3) would notify again
+        if threading.current_thread() is not self._thread:
+            self._queue.put((record.levelno, record.levelname, record.getMessage()))
+
+    def _run(self):
+        stopping = False
+        while not stopping:
+            batch = [self._queue.get()]
+            if batch[0] is None:
+                break
+            # Gather the messages until the next notification is allowed, or the script ends
+            deadline = max(self._last_sent + self.interval, time.monotonic())
+            while True:
+                remaining = deadline - time.monotonic()
+                try:
+                    item = self._queue.get(timeout=remaining) if remaining > 0 else self._queue.get_nowait()
+                except queue.Empty:
+                    break
+                if item is None:
+                    stopping = True
+                    break
+                batch.append(item)
+            self._send_batch(batch)
+            self._last_sent = time.monotonic()
+
+    def _send_batch(self, batch):
+        messages = [item for item in batch if item[0] != SUMMARY]
+        try:
+            if messages:
+                self.send_messages(messages)
+            for levelno, _, message in batch:
+                if levelno == SUMMARY:
+                    self.send_summary(message)
+        except Exception as e:
+            print(f"Failed to send a notification: {e}")
+
+    # Returns the subject, text and level name of a digest of the given messages, the text cut to the given length
+    @staticmethod
+    def get_digest(messages, limit):
+        levelname = max(messages)[1]  # The most severe level
+        if len(messages) == 1:
+            subject, text = levelname, messages[0][2]
+        else:
+            subject = f"{levelname} ({len(messages)} messages)"
+            text = "\n".join(f"{name}: {message}" for _, name, message in messages)
+        if len(text) > limit:
+            cut = f"\n... {len(text) - limit} more characters in the log"
+            text = text[:limit - len(cut)] + cut
+        return subject, text, levelname
+
+    def close(self):
+        if self._thread.is_alive():
+            self._queue.put(None)
+            self._thread.join(NOTIFICATION_SHUTDOWN_TIMEOUT)
+        super().close()
+
+class UnraidHandler(NotificationHandler):
+    # Map logging levels to icons
+    level_to_icon = {
+        'WARNING': 'warning',
+        'ERROR': 'alert',
+        'INFO': 'normal',
+        'DEBUG': 'normal',
+        'CRITICAL': 'alert'
+    }
+
+    def __init__(self, interval):
         self.notify_cmd_base = "/usr/local/emhttp/webGui/scripts/notify"
         if not os.path.isfile(self.notify_cmd_base) or not os.access(self.notify_cmd_base, os.X_OK):
             logging.warning(f"{self.notify_cmd_base} does not exist or is not executable. Unraid notifications will not be sent.")
             print(f"{self.notify_cmd_base} does not exist or is not executable. Unraid notifications will not be sent.")
             self.notify_cmd_base = None
+        super().__init__(interval)
 
-    def emit(self, record):
-        if self.notify_cmd_base:
-            if record.levelno == SUMMARY:
-                self.send_summary_unraid_notification(record)
-            else: 
-                self.send_unraid_notification(record)
-
-    def send_summary_unraid_notification(self, record):
-        icon = 'normal'
-        notify_cmd = f'{self.notify_cmd_base} -e "PlexCache" -s "Summary" -d "{record.msg}" -i "{icon}"'
-        subprocess.call(notify_cmd, shell=True)
-
-    def send_unraid_notification(self, record):
-        # Map logging levels to icons
-        level_to_icon = {
-            'WARNING': 'warning',
-            'ERROR': 'alert',
-            'INFO': 'normal',
-            'DEBUG': 'normal',
-            'CRITICAL': 'alert'
-        }
-
-        icon = level_to_icon.get(record.levelname, 'normal')  # default to 'normal' if levelname is not found in the dictionary
+    def send_summary(self, message):
+        self.send_unraid_notification("Summary", message, 'normal')
 
-        # Prepare the command with necessary arguments
-        notify_cmd = f'{self.notify_cmd_base} -e "PlexCache" -s "{record.levelname}" -d "{record.msg}" -i "{icon}"'
+    def send_messages(self, messages):
+        subject, text, levelname = self.get_digest(messages, UNRAID_MESSAGE_LIMIT)
+        self.send_unraid_notification(subject, text, self.level_to_icon.get(levelname, 'normal'))  # default to 'normal' if levelname is not found in the dictionary
 
-        # Execute the command
-        subprocess.call(notify_cmd, shell=True)
+    def send_unraid_notification(self, subject, description, icon):
+        if not self.notify_cmd_base:
+            return
+        # Without a shell, so that the quotes of the messages can't break the command
+        subprocess.run([self.notify_cmd_base, "-e", "PlexCache", "-s", subject, "-d", description, "-i", icon], timeout=NOTIFICATION_SHUTDOWN_TIMEOUT)
 
-class WebhookHandler(logging.Handler):
-    SUMMARY = SUMMARY
-    def __init__(self, webhook_url):
-        super().__init__()
+class WebhookHandler(NotificationHandler):
+    def __init__(self, webhook_url, headers, interval):
         self.webhook_url = webhook_url
-
-    def emit(self, record):
-        if record.levelno == SUMMARY:
-            self.send_summary_webhook_message(record)
-        else:
-            self.send_webhook_message(record)
-
-    def send_summary_webhook_message(self, record):
-        summary = "Plex Cache Summary:\n" + record.msg
+        self.headers = {"Content-Type": "application/json", **headers}
+        # Pooled connections, and a few retries of the failed or rate limited requests, honouring Retry-After
+        self.session = requests.Session()
+        retries = requests.adapters.Retry(total=3, backoff_factor=2, status_forcelist=[429, 500, 502, 503, 504], allowed_methods=["POST"])
+        self.session.mount('http://', requests.adapters.HTTPAdapter(max_retries=retries))
+        self.session.mount('https://', requests.adapters.HTTPAdapter(max_retries=retries))
+        super().__init__(interval)
+
+    def send_summary(self, message):
+        self.send_webhook_message("Plex Cache Summary:\n" + message)
+
+    def send_messages(self, messages):
+        subject, text, _ = self.get_digest(messages, WEBHOOK_MESSAGE_LIMIT - 50)  # Room for the subject line
+        self.send_webhook_message(text if len(messages) == 1 else f"PlexCache, {subject}:\n{text}")
+
+    def send_webhook_message(self, content):
         payload = {
-            "content": summary
-        }
-        headers = {
-            "Content-Type": "application/json"
+            "content": content
         }
-        response = requests.post(self.webhook_url, data=json.dumps(payload), headers=headers)
-        if not response.status_code == 204:
-            print(f"Failed to send summary message. Error code: {response.status_code}")
-
-    def send_webhook_message(self, record):
-        payload = {
-            "content": record.msg
-        }
-        headers = {
-            "Content-Type": "application/json"
-        }
-        response = requests.post(self.webhook_url, data=json.dumps(payload), headers=headers)
-        if not response.status_code == 204:
+        response = self.session.post(self.webhook_url, data=json.dumps(payload), headers=self.headers, timeout=WEBHOOK_TIMEOUT)
+        if not response.ok:
             print(f"Failed to send message. Error code: {response.status_code}")
 
 def check_and_create_folder(folder):
@@ -182,13 +246,19 @@ def clean_old_log_files(logs_folder, log_file_pattern, max_log_files):
 # Call the function to clean old log files
 clean_old_log_files(logs_folder, log_file_pattern, max_log_files)
 
+# Unraid shares: /mnt/user holds the files of the cache and the array, /mnt/user0 only the files of the array disks
+user_share = "/mnt/user/"
+array_share = "/mnt/user0/"
+array_disks_pattern = "/mnt/disk[0-9]*"
+unraid_shares_config = "/boot/config/shares/"  # <share>.cfg files holding the allocation method, split level... of each share
+
 def check_os():
     # Check the operating system
     os_name = platform.system()
 
     # Define information about different operating systems
     os_info = {
-        'Linux': {'path': "/mnt/user0/", 'msg': 'Script is currently running on Linux.'},
+        'Linux': {'path': array_share, 'msg': 'Script is currently running on Linux.'},
         'Darwin': {'path': None, 'msg': 'Script is currently running on macOS (untested).'},
         'Windows': {'path': None, 'msg': 'Script is currently running on Windows.'}
     }
@@ -232,7 +302,7 @@ if notification.lower() == "both":
         notification = "webhook"
 
 if notification.lower() == "both" or notification.lower() == "unraid":
-    unraid_handler = UnraidHandler()
+    unraid_handler = UnraidHandler(notification_interval)
     if unraid_level:
         unraid_level = unraid_level.lower()
         if unraid_level == "debug":
@@ -257,7 +327,7 @@ if notification.lower() == "both" or notification.lower() == "unraid":
 # Create and add the webhook handler to the logger
 if notification.lower() == "both" or notification.lower() == "webhook":
     if webhook_url:
-        webhook_handler = WebhookHandler(webhook_url)
+        webhook_handler = WebhookHandler(webhook_url, webhook_headers, notification_interval)
         if webhook_level:
             webhook_level = webhook_level.lower()
             if webhook_level == "debug":
@@ -456,6 +526,42 @@ try:
 
     max_concurrent_moves_array = settings_data['max_concurrent_moves_array']
     max_concurrent_moves_cache = settings_data['max_concurrent_moves_cache']
+    max_concurrent_moves_per_disk = settings_data.get('max_concurrent_moves_per_disk', 1)  # Moves reading from or writing to the same array disk
+
+    # Move speed limits in MB/s, 0 for no limit
+    max_move_speed_cache = settings_data.get('max_move_speed_cache', 0)
+    max_move_speed_array = settings_data.get('max_move_speed_array', 0)
+    session_move_speed = settings_data.get('session_move_speed', 10)  # While a Plex session reads from the same disk or pool, 0 pauses the moves
+    session_poll_interval = settings_data.get('session_poll_interval', 30)  # Seconds between two checks of the Plex sessions while moving
+
+    cache_high_water_mark = settings_data.get('cache_high_water_mark', 90)  # Percentage of the cache drive media can be cached up to
+    cache_space_reserve = settings_data.get('cache_space_reserve', 10)  # GB always kept free on the cache drive, e.g. for other writes
+
+    # Cached media no longer needed are moved back to the array when the cache drive goes above the high water mark,
+    # until it gets below the low one (percentages of the cache drive)
+    eviction_high_water_mark = settings_data.get('eviction_high_water_mark', 95)
+    eviction_low_water_mark = settings_data.get('eviction_low_water_mark', 85)
+    eviction_dry_run = settings_data.get('eviction_dry_run', False)  # Only report what would be evicted
+
+    max_concurrent_requests = settings_data.get('max_concurrent_requests', 16)
+    max_concurrent_requests_per_host = settings_data.get('max_concurrent_requests_per_host', 8)
+    plex_tv_rate_limit = settings_data.get('plex_tv_rate_limit', 5)  # Requests per second to plex.tv (watchlist, account)
+    plex_server_rate_limit = settings_data.get('plex_server_rate_limit', 50)  # Requests per second to the Plex server
+    account_cache_expiry = settings_data.get('account_cache_expiry', 24)  # Hours before the account, users and tokens are fetched again
+
+    copy_chunk_size = settings_data.get('copy_chunk_size', 64)  # In MB
+    copy_method = settings_data.get('copy_method', 'auto')  # "auto", "copy_file_range", "sendfile" or "read_write"
+    # Files next to a media, named after it, that are moved together with it: subtitles, .nfo, artwork and external audio
+    sidecar_extensions = settings_data.get('sidecar_extensions', [".srt", ".vtt", ".sbv", ".sub", ".idx", ".ass", ".ssa", ".nfo", ".jpg", ".jpeg", ".png", ".tbn", ".mka"])
+    # Prometheus node exporter textfile the metrics of the run are written to, e.g. "/var/lib/node_exporter/plexcache.prom". Empty to disable.
+    metrics_textfile = settings_data.get('metrics_textfile', "")
+    # Plex library database the onDeck and watched media are read from instead of the Plex API, on a local install. Empty to use the API.
+    # e.g. "/mnt/user/appdata/plex/Library/Application Support/Plex Media Server/Plug-in Support/Databases/com.plexapp.plugins.library.db"
+    plex_database_file = settings_data.get('plex_database_file', "")
+    # On Unraid, read from and write to the array disks (/mnt/diskN) directly instead of through the shfs FUSE layer of /mnt/user0
+    disk_direct_moves = settings_data.get('disk_direct_moves', True)
+    # Move the onDeck and watchlist media to the cache as soon as they are fetched, instead of after fetching everything
+    stream_cache_moves = settings_data.get('stream_cache_moves', True)
 
     deprecated_unraid = settings_data.get('unraid')
     if deprecated_unraid is not None:
@@ -476,6 +582,28 @@ try:
         settings_data['skip_ondeck'] = skip_ondeck
         settings_data['skip_watchlist'] = skip_watchlist
         settings_data['exit_if_active_session'] = exit_if_active_session
+        settings_data['max_concurrent_moves_per_disk'] = max_concurrent_moves_per_disk
+        settings_data['max_move_speed_cache'] = max_move_speed_cache
+        settings_data['max_move_speed_array'] = max_move_speed_array
+        settings_data['session_move_speed'] = session_move_speed
+        settings_data['session_poll_interval'] = session_poll_interval
+        settings_data['cache_high_water_mark'] = cache_high_water_mark
+        settings_data['cache_space_reserve'] = cache_space_reserve
+        settings_data['eviction_high_water_mark'] = eviction_high_water_mark
+        settings_data['eviction_low_water_mark'] = eviction_low_water_mark
+        settings_data['eviction_dry_run'] = eviction_dry_run
+        settings_data['max_concurrent_requests'] = max_concurrent_requests
+        settings_data['max_concurrent_requests_per_host'] = max_concurrent_requests_per_host
+        settings_data['plex_tv_rate_limit'] = plex_tv_rate_limit
+        settings_data['plex_server_rate_limit'] = plex_server_rate_limit
+        settings_data['account_cache_expiry'] = account_cache_expiry
+        settings_data['copy_chunk_size'] = copy_chunk_size
+        settings_data['copy_method'] = copy_method
+        settings_data['sidecar_extensions'] = sidecar_extensions
+        settings_data['metrics_textfile'] = metrics_textfile
+        settings_data['plex_database_file'] = plex_database_file
+        settings_data['disk_direct_moves'] = disk_direct_moves
+        settings_data['stream_cache_moves'] = stream_cache_moves
         json.dump(settings_data, f, indent=4)
 except Exception as e:
     logging.error(f"Error occurred while saving settings data: {e}")
@@ -488,44 +616,698 @@ media_to = []
 media_to_cache = []
 media_to_array = []
 move_commands = []
+edited_file_paths = {}  # Plex path -> edited path, filled by modify_file_paths()
+media_users = {}  # Plex path -> users referencing it
+media_users_lock = threading.Lock()
+plex_instances = {}  # User id (None for the main user) -> (username, PlexServer)
+plex_instances_lock = threading.Lock()
+array_disks = None  # Unraid array disks, listed when first needed
+media_priorities = {}  # Plex path -> (tier, position), the lower the sooner the media is expected to be watched
+media_priorities_lock = threading.Lock()
+sidecar_media = {}  # Sidecar (subtitle, .nfo, artwork...) path -> path of the media it belongs to
+path_maps_lock = threading.Lock()  # Guards edited_file_paths and sidecar_media, filled while the cache pipeline plans its moves
+mover_excluded_files = set()  # Cache paths of the media filtered for the cache by this process, kept in the mover exclusion file
+PRIORITY_ONDECK = 0
+PRIORITY_WATCHLIST = 1
+PRIORITY_UNKNOWN = 2
+array_disk_cache = {}  # Directory relative to /mnt/user0 -> array disk holding its last file found
 skip_cache = "--skip-cache" in sys.argv
+full_resync = "--full-resync" in sys.argv
 debug = "--debug" in sys.argv
+daemon = "--daemon" in sys.argv  # Keep running after the first run and react to the playback events
+sessions_only = "--sessions-only" in sys.argv  # Only cache the next episodes of the media being played
+profile = "--profile" in sys.argv  # Write a timeline of the run and report the memory allocations
+
+API_LATENCY_BUCKETS = [0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10]  # Buckets of the Plex API latency histograms, in seconds
+RUN_REPORTS_KEPT = 50  # Runs kept in the JSON run report
+
+# Metrics of the run: time spent in each phase, Plex API calls, files moved, errors and cache fill level
+# They are written to the JSON run report, and to a Prometheus node exporter textfile if metrics_textfile is set.
+# The phases can run in several threads at once (e.g. the onDeck media of each user): their seconds are summed over
+# the threads, and their wall time goes from the first call to the end of the last one.
+class RunMetrics:
+    def __init__(self):
+        self.started = time.time()
+        self.completed = False
+        self.written = False
+        self.errors = 0
+        self.phases = {}  # Phase -> calls, seconds, first start, last end and errors
+        self.requests = {}  # (host, endpoint) -> count, errors, seconds and latency histogram
+        self.moves = {}  # Destination -> files, bytes, errors and deferred moves
+        self._main_phase = None  # Phase of the main thread, which the threads it starts (e.g. the moves) are part of
+        self._local = threading.local()
+        self._lock = threading.Lock()
+
+    def _get_phase(self, name):
+        return self.phases.setdefault(name, {'calls': 0, 'seconds': 0.0, 'start': None, 'end': None, 'errors': 0})
+
+    def current_phase(self):
+        return getattr(self._local, 'phase', None) or self._main_phase
+
+    # Measures the code run in the context as the given phase
+    @contextmanager
+    def phase(self, name):
+        main_thread = threading.current_thread() is threading.main_thread()
+        previous, previous_main = getattr(self._local, 'phase', None), self._main_phase
+        self._local.phase = name
+        if main_thread:
+            self._main_phase = name
+        start = time.monotonic()
+        try:
+            yield
+        finally:
+            end = time.monotonic()
+            self._local.phase = previous
+            if main_thread:
+                self._main_phase = previous_main
+            with self._lock:
+                stats = self._get_phase(name)
+                stats['calls'] += 1
+                stats['seconds'] += end - start
+                stats['start'] = start if stats['start'] is None else min(stats['start'], start)
+                stats['end'] = end if stats['end'] is None else max(stats['end'], end)
+
+    # Decorator measuring every call of a function as the given phase
+    def measure(self, name):
+        def decorator(function):
+            @functools.wraps(function)
+            def wrapper(*args, **kwargs):
+                with self.phase(name):
+                    return function(*args, **kwargs)
+            return wrapper
+        return decorator
+
+    def add_error(self):
+        with self._lock:
+            self.errors += 1
+            self._get_phase(self.current_phase() or 'other')['errors'] += 1
+
+    # Records a Plex API call, status is None if no response was received
+    def record_request(self, url, seconds, status):
+        host, endpoint = get_endpoint(url)
+        with self._lock:
+            stats = self.requests.setdefault((host, endpoint), {'count': 0, 'errors': 0, 'seconds': 0.0, 'buckets': [0] * len(API_LATENCY_BUCKETS)})
+            stats['count'] += 1
+            stats['seconds'] += seconds
+            if status is None or status >= 400:
+                stats['errors'] += 1
+            for index, bound in enumerate(API_LATENCY_BUCKETS):
+                if seconds <= bound:
+                    stats['buckets'][index] += 1
+
+    # Records the result of a move to the given destination
+    def record_move(self, destination, size, result):
+        with self._lock:
+            stats = self.moves.setdefault(destination, {'files': 0, 'bytes': 0, 'errors': 0, 'deferred': 0})
+            if result == 0:
+                stats['files'] += 1
+                stats['bytes'] += size
+            elif result == MOVE_DEFERRED:
+                stats['deferred'] += 1
+            else:
+                stats['errors'] += 1
+
+    def get_report(self, cache):
+        with self._lock:
+            return {
+                'timestamp': datetime.fromtimestamp(self.started).isoformat(timespec='seconds'),
+                'duration_seconds': round(time.time() - self.started, 3),
+                'completed': self.completed,
+                'errors': self.errors,
+                'phases': {name: {'calls': stats['calls'], 'seconds': round(stats['seconds'], 3),
+                                  'wall_seconds': round(stats['end'] - stats['start'], 3) if stats['calls'] else 0, 'errors': stats['errors']}
+                           for name, stats in self.phases.items()},
+                'api_requests': [{'host': host, 'endpoint': endpoint, 'count': stats['count'], 'errors': stats['errors'],
+                                  'seconds': round(stats['seconds'], 3), 'buckets': dict(zip(map(str, API_LATENCY_BUCKETS), stats['buckets']))}
+                                 for (host, endpoint), stats in sorted(self.requests.items())],
+                'moves': {destination: dict(stats) for destination, stats in self.moves.items()},
+                'cache': cache
+            }
+
+    # Formats the report in the Prometheus text format
+    def format_prometheus(self, report):
+        lines = []
+
+        def sample(name, labels, value):
+            # Label values escape backslashes, double quotes and line feeds
+            label_text = ','.join('{}="{}"'.format(key, str(label).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')) for key, label in labels.items())
+            lines.append(f"{name}{{{label_text}}} {value}" if label_text else f"{name} {value}")
+
+        def add(name, metric_type, help_text, samples):
+            lines.append(f"# HELP {name} {help_text}")
+            lines.append(f"# TYPE {name} {metric_type}")
+            for labels, value in samples:
+                sample(name, labels, value)
+
+        add('plexcache_run_timestamp_seconds', 'gauge', 'Start time of the last run.', [({}, round(self.started, 3))])
+        add('plexcache_run_duration_seconds', 'gauge', 'Duration of the last run.', [({}, report['duration_seconds'])])
+        add('plexcache_run_completed', 'gauge', 'Whether the last run went to the end.', [({}, int(report['completed']))])
+        add('plexcache_run_errors', 'gauge', 'Errors logged during the last run.', [({}, report['errors'])])
+        phases = report['phases'].items()
+        add('plexcache_phase_seconds', 'gauge', 'Time spent in each phase of the last run, summed over the threads.', [({'phase': name}, stats['seconds']) for name, stats in phases])
+        add('plexcache_phase_wall_seconds', 'gauge', 'Wall time of each phase of the last run.', [({'phase': name}, stats['wall_seconds']) for name, stats in phases])
+        add('plexcache_phase_calls', 'gauge', 'Calls of each phase during the last run.', [({'phase': name}, stats['calls']) for name, stats in phases])
+        add('plexcache_phase_errors', 'gauge', 'Errors logged in each phase of the last run.', [({'phase': name}, stats['errors']) for name, stats in phases])
+        add('plexcache_api_request_duration_seconds', 'histogram', 'Latency of the Plex API calls of the last run.', [])
+        for request in report['api_requests']:
+            labels = {'host': request['host'], 'endpoint': request['endpoint']}
+            for bound, count in list(request['buckets'].items()) + [('+Inf', request['count'])]:
+                sample('plexcache_api_request_duration_seconds_bucket', {**labels, 'le': bound}, count)
+            sample('plexcache_api_request_duration_seconds_sum', labels, request['seconds'])
+            sample('plexcache_api_request_duration_seconds_count', labels, request['count'])
+        add('plexcache_api_request_errors', 'gauge', 'Plex API calls of the last run that failed.', [({'host': request['host'], 'endpoint': request['endpoint']}, request['errors']) for request in report['api_requests']])
+        moves = report['moves'].items()
+        add('plexcache_moved_files', 'gauge', 'Files moved during the last run.', [({'destination': destination}, stats['files']) for destination, stats in moves])
+        add('plexcache_moved_bytes', 'gauge', 'Bytes moved during the last run.', [({'destination': destination}, stats['bytes']) for destination, stats in moves])
+        add('plexcache_move_errors', 'gauge', 'Moves of the last run that failed.', [({'destination': destination}, stats['errors']) for destination, stats in moves])
+        add('plexcache_moves_deferred', 'gauge', 'Moves of the last run deferred for lack of space.', [({'destination': destination}, stats['deferred']) for destination, stats in moves])
+        cache = report['cache']
+        if 'size_bytes' in cache:
+            add('plexcache_cache_size_bytes', 'gauge', 'Size of the cache drive.', [({}, cache['size_bytes'])])
+            add('plexcache_cache_used_bytes', 'gauge', 'Space used on the cache drive.', [({}, cache['used_bytes'])])
+            add('plexcache_cache_fill_ratio', 'gauge', 'Fill level of the cache drive, from 0 to 1.', [({}, cache['fill_ratio'])])
+        if 'wanted_files' in cache:
+            add('plexcache_cache_wanted_files', 'gauge', 'Media files that should be on the cache.', [({}, cache['wanted_files'])])
+            add('plexcache_cache_cached_files', 'gauge', 'Media files that should be on the cache and are.', [({}, cache['cached_files'])])
+        return '\n'.join(lines) + '\n'
+
+    # Writes the report to the JSON run report, keeping the last runs, and the Prometheus textfile
+    def write(self, cache, report_file, textfile):
+        report = self.get_report(cache)
+        reports = []
+        if report_file.exists():
+            try:
+                with report_file.open('r') as f:
+                    reports = json.load(f)
+            except (OSError, json.JSONDecodeError):
+                reports = []
+        reports = (reports + [report])[-RUN_REPORTS_KEPT:]
+        write_file_atomically(report_file, json.dumps(reports, indent=4))
+        if textfile:
+            write_file_atomically(textfile, self.format_prometheus(report))
+        self.written = True
+
+# Function to get the host (a plex.tv host or the Plex server) and the endpoint of a Plex API call,
+# without the rating keys and the plex.tv ids so that the calls can be grouped
+def get_endpoint(url):
+    parsed = urlparse(url)
+    hostname = parsed.hostname or ''
+    host = hostname if hostname == 'plex.tv' or hostname.endswith('.plex.tv') else 'plex_server'
+    return host, re.sub(r'/(?:\d[\d,]*|[0-9a-f]{24,40})(?=/|$)', '/{id}', parsed.path) or '/'
+
+# Counts the errors logged, for the metrics of the run
+class RunMetricsHandler(logging.Handler):
+    def __init__(self, metrics):
+        super().__init__(logging.ERROR)
+        self.metrics = metrics
+
+    def emit(self, record):
+        self.metrics.add_error()
+
+# Function to write a file through a temporary file, so that its readers never see it half written
+def write_file_atomically(path, content):
+    temp_file = f"{path}.tmp"
+    with open(temp_file, 'w') as f:
+        f.write(content)
+    os.replace(temp_file, path)
+
+# Function to write the metrics of the run, with the fill level of the cache drive and how many of the media
+# that should be on the cache are there
+def write_run_metrics():
+    if run_metrics.written:
+        return
+    cache = {}
+    try:
+        usage = shutil.disk_usage(cache_dir)
+        cache = {'size_bytes': usage.total, 'used_bytes': usage.used, 'fill_ratio': round(usage.used / usage.total, 4)}
+        wanted_files = set(media_to_cache)
+        cache['wanted_files'] = len(wanted_files)
+        cache['cached_files'] = sum(1 for file in wanted_files if file_snapshot.isfile(get_cache_paths(file, real_source, cache_dir)[1]))
+    except Exception as e:
+        logging.warning(f"Could not read the cache drive usage for the metrics: {e}")
+    try:
+        run_metrics.write(cache, run_report_file, metrics_textfile)
+    except Exception as e:
+        logging.error(f"Error writing the metrics of the run: {e}")
+
+PROFILE_TOP_ALLOCATORS = 10  # Allocation sites reported at each memory snapshot of the profile mode
+
+# Profiler of the --profile mode
+# It records spans of the hot paths as a Chrome trace-event timeline, with one track per thread, which can be opened
+# in https://ui.perfetto.dev or chrome://tracing. tracemalloc snapshots are taken at the phase boundaries, the top
+# allocation sites are logged and added to the trace with the memory traced along the run.
+# When the mode is off, trace() leaves the functions as they are, so that profiling costs nothing.
+class Profiler:
+    def __init__(self, enabled):
+        self.enabled = enabled
+        self.written = False
+        self.events = []
+        self.memory_report = []
+        self._tracks = {}  # (thread ident, thread name) -> track id
+        self._lock = threading.Lock()
+        self._previous_snapshot = None
+        self._start = time.perf_counter()
+        self._pid = os.getpid()
+        if enabled:
+            import tracemalloc  # Only imported when profiling
+            tracemalloc.start()
+
+    def _get_track(self):
+        thread = threading.current_thread()
+        key = (thread.ident, thread.name)
+        with self._lock:
+            track = self._tracks.get(key)
+            if track is None:
+                # Thread idents get reused, a new thread name gets its own track
+                track = self._tracks[key] = len(self._tracks) + 1
+                self.events.append({'name': 'thread_name', 'ph': 'M', 'pid': self._pid, 'tid': track, 'args': {'name': thread.name}})
+        return track
+
+    def _timestamp(self, moment):
+        return round((moment - self._start) * 1000000, 1)  # Microseconds since the start
+
+    @contextmanager
+    def span(self, name, **args):
+        if not self.enabled:
+            yield
+            return
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            end = time.perf_counter()
+            self.events.append({'name': name, 'cat': 'plexcache', 'ph': 'X', 'pid': self._pid, 'tid': self._get_track(),
+                                'ts': self._timestamp(start), 'dur': round((end - start) * 1000000, 1), 'args': args})
+
+    # Decorator recording every call of a function as a span, with its simple arguments (user, file...)
+    def trace(self, name=None):
+        def decorator(function):
+            if not self.enabled:
+                return function
+            code = function.__code__
+            argument_names = code.co_varnames[:code.co_argcount]
+
+            @functools.wraps(function)
+            def wrapper(*args, **kwargs):
+                span_args = {}
+                for argument_name, value in list(zip(argument_names, args)) + list(kwargs.items()):
+                    description = describe_span_argument(value)
+                    if description is not None:
+                        span_args[argument_name] = description
+                with self.span(name or function.__name__, **span_args):
+                    return function(*args, **kwargs)
+            return wrapper
+        return decorator
+
+    # Takes a tracemalloc snapshot at the end of the given phase and reports the top allocation sites
+    def snapshot(self, phase):
+        if not self.enabled:
+            return
+        import tracemalloc
+        with self.span('tracemalloc snapshot', phase=phase):
+            snapshot = tracemalloc.take_snapshot().filter_traces([
+                tracemalloc.Filter(False, tracemalloc.__file__),
+                tracemalloc.Filter(False, "<frozen importlib._bootstrap>"),
+                tracemalloc.Filter(False, "<frozen importlib._bootstrap_external>"),
+                tracemalloc.Filter(False, "<unknown>")
+            ])
+            current, peak = tracemalloc.get_traced_memory()
+            if hasattr(tracemalloc, 'reset_peak'):
+                tracemalloc.reset_peak()  # So that each phase gets its own peak
+            # What the phase allocated and still holds, compared to the previous snapshot
+            if self._previous_snapshot:
+                statistics = snapshot.compare_to(self._previous_snapshot, 'lineno')
+            else:
+                statistics = snapshot.statistics('lineno')
+            self._previous_snapshot = snapshot
+        top_allocators = [{
+            'location': f"{statistic.traceback[0].filename}:{statistic.traceback[0].lineno}",
+            'size_bytes': statistic.size,
+            'size_diff_bytes': getattr(statistic, 'size_diff', statistic.size),
+            'count': statistic.count
+        } for statistic in statistics[:PROFILE_TOP_ALLOCATORS]]
+        self.memory_report.append({'phase': phase, 'traced_bytes': current, 'peak_bytes': peak, 'top_allocators': top_allocators})
+        self.events.append({'name': 'memory', 'ph': 'C', 'pid': self._pid, 'ts': self._timestamp(time.perf_counter()),
+                            'args': {'traced MB': round(current / 1024 ** 2, 1), 'peak MB': round(peak / 1024 ** 2, 1)}})
+        logging.info(f"Memory after {phase}: {current / 1024 ** 2:.1f} MB traced, peak {peak / 1024 ** 2:.1f} MB. Top allocators:")
+        for allocator in top_allocators:
+            logging.info(f"    {allocator['location']}: {allocator['size_bytes'] / 1024 ** 2:.1f} MB ({allocator['size_diff_bytes'] / 1024 ** 2:+.1f} MB), {allocator['count']} blocks")
+
+    def write(self, trace_file):
+        if not self.enabled or self.written:
+            return
+        self.written = True
+        with open(trace_file, 'w') as f:
+            json.dump({'traceEvents': self.events, 'displayTimeUnit': 'ms', 'otherData': {'memory': self.memory_report}}, f)
+        print(f"Profile written to {trace_file}, open it in https://ui.perfetto.dev")
+        logging.info(f"Profile written to {trace_file}")
+
+# Function to describe an argument of a traced function in a span, None to leave it out
+def describe_span_argument(value):
+    if isinstance(value, str):
+        return value[:200]
+    if isinstance(value, (int, float, bool)):
+        return value
+    if isinstance(value, (list, tuple, set)):
+        if len(value) <= 4 and all(isinstance(item, (str, int, float)) for item in value):
+            return list(value)
+        return f"{len(value)} items"
+    # The title of users and videos, read from their attributes so that plexapi doesn't reload the object
+    title = getattr(value, '__dict__', {}).get('title')
+    return title if isinstance(title, str) else None
+
+profiler = Profiler(profile)
+trace_file = os.path.join(logs_folder, f"plexcache_trace_{current_time}.json")
+if profile:
+    atexit.register(profiler.write, trace_file)  # Also written when the script exits early
+
+run_metrics = RunMetrics()
+logging.getLogger().addHandler(RunMetricsHandler(run_metrics))
+atexit.register(write_run_metrics)  # Also written when the script exits early, e.g. on an error
+
+# Token bucket allowing a given number of requests per second, shared by all the threads
+class TokenBucket:
+    def __init__(self, rate, capacity):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+        self.blocked_until = 0  # Set when the server asks to slow down
+        self._lock = threading.Lock()
+
+    # Takes a token and returns the seconds to wait for it if the bucket is empty or blocked, without waiting
+    def reserve(self):
+        with self._lock:
+            now = time.monotonic()
+            self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+            self.tokens -= 1  # Tokens can go negative, the deficit being the time to wait for the next ones
+            return max(self.blocked_until - now, -self.tokens / self.rate, 0)
+
+    # Takes a token, waiting for it if the bucket is empty or blocked, and returns the seconds waited
+    def acquire(self):
+        wait = self.reserve()
+        if wait > 0:
+            time.sleep(wait)
+        return wait
+
+    # Blocks the bucket for the given number of seconds
+    def block(self, seconds):
+        with self._lock:
+            self.blocked_until = max(self.blocked_until, time.monotonic() + seconds)
+
+# Rate limiter with a token bucket for each class of endpoints: plex.tv (watchlist, account) and the Plex server
+# Rate limited requests block their bucket for the time given by Retry-After, or a jittered exponential backoff,
+# so that all the threads slow down together instead of each one sleeping blindly.
+class RateLimiter:
+    def __init__(self, plex_tv_rate, plex_server_rate):
+        self.buckets = {
+            'plex.tv': TokenBucket(plex_tv_rate, plex_tv_rate * 2),
+            'server': TokenBucket(plex_server_rate, plex_server_rate * 2)
+        }
+        self.throttled_seconds = 0.0  # Time lost to rate limiting, across all the threads
+        self.throttled_requests = 0
+        self._lock = threading.Lock()
+        self._prepaid = threading.local()  # Bucket whose token was already waited for by the fetch engine, for this thread
+
+    @staticmethod
+    def get_bucket_name(host):
+        hostname = host.split(':')[0]
+        return 'plex.tv' if hostname == 'plex.tv' or hostname.endswith('.plex.tv') else 'server'
+
+    def get_bucket(self, host):
+        return self.buckets[self.get_bucket_name(host)]
+
+    # Only the time spent blocked by the server counts as throttling
+    def add_throttled(self, blocked, waited):
+        if blocked > 0:
+            with self._lock:
+                self.throttled_seconds += min(waited, blocked)
+
+    # Waits for the given host's bucket, unless the fetch engine already did for this request
+    def wait(self, host):
+        name = self.get_bucket_name(host)
+        if getattr(self._prepaid, 'name', None) == name:
+            self._prepaid.name = None
+            return
+        bucket = self.buckets[name]
+        blocked = bucket.blocked_until - time.monotonic()
+        self.add_throttled(blocked, bucket.acquire())
+
+    # Waits for a token of the given bucket in the event loop of the fetch engine, rather than in a worker thread
+    async def acquire_async(self, name):
+        bucket = self.buckets[name]
+        blocked = bucket.blocked_until - time.monotonic()
+        wait = bucket.reserve()
+        if wait > 0:
+            await asyncio.sleep(wait)
+        self.add_throttled(blocked, wait)
+
+    # Runs the given function in a worker thread with a token of the given bucket acquired by acquire_async(),
+    # which its first request of that bucket then uses
+    def run_prepaid(self, name, function, *args):
+        self._prepaid.name = name
+        try:
+            return function(*args)
+        finally:
+            self._prepaid.name = None
+
+    # Returns how long to wait before retrying a rate limited request, and blocks the host's bucket meanwhile
+    def back_off(self, host, response, attempt):
+        delay = None
+        retry_after = response.headers.get('Retry-After')
+        if retry_after:
+            try:
+                delay = float(retry_after)  # Retry-After is either a number of seconds or an HTTP date
+            except ValueError:
+                try:
+                    delay = parsedate_to_datetime(retry_after).timestamp() - time.time()
+                except (TypeError, ValueError):
+                    delay = None
+        if delay is None:
+            # Exponential backoff with jitter, so that the threads don't all retry at the same time
+            delay = DELAY * (2 ** attempt) * random.uniform(0.5, 1.5)
+        delay = max(delay, 0)
+        self.get_bucket(host).block(delay)
+        with self._lock:
+            self.throttled_requests += 1
+        return delay
+
+rate_limiter = RateLimiter(plex_tv_rate_limit, plex_server_rate_limit)
+
+# Plex user as saved in the account cache
+class CachedUser:
+    def __init__(self, id, title, server_token):
+        self.id = id
+        self.title = title
+        self.server_token = server_token  # None if the user has no access to this server
+
+# Function to build a plex.tv account from its cached data, without the GET plex.tv/api/v2/user of MyPlexAccount
+def load_plex_account(token, data):
+    from plexapi.myplex import MyPlexAccount  # Only imported when the plex.tv accounts are needed
+    from xml.etree import ElementTree
+
+    class CachedPlexAccount(MyPlexAccount):
+        def _signin(self, *args):
+            return ElementTree.fromstring(data), self.key
+
+    return CachedPlexAccount(token=token, session=fetch_session)
+
+# On-disk cache of the Plex account, its users, their server tokens and the plex.tv accounts of the main and home
+# users, so that plex.tv is only asked for them again once the cache expires or when a token gets rejected.
+class AccountCache:
+    def __init__(self, cache_file, expiry_hours):
+        self.cache_file = cache_file
+        self.expiry_hours = expiry_hours
+        self._data = None
+        self._lock = threading.RLock()  # Reentrant, a token rejected while refreshing invalidates the cache from the same thread
+        if cache_file.exists():
+            try:
+                with cache_file.open('r') as f:
+                    self._data = json.load(f)
+            except json.JSONDecodeError:
+                self._data = None
+
+    def save(self):
+        # The file holds tokens, only the owner can read it
+        temp_file = self.cache_file.with_suffix('.tmp')
+        with open(os.open(temp_file, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600), 'w') as f:
+            json.dump(self._data, f)
+        os.replace(temp_file, self.cache_file)
+
+    # Drops the cache, e.g. when the account token is rejected, so that everything is fetched again
+    def invalidate(self):
+        with self._lock:
+            if self._data is not None:
+                logging.warning("The Plex account token was rejected, the account cache will be refreshed.")
+            self._data = None
+            if self.cache_file.exists():
+                os.remove(self.cache_file)
+
+    # Forgets the given rejected token: the whole cache for the account token, otherwise only the user or home token
+    # it belongs to, so that one user losing access doesn't make every run fetch the account again
+    def reject_token(self, token):
+        if not token:
+            return
+        if token == PLEX_TOKEN:
+            self.invalidate()
+            return
+        with self._lock:
+            if self._data is None:
+                return
+            users = [user for user in self._data['users'] if user['server_token'] != token]
+            accounts = {key: account for key, account in self._data['accounts'].items() if not account or account['token'] != token}
+            if len(users) < len(self._data['users']):
+                logging.warning("The server token of a Plex user was rejected, the user is skipped until the account cache expires.")
+            elif len(accounts) < len(self._data['accounts']):
+                logging.warning("The token of a Plex home user was rejected, it will be fetched again.")
+            else:
+                return
+            self._data['users'] = users
+            self._data['accounts'] = accounts
+            self.save()
+
+    def _is_valid(self, plex):
+        return (self._data is not None
+                and 'accounts' in self._data
+                and self._data.get('machine_identifier') == plex.machineIdentifier
+                and datetime.now() - datetime.fromtimestamp(self._data['timestamp']) < timedelta(hours=self.expiry_hours))
+
+    def _get_data(self, plex):
+        with self._lock:
+            if not self._is_valid(plex):
+                logging.info("Fetching the Plex account and its users...")
+                account = plex.myPlexAccount()
+                users = [{'id': user.id, 'title': user.title, 'server_token': user.get_token(plex.machineIdentifier)} for user in account.users()]
+                self._data = {
+                    'timestamp': datetime.now().timestamp(),
+                    'machine_identifier': plex.machineIdentifier,
+                    'username': account.title,
+                    'users': users,
+                    # 'main' or user id -> token and XML data of the plex.tv account (after switching to that home user),
+                    # None if the user isn't a home user
+                    'accounts': {'main': self.get_account_data(account)}
+                }
+                self.save()
+            return self._data
+
+    def get_username(self, plex):
+        return self._get_data(plex)['username']
+
+    def get_users(self, plex):
+        return [CachedUser(user['id'], user['title'], user['server_token']) for user in self._get_data(plex)['users']]
+
+    @staticmethod
+    def get_account_data(account):
+        from xml.etree import ElementTree
+        return {'token': account.authenticationToken, 'data': ElementTree.tostring(account._data, encoding='unicode')}
+
+    # Returns the plex.tv account of the given user (None for the main one), or None if it isn't a home user
+    # The accounts are built from their cached data, plex.tv is only asked again once their token was rejected
+    def get_user_account(self, plex, user=None):
+        from plexapi.myplex import MyPlexAccount  # Only imported when the plex.tv accounts are needed
+        key = 'main' if user is None else str(user.id)
+        accounts = self._get_data(plex)['accounts']
+        if key in accounts:
+            cached_account = accounts[key]
+            return load_plex_account(cached_account['token'], cached_account['data']) if cached_account else None
+        if user is None:
+            account = MyPlexAccount(token=PLEX_TOKEN, session=fetch_session)
+        else:
+            try:
+                account = self.get_user_account(plex).switchHomeUser(f'{user.title}')
+            except NotFound:
+                account = None
+        with self._lock:
+            if self._data is not None:
+                self._data['accounts'][key] = self.get_account_data(account) if account else None
+                self.save()
+        return account
+
+account_cache = AccountCache(account_cache_file, account_cache_expiry)
+
+# Requests session shared by all the Plex API calls
+# It bounds the number of requests in flight, overall and for each host (the Plex server and plex.tv),
+# and retries the rate limited requests through the rate limiter.
+class BoundedSession(requests.Session):
+    def __init__(self, max_requests, max_requests_per_host, rate_limiter):
+        super().__init__()
+        self.rate_limiter = rate_limiter
+        self.max_requests_per_host = max_requests_per_host
+        self._requests = threading.BoundedSemaphore(max_requests)
+        self._hosts = {}
+        self._lock = threading.Lock()
+        # Keep enough connections open to each host for the requests allowed in flight
+        adapter = requests.adapters.HTTPAdapter(pool_connections=4, pool_maxsize=max_requests_per_host)
+        self.mount('http://', adapter)
+        self.mount('https://', adapter)
+
+    def request(self, method, url, *args, **kwargs):
+        host = urlparse(url).netloc
+        with self._lock:
+            host_requests = self._hosts.setdefault(host, threading.BoundedSemaphore(self.max_requests_per_host))
+        for attempt in range(RETRY_LIMIT + 1):
+            self.rate_limiter.wait(host)
+            # Wait for the host first, so that a busy host doesn't hold on to the global slots
+            with host_requests, self._requests, profiler.span(' '.join([method, *get_endpoint(url)])):
+                request_start = time.monotonic()
+                try:
+                    response = super().request(method, url, *args, **kwargs)
+                except Exception:
+                    run_metrics.record_request(url, time.monotonic() - request_start, None)
+                    raise
+                run_metrics.record_request(url, time.monotonic() - request_start, response.status_code)
+            # Plex servers also answer 503 with a Retry-After while they are busy
+            rate_limited = response.status_code == 429 or (response.status_code == 503 and 'Retry-After' in response.headers)
+            if response.status_code == 401:
+                account_cache.reject_token(response.request.headers.get('X-Plex-Token'))
+            if not rate_limited or attempt == RETRY_LIMIT:
+                return response
+            delay = self.rate_limiter.back_off(host, response, attempt)
+            logging.warning(f"Rate limit exceeded by {host}. Retrying {attempt + 1}/{RETRY_LIMIT} in {delay:.1f} seconds...")
+        return response
+
+fetch_session = BoundedSession(max_concurrent_requests, max_concurrent_requests_per_host, rate_limiter)
 
 # Connect to the Plex server
+playing_episodes = []  # (username, episode) of the sessions, for the sessions only mode
 try:
-    plex = PlexServer(PLEX_URL, PLEX_TOKEN)
+    plex = PlexServer(PLEX_URL, PLEX_TOKEN, session=fetch_session)
 except Exception as e:
     logging.critical(f"Error connecting to the Plex server: {e}")
     exit(f"Error connecting to the Plex server: {e}")
 
 # Check if any active session
-sessions = plex.sessions()  # Get the list of active sessions
-if sessions:  # Check if there are any active sessions
-    if exit_if_active_session:  # Check if the 'exit_if_active_session' boolean is set to true
-        logging.warning('There is an active session. Exiting...')
-        exit('There is an active session. Exiting...')
+with run_metrics.phase('session_check'):
+    sessions = plex.sessions()  # Get the list of active sessions
+    if sessions:  # Check if there are any active sessions
+        if exit_if_active_session and not sessions_only:  # Check if the 'exit_if_active_session' boolean is set to true
+            logging.warning('There is an active session. Exiting...')
+            exit('There is an active session. Exiting...')
+        else:
+            for session in sessions:  # Iterate over each active session
+                try:
+                    media = str(session.source())  # Get the source of the session
+                    media_id = media[media.find(":") + 1:media.find(":", media.find(":") + 1)]  # Extract the media ID from the source
+                    media_item = plex.fetchItem(int(media_id))  # Fetch the media item using the media ID
+                    media_title = media_item.title  # Get the title of the media item
+                    media_type = media_item.type  # Get the media type (e.g., show, movie)
+                    if media_type == "episode":  # Check if the media type is an episode
+                        show_title = media_item.grandparentTitle  # Get the title of the show
+                        print(f"Active session detected, skipping: {show_title} - {media_title}")  # Print a message indicating the active session with show and episode titles
+                        logging.warning(f"Active session detected, skipping: {show_title} - {media_title}")  # Log a warning message about the active session with show and episode titles
+                        playing_episodes.append((session.usernames[0] if session.usernames else None, media_item))
+                    elif media_type == "movie":  # Check if the media type is a movie
+                        print(f"Active session detected, skipping: {media_title}")  # Print a message indicating the active session with the movie title
+                        logging.warning(f"Active session detected, skipping: {media_title}")  # Log a warning message about the active session with the movie title
+                    media_path = media_item.media[0].parts[0].file  # Get the file path of the media item
+                    logging.info(f"Skipping: {media_path}")
+                    files_to_skip.append(media_path)  # Add the file path to the list of files to skip
+                except Exception as e:
+                    logging.error(f"Error occurred while processing session: {session} - {e}")  # Log an error message if an exception occurs while processing the session
     else:
-        for session in sessions:  # Iterate over each active session
-            try:
-                media = str(session.source())  # Get the source of the session
-                media_id = media[media.find(":") + 1:media.find(":", media.find(":") + 1)]  # Extract the media ID from the source
-                media_item = plex.fetchItem(int(media_id))  # Fetch the media item using the media ID
-                media_title = media_item.title  # Get the title of the media item
-                media_type = media_item.type  # Get the media type (e.g., show, movie)
-                if media_type == "episode":  # Check if the media type is an episode
-                    show_title = media_item.grandparentTitle  # Get the title of the show
-                    print(f"Active session detected, skipping: {show_title} - {media_title}")  # Print a message indicating the active session with show and episode titles
-                    logging.warning(f"Active session detected, skipping: {show_title} - {media_title}")  # Log a warning message about the active session with show and episode titles
-                elif media_type == "movie":  # Check if the media type is a movie
-                    print(f"Active session detected, skipping: {media_title}")  # Print a message indicating the active session with the movie title
-                    logging.warning(f"Active session detected, skipping: {media_title}")  # Log a warning message about the active session with the movie title
-                media_path = media_item.media[0].parts[0].file  # Get the file path of the media item
-                logging.info(f"Skipping: {media_path}")
-                files_to_skip.append(media_path)  # Add the file path to the list of files to skip
-            except Exception as e:
-                logging.error(f"Error occurred while processing session: {session} - {e}")  # Log an error message if an exception occurs while processing the session
-else:
-    logging.info('No active sessions found. Proceeding...')  # Log an info message indicating no active sessions were found, and proceed with the code execution
+        logging.info('No active sessions found. Proceeding...')  # Log an info message indicating no active sessions were found, and proceed with the code execution
+profiler.snapshot('session_check')
 
 # Check if debug mode is active
 if debug:
@@ -540,277 +1322,728 @@ if debug:
 else:
     logging.getLogger().setLevel(logging.INFO)
 
-# Main function to fetch onDeck media files
-def fetch_on_deck_media_main(plex, valid_sections, days_to_monitor, number_episodes, users_toggle, skip_ondeck):
-    try:
-        users_to_fetch = [None]  # Start with main user (None)
-
-        if users_toggle:
-            users_to_fetch += plex.myPlexAccount().users()
-            # Filter out the users present in skip_ondeck
-            users_to_fetch = [user for user in users_to_fetch if (user is None) or (user.get_token(plex.machineIdentifier) not in skip_ondeck)]
-
-        with ThreadPoolExecutor(max_workers=10) as executor:
-            futures = {executor.submit(fetch_on_deck_media, plex, valid_sections, days_to_monitor, number_episodes, user) for user in users_to_fetch}
-            for future in as_completed(futures):
-                try:
-                    yield from future.result()
-                except Exception as e:
-                    print(f"An error occurred in fetch_on_deck_media: {e}")
-                    logging.error(f"An error occurred while fetching onDeck media for a user: {e}")
-
-    except Exception as e:
-        print(f"An error occurred in fetch_on_deck_media: {e}")
-        logging.error(f"An error occurred in fetch_on_deck_media_main: {e}")
-
+# Function to fetch the onDeck media files of a user
+@profiler.trace()
 def fetch_on_deck_media(plex, valid_sections, days_to_monitor, number_episodes, user=None):
-    try:
-        username, plex = get_plex_instance(plex, user)  # Get the username and Plex instance
-        if not plex:  # Check if Plex instance is available
-            return []  # Return an empty list
-
-        print(f"Fetching {username}'s onDeck media...")  # Print a message indicating that onDeck media is being fetched
-        logging.info(f"Fetching {username}'s onDeck media...")  # Log the message indicating that onDeck media is being fetched
-        
-        on_deck_files = []  # Initialize an empty list to store onDeck files
-        # Get all sections available for the user
-        available_sections = [section.key for section in plex.library.sections()]
-
-        # Intersect available_sections and valid_sections
-        filtered_sections = list(set(available_sections) & set(valid_sections))
-
-        for video in plex.library.onDeck():  # Iterate through the onDeck videos in the Plex library
-            section_key = video.section().key  # Get the section key of the video
-            if not filtered_sections or section_key in filtered_sections:  # Check if filtered_sections is empty or the video belongs to a valid section
-                delta = datetime.now() - video.lastViewedAt  # Calculate the time difference between now and the last viewed time of the video
-                if delta.days <= days_to_monitor:  # Check if the video was viewed within the specified number of days
-                    if isinstance(video, Episode):  # Check if the video is an episode
-                        process_episode_ondeck(video, number_episodes, on_deck_files)  # Process the episode and add it to the onDeck files list
-                    elif isinstance(video, Movie):  # Check if the video is a movie
-                        process_movie_ondeck(video, on_deck_files)  # Process the movie and add it to the onDeck files list
-
-        return on_deck_files  # Return the list of onDeck files
-
-    except Exception as e:  # Handle any exceptions that occur
-        print(f"An error occurred while fetching onDeck media: {e}")  # Print an error message indicating the exception
-        logging.error(f"An error occurred while fetching onDeck media: {e}")  # Log an error message indicating the exception
+    username, plex = get_plex_instance(plex, user)  # Get the username and Plex instance
+    if not plex:  # Check if Plex instance is available
         return []  # Return an empty list
 
+    print(f"Fetching {username}'s onDeck media...")  # Print a message indicating that onDeck media is being fetched
+    logging.info(f"Fetching {username}'s onDeck media...")  # Log the message indicating that onDeck media is being fetched
+    
+    on_deck_files = []  # Initialize an empty list to store onDeck files
+    # Get all sections available for the user
+    available_sections = [section.key for section in plex.library.sections()]
+
+    # Intersect available_sections and valid_sections
+    filtered_sections = list(set(available_sections) & set(valid_sections))
+
+    for video in plex.library.onDeck():  # Iterate through the onDeck videos in the Plex library
+        section_key = video.section().key  # Get the section key of the video
+        if not filtered_sections or section_key in filtered_sections:  # Check if filtered_sections is empty or the video belongs to a valid section
+            delta = datetime.now() - video.lastViewedAt  # Calculate the time difference between now and the last viewed time of the video
+            if delta.days <= days_to_monitor:  # Check if the video was viewed within the specified number of days
+                if isinstance(video, Episode):  # Check if the video is an episode
+                    process_episode_ondeck(video, number_episodes, on_deck_files)  # Process the episode and add it to the onDeck files list
+                elif isinstance(video, Movie):  # Check if the video is a movie
+                    process_movie_ondeck(video, on_deck_files)  # Process the movie and add it to the onDeck files list
+
+    add_media_users(on_deck_files, username)
+    return on_deck_files  # Return the list of onDeck files
+
+# Function to remember which users reference the given files, it gets saved in the state database
+def add_media_users(files, username):
+    with media_users_lock:
+        for file in files:
+            media_users.setdefault(file, set()).add(username)
+
+# Function to remember when the given files are expected to be watched, keeping the soonest
+# The position is 0 for the onDeck episode or movie itself, 1 for the next episode and so on
+def set_media_priority(files, tier, position):
+    with media_priorities_lock:
+        for file in files:
+            media_priorities[file] = min(media_priorities.get(file, (tier, position)), (tier, position))
+
+# Function to get the users referencing the given edited files
+def get_media_users(files):
+    files = set(files)
+    users = {}
+    with media_users_lock:
+        for plex_path, usernames in media_users.items():
+            file = edited_file_paths.get(plex_path)
+            if file in files:
+                users.setdefault(file, set()).update(usernames)
+    return users
+
 # Function to fetch the Plex instance
+# Each user's instance is only created once per run and shared by all the fetching phases
 def get_plex_instance(plex, user):
-    if user:
+    user_key = user.id if user else None
+    with plex_instances_lock:
+        if user_key in plex_instances:
+            return plex_instances[user_key]
+    if user and not user.server_token:
+        logging.warning(f"{user.title} has no access to this Plex server. Skipping...")
+        instance = None, None
+    elif user:
         username = user.title  # Get the username
         try:
-            return username, PlexServer(PLEX_URL, user.get_token(plex.machineIdentifier))  # Return username and PlexServer instance with user token
+            instance = username, PlexServer(PLEX_URL, user.server_token, session=fetch_session)  # Username and PlexServer instance with user token
         except Exception as e:
-            print(f"Error: Failed to Fetch {username} onDeck media. Error: {e}")  # Print error message if failed to fetch onDeck media for the user
-            logging.error(f"Error: Failed to Fetch {username} onDeck media. Error: {e}")  # Log the error
-            return None, None
+            print(f"Error: Failed to connect to the Plex server as {username}. Error: {e}")  # Print error message if failed to connect as the user
+            logging.error(f"Error: Failed to connect to the Plex server as {username}. Error: {e}")  # Log the error
+            instance = None, None
     else:
-        username = plex.myPlexAccount().title  # Get the username from the Plex account
-        return username, PlexServer(PLEX_URL, PLEX_TOKEN)  # Return username and PlexServer instance with account token
+        username = account_cache.get_username(plex)  # Get the username from the Plex account
+        instance = username, plex  # The main user uses the already connected instance
+    with plex_instances_lock:
+        return plex_instances.setdefault(user_key, instance)
 
 # Function to process the onDeck media files
-def process_episode_ondeck(video, number_episodes, on_deck_files):
-    for media in video.media:
-        on_deck_files.extend(part.file for part in media.parts)  # Add file paths of media parts to onDeck files list
-    show = video.grandparentTitle  # Get the title of the show
-    library_section = video.section()  # Get the library section of the video
-    episodes = list(library_section.search(show)[0].episodes())  # Search the library section for episodes of the show
-    current_season = video.parentIndex  # Get the index of the current season
-    next_episodes = get_next_episodes(episodes, current_season, video.index, number_episodes)  # Get the next episodes based on the current episode and season
-    for episode in next_episodes:
-        for media in episode.media:
-            on_deck_files.extend(part.file for part in media.parts)  # Add file paths of media parts of the next episodes to onDeck files list
-            for part in media.parts:
-                logging.info(f"OnDeck found: {(part.file)}")  # Log the file path of the onDeck media part
+# With finished=True the episode itself was just watched to the end, only the ones after it are added
+@profiler.trace()
+def process_episode_ondeck(video, number_episodes, on_deck_files, finished=False):
+    if not finished:
+        for media in video.media:
+            on_deck_files.extend(part.file for part in media.parts)  # Add file paths of media parts to onDeck files list
+            set_media_priority((part.file for part in media.parts), PRIORITY_ONDECK, 0)
+    next_episodes = episode_index.get_next_episodes(video, number_episodes)  # Get the next episodes based on the current episode and season
+    for position, episode in enumerate(next_episodes, start=0 if finished else 1):
+        for media_files in episode.files:
+            on_deck_files.extend(media_files)  # Add file paths of media parts of the next episodes to onDeck files list
+            set_media_priority(media_files, PRIORITY_ONDECK, position)
+            for file in media_files:
+                logging.info(f"OnDeck found: {file}")  # Log the file path of the onDeck media part
 
 # Function to process the onDeck movies files
 def process_movie_ondeck(video, on_deck_files):
     for media in video.media:
         on_deck_files.extend(part.file for part in media.parts)  # Add file paths of media parts to onDeck files list
+        set_media_priority((part.file for part in media.parts), PRIORITY_ONDECK, 0)
         for part in media.parts:
             logging.info(f"OnDeck found: {(part.file)}")  # Log the file path of the onDeck media part
 
-# Function to get the next episodes
-def get_next_episodes(episodes, current_season, current_episode_index, number_episodes):
-    next_episodes = []
-    for episode in episodes:
-        if (episode.parentIndex > current_season or (episode.parentIndex == current_season and episode.index > current_episode_index)) and len(next_episodes) < number_episodes:
-            next_episodes.append(episode)  # Add the episode to the next_episodes list if it comes after the current episode
-        if len(next_episodes) == number_episodes:
-            break  # Stop iterating if the desired number of next episodes is reached
-    return next_episodes  # Return the list of next episodes
-
-# Function to search for a file in the Plex server
-def search_plex(plex, title):
-    results = plex.search(title)
-    return results[0] if len(results) > 0 else None
-
-def fetch_watchlist_media(plex, valid_sections, watchlist_episodes, users_toggle, skip_watchlist):
-
-    def get_watchlist(token, user=None, retries=0):
-        # Retrieve the watchlist for the specified user's token.
-        account = MyPlexAccount(token=token)
-        try:
-            if user:
-                account = account.switchHomeUser(f'{user.title}')
-            return account.watchlist(filter='released')
-        except (BadRequest, NotFound) as e:
-            if "429" in str(e) and retries < RETRY_LIMIT:  # Rate limit exceeded
-                logging.warning(f"Rate limit exceeded. Retrying {retries + 1}/{RETRY_LIMIT}. Sleeping for {DELAY} seconds...")
-                time.sleep(DELAY)
-                return get_watchlist(token, user, retries + 1)
-            elif isinstance(e, NotFound):
-                logging.warning(f"Failed to switch to user {user.title if user else 'Unknown'}. Skipping...")
-                return []
+# Episode as kept in the episode index: only what is the same for every user, not the watched state
+ITEMS_BATCH = 100  # Library items read with a single request, e.g. for their watched state
+
+class IndexedEpisode:
+    def __init__(self, episode):
+        self.rating_key = episode.ratingKey
+        self.files = [[part.file for part in media.parts] for media in episode.media]  # File paths of the parts of each media
+
+# Shared index of the episodes of each show, keyed by the show's ratingKey (grandparentRatingKey)
+# Each show is fetched once per run, no matter how many users have it onDeck, and its episodes
+# are kept sorted by (season, episode) so the next episodes can be found with a bisect.
+# The show is fetched with the token of whichever user needs it first, so the index holds no watched state.
+class EpisodeIndex:
+    def __init__(self):
+        self._shows = {}  # ratingKey -> (sorted (season, episode) keys, sorted episodes)
+        self._show_locks = {}  # ratingKey -> lock, so that only one thread fetches a given show
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def episode_key(episode):
+        # Episodes without a season or episode number (e.g. unmatched files) are sorted first
+        return (episode.parentIndex or 0, episode.index or 0)
+
+    # Returns the sorted (season, episode) keys and episodes of a show, fetch_show is only called the first time
+    def get_show_episodes(self, show_key, fetch_show):
+        show_key = int(show_key)
+        with self._lock:
+            show_lock = self._show_locks.setdefault(show_key, threading.Lock())
+        with show_lock:
+            if show_key not in self._shows:
+                show = fetch_show()
+                episodes = sorted(show.episodes(), key=self.episode_key)
+                self._shows[show_key] = ([self.episode_key(episode) for episode in episodes], [IndexedEpisode(episode) for episode in episodes])
+                logging.debug(f"Indexed {len(episodes)} episodes of {show.title}")
+        return self._shows[show_key]
+
+    # Function to get the next episodes
+    def get_next_episodes(self, video, number_episodes):
+        # Fetch the show by its ratingKey rather than searching its title
+        keys, episodes = self.get_show_episodes(video.grandparentRatingKey, video.show)
+        start = bisect.bisect_right(keys, self.episode_key(video))  # First episode after the current one
+        return episodes[start:start + number_episodes]
+
+    def invalidate(self, show_key=None):
+        with self._lock:
+            if show_key is None:
+                self._shows.clear()
             else:
-                raise e
-
-
-    def process_show(file, watchlist_episodes):
-        #Process episodes of a TV show file up to a specified number.
-        episodes = file.episodes()
-        count = 0
-        for episode in episodes[:watchlist_episodes]:
-            if len(episode.media) > 0 and len(episode.media[0].parts) > 0:
-                count += 1
-                if not episode.isPlayed:
-                    yield episode.media[0].parts[0].file
-
-    def process_movie(file):
-        #Process a movie file.
-        if not file.isPlayed:
-            yield file.media[0].parts[0].file
-
-    def fetch_user_watchlist(user):
-        current_username = plex.myPlexAccount().title if user is None else user.title
-        available_sections = [section.key for section in plex.library.sections()]
-        filtered_sections = list(set(available_sections) & set(valid_sections))
-
-        if user and user.get_token(plex.machineIdentifier) in skip_watchlist:
-            logging.info(f"Skipping {current_username}'s watchlist media...")
+                self._shows.pop(int(show_key), None)
+
+episode_index = EpisodeIndex()
+
+# Index of the library items by their plex://, imdb://, tmdb:// and tvdb:// guids, used to resolve watchlist items
+# It is saved to disk and a section is only listed again when its updatedAt changes.
+class GuidIndex:
+    def __init__(self, index_file):
+        self.index_file = index_file
+        self._sections = {}  # section key -> {'updatedAt': timestamp, 'guids': {guid: ratingKey}}
+        self._guids = {}  # guid -> ratingKey, across all the indexed sections
+        self._items = {}  # ratingKey -> library item, shared by all users
+        self._fetch_lock = threading.Lock()  # One user fetches the missing items at a time, the others then find them
+        self._loaded = False  # Loaded on the first refresh, it isn't needed by every run
+
+
+    def load(self):
+        if self.index_file.exists():
+            try:
+                with self.index_file.open('r') as f:
+                    self._sections = json.load(f).get('sections', {})
+            except (json.JSONDecodeError, AttributeError) as e:
+                logging.warning(f"Invalid guid index file, it will be rebuilt: {e}")
+                self._sections = {}
+
+    def save(self):
+        # Write to a temporary file first so that a crash can't leave a truncated index behind
+        temp_file = self.index_file.with_suffix('.tmp')
+        with temp_file.open('w') as f:
+            json.dump({'sections': self._sections}, f)
+        os.replace(temp_file, self.index_file)
+
+    # Lists again the sections that changed since the last run, and drops the ones no longer valid
+    def refresh(self, plex, valid_sections):
+        if not self._loaded:
+            self.load()
+            self._loaded = True
+        sections = {}
+        for section in plex.library.sections():
+            if section.type not in ('movie', 'show') or (valid_sections and section.key not in valid_sections):
+                continue
+            updated_at = section.updatedAt.timestamp() if section.updatedAt else None
+            cached_section = self._sections.get(str(section.key))
+            if cached_section and updated_at and cached_section['updatedAt'] == updated_at:
+                sections[str(section.key)] = cached_section
+                continue
+            logging.info(f"Indexing the {section.title} library...")
+            guids = {}
+            for item in section.search(includeGuids=True):
+                guids[item.guid] = item.ratingKey
+                for guid in item.guids:
+                    guids[guid.id] = item.ratingKey
+                self._items[item.ratingKey] = item
+            sections[str(section.key)] = {'updatedAt': updated_at, 'guids': guids}
+        changed = sections != self._sections
+        self._sections = sections
+        self._guids = {guid: rating_key for section in sections.values() for guid, rating_key in section['guids'].items()}
+        if changed:
+            self.save()
+
+    # Returns the ratingKey of the library item matching the given watchlist item, or None if it isn't in the library
+    # The other guids of the item are only read if its Plex guid isn't known, as reading them may reload the item.
+    def get_rating_key(self, item):
+        rating_key = self._guids.get(item.guid)
+        if rating_key is None:
+            rating_key = next((self._guids[guid.id] for guid in item.guids if guid.id in self._guids), None)
+        return rating_key
+
+    # Returns the library items of the given ratingKeys, the ones not indexed in this run fetched with one request per batch
+    # An item removed since its section was indexed is None.
+    def get_items(self, plex, rating_keys):
+        missing = [rating_key for rating_key in dict.fromkeys(rating_keys) if rating_key not in self._items]
+        if missing:
+            with self._fetch_lock:
+                missing = [rating_key for rating_key in missing if rating_key not in self._items]
+                for start in range(0, len(missing), ITEMS_BATCH):
+                    batch = missing[start:start + ITEMS_BATCH]
+                    try:
+                        items = plex.fetchItems('/library/metadata/' + ','.join(str(rating_key) for rating_key in batch))
+                    except NotFound:
+                        items = []
+                    fetched_items = {item.ratingKey: item for item in items}
+                    for rating_key in batch:
+                        self._items[rating_key] = fetched_items.get(rating_key)
+        return {rating_key: self._items[rating_key] for rating_key in rating_keys}
+
+guid_index = GuidIndex(guid_index_file)
+
+# Function to retrieve the watchlist of the specified user.
+# Rate limited requests are retried by fetch_session.
+def get_watchlist(plex, user=None):
+    account = account_cache.get_user_account(plex, user)
+    if account is None:
+        logging.warning(f"Failed to switch to user {user.title if user else 'Unknown'}. Skipping...")
+        return []
+    return account.watchlist(filter='released')
+
+# Function to process episodes of a TV show file up to a specified number.
+# Yields the (file, position, ratingKey) of the episodes, whether the user played them is checked afterwards.
+def process_show(file, watchlist_episodes):
+    episodes = episode_index.get_show_episodes(file.ratingKey, lambda: file)[1]
+    count = 0
+    for episode in episodes[:watchlist_episodes]:
+        if len(episode.files) > 0 and len(episode.files[0]) > 0:
+            count += 1
+            yield episode.files[0][0], count, episode.rating_key
+
+# Function to process a movie file.
+def process_movie(file):
+    yield file.media[0].parts[0].file, 0, file.ratingKey
+
+# Function to get which of the given items (episodes or movies) the user of the given Plex instance played
+# The library items are shared by all the users, so their own watched state is read with one request per batch of items.
+def get_played_items(plex, rating_keys):
+    played = set()
+    rating_keys = list(dict.fromkeys(rating_keys))
+    for start in range(0, len(rating_keys), ITEMS_BATCH):
+        batch = rating_keys[start:start + ITEMS_BATCH]
+        items = plex.fetchItems('/library/metadata/' + ','.join(str(rating_key) for rating_key in batch))
+        played.update(item.ratingKey for item in items if item.isPlayed)
+    return played
+
+# Function to fetch the watchlist media files of a user
+@profiler.trace()
+def fetch_user_watchlist(plex, valid_sections, watchlist_episodes, skip_watchlist, user=None):
+    current_username = account_cache.get_username(plex) if user is None else user.title
+    available_sections = [section.key for section in plex.library.sections()]
+    filtered_sections = list(set(available_sections) & set(valid_sections))
+
+    if user and user.server_token in skip_watchlist:
+        logging.info(f"Skipping {current_username}'s watchlist media...")
+        return []
+
+    logging.info(f"Fetching {current_username}'s watchlist media...")
+    try:
+        watchlist = get_watchlist(plex, user)
+        candidates = []
+
+        rating_keys = [guid_index.get_rating_key(item) for item in watchlist]
+        items = guid_index.get_items(plex, [rating_key for rating_key in rating_keys if rating_key is not None])
+        for rating_key in rating_keys:
+            file = items.get(rating_key)
+            if file and (not filtered_sections or (file.librarySectionID in filtered_sections)):
+                if file.TYPE == 'show':
+                    candidates.extend(process_show(file, watchlist_episodes))
+                else:
+                    candidates.extend(process_movie(file))
+
+        # Only the media the user didn't play, by their own watched state (the admin's for users without access to the server)
+        user_plex = get_plex_instance(plex, user)[1] or plex
+        played = get_played_items(user_plex, [rating_key for _, _, rating_key in candidates])
+        results = []
+        for file, position, rating_key in candidates:
+            if rating_key not in played:
+                set_media_priority([file], PRIORITY_WATCHLIST, position)
+                results.append(file)
+        add_media_users(results, current_username)
+        return results
+    except Exception as e:
+        logging.error(f"Error fetching watchlist for {current_username}: {str(e)}")
+        return []
+
+# Function to fetch the watched media files of a user
+@profiler.trace()
+def fetch_user_watched_media(plex, valid_sections, last_updated, user=None):
+    username, plex_instance = get_plex_instance(plex, user)
+    if not plex_instance:
+        return []
+    watched_files = []
+    try:
+        print(f"Fetching {username}'s watched media...")
+        logging.info(f"Fetching {username}'s watched media...")
+        # Get all sections available for the user
+        all_sections = [section.key for section in plex_instance.library.sections()]
+        # Check if valid_sections is specified. If not, consider all available sections as valid.
+        if valid_sections:
+            available_sections = list(set(all_sections) & set(valid_sections))
+        else:
+            available_sections = all_sections
+        # Filter sections the user has access to
+        user_accessible_sections = [section for section in available_sections if section in all_sections]
+        for section_key in user_accessible_sections:
+            section = plex_instance.library.sectionByID(section_key)  # Get the section object using its key
+            # Search for videos in the section
+            for video in section.search(unwatched=False):
+                # Skip if the video was last viewed before the last_updated timestamp
+                if video.lastViewedAt and last_updated and video.lastViewedAt < datetime.fromtimestamp(last_updated):
+                    continue
+                # Process the video and add the file paths
+                watched_files.extend(process_video(video))
+        add_media_users(watched_files, username)
+        return watched_files
+
+    except NotFound:
+        print(f"Failed to switch to user {username}. Skipping...")
+        logging.warning(f"Failed to switch to user {username}. Skipping...")
+        return []
+
+def process_video(video):
+    if video.TYPE == 'show':
+        # Iterate through each episode of a show video
+        for episode in video.episodes():
+            yield from process_episode(episode)
+    else:
+        # Get the file path of the video
+        #if video.isPlayed:
+        file_path = video.media[0].parts[0].file
+        yield file_path
+
+def process_episode(episode):
+    # Iterate through each media and part of an episode
+    for media in episode.media:
+        for part in media.parts:
+            if episode.isPlayed:
+                # Get the file path of the played episode
+                file_path = part.file
+                yield file_path
+
+# Function to get the position of a play history entry, used as cursor for the incremental watched sync
+def get_history_cursor(play):
+    return {'history_id': int(play.historyKey.rsplit('/', 1)[-1]), 'viewed_at': play.viewedAt.timestamp()}
+
+# Function to get the cursor of the newest entry in the server's play history
+def get_newest_history_cursor(plex):
+    newest_plays = plex.history(maxresults=1)
+    return get_history_cursor(newest_plays[0]) if newest_plays else None
+
+# Function to fetch the media watched since the given cursor, reading only the new entries of the server's play history
+# It returns None as media if the cursor is no longer valid (e.g. the play history was cleared), a full resync is then needed
+def fetch_watched_history(plex, valid_sections, history_cursor, users_toggle):
+    newest_cursor = get_newest_history_cursor(plex)
+    if newest_cursor is None or newest_cursor['history_id'] < history_cursor['history_id']:
+        return None, newest_cursor
+    if newest_cursor['history_id'] == history_cursor['history_id']:
+        return [], history_cursor  # Nothing was played since the last run
+
+    print("Fetching watched media from the play history...")
+    logging.info("Fetching watched media from the play history...")
+    account_names = {account.id: account.name for account in plex.systemAccounts()}
+    rating_keys = []
+    play_accounts = {}
+    # plexapi filters with viewedAt > mindate, plays sharing the cursor's second are then skipped by their id
+    for play in plex.history(mindate=datetime.fromtimestamp(history_cursor['viewed_at'] - 1)):
+        if get_history_cursor(play)['history_id'] <= history_cursor['history_id']:
+            continue
+        if not users_toggle and play.accountID != 1:  # The server owner is always account 1
+            continue
+        if valid_sections and play.librarySectionID not in valid_sections:
+            continue
+        if play.ratingKey not in rating_keys:
+            rating_keys.append(play.ratingKey)
+        play_accounts.setdefault(play.ratingKey, set()).add(account_names.get(play.accountID, str(play.accountID)))
+
+    watched_files = []
+    for rating_key in rating_keys:
+        try:
+            video = plex.fetchItem(rating_key)
+        except NotFound:
+            continue  # The media was removed since it was played
+        for media in video.media:
+            watched_files.extend(part.file for part in media.parts)
+            for username in play_accounts[rating_key]:
+                add_media_users((part.file for part in media.parts), username)
+    logging.info(f"Found {len(watched_files)} watched files in {len(rating_keys)} new plays.")
+    return watched_files, newest_cursor
+
+# Function to convert a date of the Plex library database to a timestamp, older servers store them as text
+def get_database_timestamp(value):
+    if value is None or isinstance(value, (int, float)):
+        return value
+    try:
+        return float(value)
+    except ValueError:
+        return datetime.fromisoformat(value).timestamp()
+
+# Read-only planner working on the Plex library database, for a local install
+# Instead of the onDeck, episodes, library searches and lazy reloads of the Plex API, the episodes, movies, files and
+# the play state of every account are read with a few queries, in a single read transaction so that they come from a
+# consistent snapshot while Plex keeps writing. Its fetch functions are drop-in replacements of the API ones.
+# The database is only read once, the first time it is needed, and shared by all the users.
+class LibraryDatabase:
+    def __init__(self, database_file):
+        self.database_file = database_file
+        self._data = None
+        self._lock = threading.Lock()
+
+    def _connect(self):
+        # Read-only, Plex is the only writer of its database
+        connection = sqlite3.connect(Path(self.database_file).resolve().as_uri() + '?mode=ro', uri=True, check_same_thread=False)
+        # Collations of the Plex schema, only needed if SQLite picks one of the indexes using them
+        for collation in ('naturalsort', 'icu_root'):
+            connection.create_collation(collation, lambda a, b: (a > b) - (a < b))
+        return connection
+
+    def _read(self):
+        started = time.monotonic()
+        connection = self._connect()
+        try:
+            connection.execute('BEGIN')
+            items = {}  # Id -> (type, section, guid, show id or None, (season, episode) key)
+            for item_id, item_type, section, guid, index, season_index, show_id in connection.execute(
+                    'SELECT item.id, item.metadata_type, item.library_section_id, item.guid, item."index", season."index", season.parent_id '
+                    'FROM metadata_items AS item LEFT JOIN metadata_items AS season ON item.metadata_type = 4 AND season.id = item.parent_id '
+                    'WHERE item.metadata_type IN (1, 4)'):
+                items[item_id] = (item_type, section, guid, show_id if item_type == 4 else None, (season_index or 0, index or 0))
+            files = {}  # Item id -> files of its media
+            for item_id, file in connection.execute(
+                    'SELECT media_items.metadata_item_id, media_parts.file FROM media_parts '
+                    'JOIN media_items ON media_items.id = media_parts.media_item_id '
+                    'WHERE media_parts.deleted_at IS NULL AND media_items.deleted_at IS NULL AND media_parts.file != \'\' '
+                    'ORDER BY media_items.id, media_parts.id'):
+                files.setdefault(item_id, []).append(file)
+            settings = {}  # Account id -> [(guid, view count, view offset, last viewed at)]
+            for account_id, guid, view_count, view_offset, last_viewed_at in connection.execute(
+                    'SELECT account_id, guid, view_count, view_offset, last_viewed_at FROM metadata_item_settings '
+                    'WHERE view_count > 0 OR view_offset > 0'):
+                settings.setdefault(account_id, []).append((guid, view_count or 0, view_offset or 0, get_database_timestamp(last_viewed_at)))
+            accounts = dict(connection.execute('SELECT id, name FROM accounts'))
+            newest_play = connection.execute('SELECT id, viewed_at FROM metadata_item_views ORDER BY id DESC LIMIT 1').fetchone()
+            connection.execute('COMMIT')
+        finally:
+            connection.close()
+
+        items_by_guid = {}
+        show_episodes = {}  # Show id -> (sorted (season, episode) keys, ids of the episodes in the same order)
+        for item_id, (item_type, _, guid, show_id, key) in items.items():
+            items_by_guid.setdefault(guid, []).append(item_id)
+            if show_id is not None:
+                show_episodes.setdefault(show_id, []).append((key, item_id))
+        for show_id, episodes in show_episodes.items():
+            episodes.sort()
+            show_episodes[show_id] = ([key for key, _ in episodes], [item_id for _, item_id in episodes])
+        logging.info(f"Read {len(items)} episodes and movies, {len(files)} of them with files, from the Plex database in {time.monotonic() - started:.2f} seconds.")
+        return {
+            'items': items,
+            'items_by_guid': items_by_guid,
+            'show_episodes': show_episodes,
+            'files': files,
+            'settings': settings,
+            'accounts': accounts,
+            'newest_cursor': {'history_id': newest_play[0], 'viewed_at': get_database_timestamp(newest_play[1])} if newest_play else None
+        }
+
+    def get_data(self):
+        with self._lock:
+            if self._data is None:
+                self._data = self._read()
+            return self._data
+
+    # Checks that the database can be read, the Plex API is used instead if it can't
+    def is_available(self):
+        try:
+            self.get_data()
+            return True
+        except (sqlite3.Error, OSError, ValueError) as e:
+            logging.warning(f"Could not read the Plex database {self.database_file}, using the Plex API instead: {e}")
+            return False
+
+    # Returns the username and the database account of the given user (None for the main one), None if it has no access
+    def get_account(self, plex, user):
+        if user is None:
+            return account_cache.get_username(plex), 1  # The server owner is always account 1
+        if not user.server_token:
+            logging.warning(f"{user.title} has no access to this Plex server. Skipping...")
+            return user.title, None
+        # The accounts of the shared and home users have their plex.tv ids
+        if user.id not in self.get_data()['accounts']:
+            logging.warning(f"{user.title} has no account in the Plex database. Skipping...")
+            return user.title, None
+        return user.title, user.id
+
+    # Returns the played and in progress episodes and movies of an account, in the valid sections
+    def get_account_items(self, account_id, valid_sections):
+        data = self.get_data()
+        for guid, view_count, view_offset, last_viewed_at in data['settings'].get(account_id, []):
+            for item_id in data['items_by_guid'].get(guid, []):
+                item = data['items'][item_id]
+                if not valid_sections or item[1] in valid_sections:
+                    yield item_id, item, view_count, view_offset, last_viewed_at
+
+    # Same as fetch_on_deck_media: the episodes and movies in progress, and the episode after the last one watched of
+    # each show, if it was watched in the last days_to_monitor days, with the number_episodes following episodes
+    @profiler.trace('fetch_on_deck_media')
+    def fetch_on_deck_media(self, plex, valid_sections, days_to_monitor, number_episodes, user=None):
+        username, account_id = self.get_account(plex, user)
+        if account_id is None:
+            return []
+        print(f"Fetching {username}'s onDeck media from the Plex database...")
+        logging.info(f"Fetching {username}'s onDeck media from the Plex database...")
+        data = self.get_data()
+        now = time.time()
+        on_deck_files = []
+        played = set()
+        last_episodes = {}  # Show id -> (last viewed at, episode id, in progress) of the last episode watched
+        for item_id, (item_type, _, _, show_id, _), view_count, view_offset, last_viewed_at in self.get_account_items(account_id, valid_sections):
+            if view_count:
+                played.add(item_id)
+            if not last_viewed_at or (now - last_viewed_at) // 86400 > days_to_monitor:
+                continue
+            if item_type == 1:
+                if view_offset:
+                    # A movie in progress
+                    files = data['files'].get(item_id, [])
+                    on_deck_files.extend(files)
+                    set_media_priority(files, PRIORITY_ONDECK, 0)
+                    for file in files:
+                        logging.info(f"OnDeck found: {file}")
+            elif show_id is not None and (show_id not in last_episodes or last_viewed_at > last_episodes[show_id][0]):
+                last_episodes[show_id] = (last_viewed_at, item_id, bool(view_offset))
+
+        for show_id, (_, episode_id, in_progress) in last_episodes.items():
+            episodes = data['show_episodes'][show_id][1]
+            position = episodes.index(episode_id)
+            if not in_progress:
+                # The next episode not played yet, the show is not onDeck once they are all played
+                position = next((index for index in range(position + 1, len(episodes)) if episodes[index] not in played), None)
+                if position is None:
+                    continue
+            for offset, next_episode in enumerate(episodes[position:position + number_episodes + 1]):
+                files = data['files'].get(next_episode, [])
+                on_deck_files.extend(files)
+                set_media_priority(files, PRIORITY_ONDECK, offset)
+                for file in files:
+                    logging.info(f"OnDeck found: {file}")
+        add_media_users(on_deck_files, username)
+        return on_deck_files
+
+    # Same as fetch_user_watched_media: the played movies, and the played episodes of the shows, viewed since last_updated
+    @profiler.trace('fetch_user_watched_media')
+    def fetch_user_watched_media(self, plex, valid_sections, last_updated, user=None):
+        username, account_id = self.get_account(plex, user)
+        if account_id is None:
             return []
+        print(f"Fetching {username}'s watched media from the Plex database...")
+        logging.info(f"Fetching {username}'s watched media from the Plex database...")
+        data = self.get_data()
+        watched_files = []
+        show_episodes = {}  # Show id -> ids of the played episodes
+        show_last_viewed = {}
+        for item_id, (item_type, _, _, show_id, _), view_count, _, last_viewed_at in self.get_account_items(account_id, valid_sections):
+            if not view_count:
+                continue
+            if item_type == 1:
+                if not (last_viewed_at and last_updated and last_viewed_at < last_updated):
+                    watched_files.extend(data['files'].get(item_id, [])[:1])
+            elif show_id is not None:
+                show_episodes.setdefault(show_id, set()).add(item_id)
+                show_last_viewed[show_id] = max(show_last_viewed.get(show_id) or 0, last_viewed_at or 0)
+        for show_id, episodes in show_episodes.items():
+            # Like the show in the Plex API, all its played episodes are included if any was viewed since last_updated
+            if show_last_viewed[show_id] and last_updated and show_last_viewed[show_id] < last_updated:
+                continue
+            for episode_id in data['show_episodes'][show_id][1]:
+                if episode_id in episodes:
+                    watched_files.extend(data['files'].get(episode_id, []))
+        add_media_users(watched_files, username)
+        return watched_files
+
+    # Same as get_newest_history_cursor, so that the play history can be read through the Plex API afterwards
+    def get_newest_history_cursor(self, plex):
+        return self.get_data()['newest_cursor']
+
+library_database = LibraryDatabase(plex_database_file) if plex_database_file else None
+
+# Fetch engine running the onDeck, watchlist and watched phases of all the users at the same time
+# The blocking plexapi calls run in worker threads scheduled by asyncio, while fetch_session bounds the requests in flight,
+# so the whole fetching takes as long as the slowest user rather than the sum of the phases.
+# The onDeck and watchlist media of each user are handed to the cache pipeline, if given, as soon as they are fetched
+async def fetch_media(plex, fetch_watchlist, fetch_watched, watched_last_updated, history_cursor, cache_pipeline=None):
+    loop = asyncio.get_running_loop()
+    users = [None]  # Start with main user (None)
+    if users_toggle:
+        users += await loop.run_in_executor(None, account_cache.get_users, plex)
+    # Filter out the users present in skip_ondeck
+    ondeck_users = [user for user in users if (user is None) or (user.server_token not in skip_ondeck)]
+
+    # Workers mostly wait on the network, one per user and phase lets every phase of every user start right away
+    executor = ThreadPoolExecutor(max_workers=len(users) * 3 + 1)  # Plus one for the library locations
+
+    # Each call waits for the rate limiter here, so that no worker thread sits blocked on a throttled bucket
+    async def run(function, *args, bucket='server'):
+        if not bucket:
+            return await loop.run_in_executor(executor, function, *args)
+        await rate_limiter.acquire_async(bucket)
+        return await loop.run_in_executor(executor, rate_limiter.run_prepaid, bucket, function, *args)
 
-        logging.info(f"Fetching {current_username}'s watchlist media...")
+    # The onDeck and watched media are read from the Plex database when it is configured and readable
+    database = library_database if library_database and await run(library_database.is_available, bucket=None) else None
+
+    async def add_section_locations():
         try:
-            watchlist = get_watchlist(PLEX_TOKEN, user)
-            results = []
-
-            for item in watchlist:
-                file = search_plex(plex, item.title)
-                if file and (not filtered_sections or (file.librarySectionID in filtered_sections)):
-                    if file.TYPE == 'show':
-                        results.extend(process_show(file, watchlist_episodes))
-                    else:
-                        results.extend(process_movie(file))
-            return results
+            await run(run_metrics.measure('path_mapping')(path_mapper.add_section_locations), plex, valid_sections)
         except Exception as e:
-            logging.error(f"Error fetching watchlist for {current_username}: {str(e)}")
-            return []
+            logging.warning(f"Could not read the library locations, only the configured library folders are mapped: {e}")
 
-    users_to_fetch = [None]  # Start with main user (None)
-    if users_toggle:
-        users_to_fetch += plex.myPlexAccount().users()
+    section_locations = asyncio.ensure_future(add_section_locations())
 
-    with ThreadPoolExecutor(max_workers=10) as executor:
-        futures = {executor.submit(fetch_user_watchlist, user) for user in users_to_fetch}
-        for future in as_completed(futures):
-            retries = 0
-            while retries < RETRY_LIMIT:
-                try:
-                    yield from future.result()
-                    break
-                except Exception as e:
-                    if "429" in str(e):  # rate limit error
-                        logging.warning(f"Rate limit exceeded. Retrying in {DELAY} seconds...")
-                        time.sleep(DELAY)
-                        retries += 1
-                    else:
-                        logging.error(f"Error fetching watchlist media: {str(e)}")
-                        break
+    # The media fetched with a priority are streamed to the cache pipeline
+    async def run_for_users(phase, function, users, *args, priority=None):
+        function = run_metrics.measure(phase.lower())(function)
+
+        async def run_for_user(user):
+            files = await run(function, plex, *args, user)
+            if cache_pipeline and priority is not None:
+                await section_locations  # The paths can only be mapped once the library locations are known
+                cache_pipeline.submit(files, priority)
+            return files
 
-# Function to fetch watched media files
-def get_watched_media(plex, valid_sections, last_updated, users_toggle):
-    def fetch_user_watched_media(plex_instance, username, retries=0):
         try:
-            print(f"Fetching {username}'s watched media...")
-            logging.info(f"Fetching {username}'s watched media...")
-            # Get all sections available for the user
-            all_sections = [section.key for section in plex_instance.library.sections()]
-            # Check if valid_sections is specified. If not, consider all available sections as valid.
-            if 'valid_sections' in globals() and valid_sections:
-                available_sections = list(set(all_sections) & set(valid_sections))
-            else:
-                available_sections = all_sections
-            # Filter sections the user has access to
-            user_accessible_sections = [section for section in available_sections if section in all_sections]
-            for section_key in user_accessible_sections:
-                section = plex_instance.library.sectionByID(section_key)  # Get the section object using its key
-                # Search for videos in the section
-                for video in section.search(unwatched=False):
-                    # Skip if the video was last viewed before the last_updated timestamp
-                    if video.lastViewedAt and last_updated and video.lastViewedAt < datetime.fromtimestamp(last_updated):
-                        continue
-                    # Process the video and yield the file path
-                    yield from process_video(video)
-
-        except (BadRequest, NotFound) as e:
-            if "429" in str(e) and retries < RETRY_LIMIT:  # Rate limit exceeded
-                print(f"Rate limit exceeded. Retrying {retries + 1}/{RETRY_LIMIT}. Sleeping for {DELAY} seconds...")
-                logging.warning(f"Rate limit exceeded. Retrying {retries + 1}/{RETRY_LIMIT}. Sleeping for {DELAY} seconds...")
-                time.sleep(DELAY)
-                return fetch_user_watched_media(user_plex, username, retries + 1)
-            elif isinstance(e, NotFound):
-                print(f"Failed to switch to user {user.title if user else 'Unknown'}. Skipping...")
-                logging.warning(f"Failed to switch to user {user.title if user else 'Unknown'}. Skipping...")
-                return []
-            else:
-                raise e
+            results = await asyncio.gather(*(run_for_user(user) for user in users), return_exceptions=True)
+        finally:
+            if cache_pipeline and priority is not None:
+                cache_pipeline.finish(priority)
+        # The phase fails as a whole if the media of a user could not be fetched, as an incomplete list would drop
+        # that user's media from the state database
+        files = []
+        for user, result in zip(users, results):
+            if isinstance(result, Exception):
+                print(f"An error occurred while fetching {phase} media: {result}")
+                logging.error(f"An error occurred while fetching {phase} media for {user.title if user else 'the main user'}: {result}")
+                files = None
+            elif files is not None:
+                files.extend(result)
+        return files
+
+    async def fetch_watchlist_phase():
+        # Index the library once, it is then shared by all the users
+        await run(run_metrics.measure('watchlist')(guid_index.refresh), plex, valid_sections)
+        return await run_for_users('watchlist', fetch_user_watchlist, users, valid_sections, watchlist_episodes, skip_watchlist, priority=PRIORITY_WATCHLIST)
+
+    async def fetch_watched_phase():
+        if database:
+            # Reading all the watched media from the database is cheaper than reading the play history through the API
+            watched_files = await run_for_users('watched', database.fetch_user_watched_media, users, valid_sections, watched_last_updated)
+            return watched_files, await run(database.get_newest_history_cursor, plex)
+        # Only read the plays since the last run, unless a full resync was asked or there is no valid cursor
+        if not full_resync and history_cursor:
+            watched_files, new_history_cursor = await run(run_metrics.measure('watched')(fetch_watched_history), plex, valid_sections, history_cursor, users_toggle)
+            if watched_files is not None:
+                return watched_files, new_history_cursor
+            print("The play history cursor is no longer valid, doing a full resync...")
+            logging.warning("The play history cursor is no longer valid, doing a full resync...")
+        # Get the cursor first, so that plays happening during the full resync are fetched on the next run
+        new_history_cursor = await run(run_metrics.measure('watched')(get_newest_history_cursor), plex)
+        watched_files = await run_for_users('watched', fetch_user_watched_media, users, valid_sections, watched_last_updated)
+        return watched_files, new_history_cursor
+
+    async def nothing():
+        return None
 
-    def process_video(video):
-        if video.TYPE == 'show':
-            # Iterate through each episode of a show video
-            for episode in video.episodes():
-                yield from process_episode(episode)
-        else:
-            # Get the file path of the video
-            #if video.isPlayed:
-            file_path = video.media[0].parts[0].file
-            yield file_path
-
-    def process_episode(episode):
-        # Iterate through each media and part of an episode
-        for media in episode.media:
-            for part in media.parts:
-                if episode.isPlayed:
-                    # Get the file path of the played episode
-                    file_path = part.file
-                    yield file_path
-
-    # Create a ThreadPoolExecutor
-    with ThreadPoolExecutor() as executor:
-        main_username = plex.myPlexAccount().title
-        
-        # Start a new task for the main user
-        futures = [executor.submit(fetch_user_watched_media, plex, main_username)]
-        
-        if users_toggle:
-            for user in plex.myPlexAccount().users():
-                username = user.title
-                user_token = user.get_token(plex.machineIdentifier)
-                user_plex = PlexServer(PLEX_URL, user_token)
-
-                # Start a new task for each other user
-                futures.append(executor.submit(fetch_user_watched_media, user_plex, username))
-        
-        # As each task completes, yield the results
-        for future in as_completed(futures):
-            try:
-                yield from future.result()
-            except Exception as e:
-                print(f"An error occurred in get_watched_media: {e}")
-                logging.error(f"An error occurred in get_watched_media: {e}")
+    try:
+        ondeck_files, watchlist_files, watched, _ = await asyncio.gather(
+            run_for_users('onDeck', database.fetch_on_deck_media if database else fetch_on_deck_media, ondeck_users, valid_sections, days_to_monitor, number_episodes, priority=PRIORITY_ONDECK),
+            fetch_watchlist_phase() if fetch_watchlist else nothing(),
+            fetch_watched_phase() if fetch_watched else nothing(),
+            section_locations,
+            return_exceptions=True
+        )
+    finally:
+        executor.shutdown(wait=False)
+    # A failed phase returns None, its media are then loaded from the state database instead
+    if isinstance(ondeck_files, Exception):
+        logging.error(f"An error occurred while fetching onDeck media: {ondeck_files}")
+        ondeck_files = None
+    if isinstance(watchlist_files, Exception):
+        logging.error(f"An error occurred while fetching watchlist media: {watchlist_files}")
+        watchlist_files = None
+    if isinstance(watched, Exception):
+        logging.error(f"An error occurred while fetching watched media: {watched}")
+        watched = None
+    watched_files, history_cursor = watched if watched else (None, history_cursor)
+    return ondeck_files, watchlist_files, watched_files, history_cursor
 
 # Function to load watched media from cache
 def load_media_from_cache(cache_file):
@@ -830,8 +2063,207 @@ def load_media_from_cache(cache_file):
                 return set(), None
     return set(), None
 
+# SQLite state database, replacing the JSON watchlist and watched cache files
+# It tracks where each media comes from (ondeck, watchlist, watched), the users referencing it, when it was first and last seen
+# and where it currently is, so that each run only writes what changed.
+class StateStore:
+    SCHEMA = """
+        CREATE TABLE IF NOT EXISTS media (
+            path TEXT PRIMARY KEY,
+            location TEXT,
+            first_seen REAL NOT NULL,
+            last_seen REAL NOT NULL
+        );
+        CREATE INDEX IF NOT EXISTS media_location ON media (location);
+        CREATE TABLE IF NOT EXISTS media_origins (
+            origin TEXT NOT NULL,
+            path TEXT NOT NULL,
+            first_seen REAL NOT NULL,
+            last_seen REAL NOT NULL,
+            PRIMARY KEY (origin, path)
+        );
+        CREATE INDEX IF NOT EXISTS media_origins_last_seen ON media_origins (origin, last_seen);
+        CREATE TABLE IF NOT EXISTS media_users (
+            origin TEXT NOT NULL,
+            path TEXT NOT NULL,
+            username TEXT NOT NULL,
+            last_seen REAL NOT NULL,
+            PRIMARY KEY (origin, path, username)
+        );
+        CREATE TABLE IF NOT EXISTS state (
+            key TEXT PRIMARY KEY,
+            value TEXT NOT NULL
+        );
+    """
+
+    def __init__(self, db_file):
+        self._lock = threading.Lock()
+        self.connection = sqlite3.connect(db_file, check_same_thread=False)
+        self.connection.execute("PRAGMA journal_mode=WAL")
+        self.connection.execute("PRAGMA synchronous=NORMAL")
+        self.connection.executescript(self.SCHEMA)
+
+    def get_state(self, key, default=None):
+        row = self.connection.execute("SELECT value FROM state WHERE key = ?", (key,)).fetchone()
+        return json.loads(row[0]) if row else default
+
+    def set_state(self, key, value):
+        with self._lock, self.connection:
+            self.connection.execute("INSERT INTO state (key, value) VALUES (?, ?) ON CONFLICT (key) DO UPDATE SET value = excluded.value", (key, json.dumps(value)))
+
+    # Returns all the media known to be in the given location, whatever their origin
+    def get_media_in(self, location):
+        return {row[0] for row in self.connection.execute("SELECT path FROM media WHERE location = ?", (location,))}
+
+    # Returns the media of the given origin, optionally only the ones known to be in the given location
+    def get_media(self, origin, location=None):
+        if location:
+            # CROSS JOIN makes SQLite start from the location index, so the cost follows the media in that location
+            query = "SELECT m.path FROM media m CROSS JOIN media_origins o ON o.path = m.path AND o.origin = ? WHERE m.location = ?"
+            return {row[0] for row in self.connection.execute(query, (origin, location))}
+        query = "SELECT o.path FROM media_origins o JOIN media m ON m.path = o.path WHERE o.origin = ?"
+        return {row[0] for row in self.connection.execute(query, (origin,))}
+
+    # Adds the given media to an origin in a single transaction and returns the ones that were not there yet
+    # With replace=True, the media of that origin which were not in the given files are removed from it
+    def update_media(self, origin, files, users=None, replace=False, seen_at=None):
+        seen_at = seen_at or time.time()
+        users = users or {}
+        new_files = []
+        with self._lock, self.connection:
+            for file in dict.fromkeys(files):
+                self.connection.execute("INSERT INTO media (path, first_seen, last_seen) VALUES (?, ?, ?) ON CONFLICT (path) DO UPDATE SET last_seen = excluded.last_seen", (file, seen_at, seen_at))
+                cursor = self.connection.execute("INSERT OR IGNORE INTO media_origins (origin, path, first_seen, last_seen) VALUES (?, ?, ?, ?)", (origin, file, seen_at, seen_at))
+                if cursor.rowcount:
+                    new_files.append(file)
+                else:
+                    self.connection.execute("UPDATE media_origins SET last_seen = ? WHERE origin = ? AND path = ?", (seen_at, origin, file))
+                self.connection.executemany("INSERT INTO media_users (origin, path, username, last_seen) VALUES (?, ?, ?, ?) ON CONFLICT (origin, path, username) DO UPDATE SET last_seen = excluded.last_seen", ((origin, file, username, seen_at) for username in users.get(file, ())))
+            if replace:
+                self.connection.execute("DELETE FROM media_users WHERE origin = ? AND last_seen < ?", (origin, seen_at))
+                self.connection.execute("DELETE FROM media_origins WHERE origin = ? AND last_seen < ?", (origin, seen_at))
+            self.connection.execute("INSERT INTO state (key, value) VALUES (?, ?) ON CONFLICT (key) DO UPDATE SET value = excluded.value", (f"{origin}_updated", json.dumps(seen_at)))
+        return new_files
+
+    # Returns the media that may be on the cache, with when they were last referenced (onDeck, watchlist) and last watched
+    def get_cache_candidates(self):
+        query = """
+            SELECT m.path,
+                   MAX(CASE WHEN o.origin IN ('ondeck', 'watchlist') THEN o.last_seen END),
+                   MAX(CASE WHEN o.origin = 'watched' THEN o.last_seen END),
+                   m.first_seen
+            FROM media m JOIN media_origins o ON o.path = m.path
+            GROUP BY m.path
+            HAVING m.location = 'cache' OR (m.location IS NULL AND SUM(o.origin IN ('ondeck', 'watchlist')) > 0)
+        """
+        return self.connection.execute(query).fetchall()
+
+    # Records where the given media are now, e.g. after being moved
+    def set_location(self, files, location):
+        with self._lock, self.connection:
+            self.connection.executemany("UPDATE media SET location = ? WHERE path = ?", ((location, file) for file in files))
+
+    # Imports an old JSON cache file, which is then renamed so it only gets imported once
+    def migrate_json_cache(self, cache_file, origin):
+        if not cache_file.exists():
+            return
+        media, timestamp = load_media_from_cache(cache_file)
+        self.update_media(origin, media, seen_at=timestamp)
+        with cache_file.open('r') as f:
+            try:
+                history_cursor = json.load(f).get('history_cursor')
+                if history_cursor:
+                    self.set_state('history_cursor', history_cursor)
+            except (json.JSONDecodeError, AttributeError):
+                pass
+        os.replace(cache_file, cache_file.with_name(cache_file.name + '.migrated'))
+        logging.info(f"Migrated {len(media)} media from {cache_file} to the state database.")
+
+    def close(self):
+        self.connection.close()
+
+state_store = None  # Opened by the full runs only, a --sessions-only run doesn't touch the state database
+
+# Compiled table mapping the Plex paths to the paths of the actual files on the running system
+# Each Plex library folder (plex_source + folder) maps to its NAS folder (real_source + nas_folder), the locations of
+# the library sections are added once known, and a path is mapped by its longest matching prefix.
+# Directories are mapped only once, the files of a directory then only cost a dictionary lookup.
+class PathMapper:
+    def __init__(self, plex_source, real_source, plex_library_folders, nas_library_folders):
+        self.plex_source = plex_source
+        self.real_source = real_source
+        self.folders = dict(zip(plex_library_folders, nas_library_folders))
+        self.real_separator = self.get_separator(real_source)
+        self._prefixes = {plex_source.rstrip('/\\'): real_source.rstrip('/\\')}  # Plex prefix -> real prefix
+        # Each side uses its own separator, e.g. a Windows Plex server with a Linux real_source
+        self.plex_separator = self.get_separator(plex_source)
+        for folder, nas_folder in self.folders.items():
+            self._prefixes[plex_source.rstrip('/\\') + self.plex_separator + folder] = real_source.rstrip('/\\') + self.real_separator + nas_folder
+        self._directories = {}  # Plex directory -> real directory
+        self._lock = threading.Lock()
+
+    # Adds the locations of the library sections, so that libraries not directly under plex_source map too
+    def add_section_locations(self, plex, valid_sections):
+        prefixes = {}
+        for section in plex.library.sections():
+            if valid_sections and section.key not in valid_sections:
+                continue
+            for location in section.locations:
+                location = location.rstrip('/\\')
+                if not location.startswith(self.plex_source.rstrip('/\\')) or location in self._prefixes:
+                    continue
+                cut = max(location.rfind('/'), location.rfind('\\'))
+                parent, folder = location[:cut], location[cut + 1:]
+                if folder in self.folders:
+                    prefixes[location] = self.map_directory(parent) + self.real_separator + self.folders[folder]
+        with self._lock:
+            self._prefixes.update(prefixes)
+            self._directories.clear()
+        logging.info(f"Mapping {len(self._prefixes)} library folders.")
+
+    # Returns the separator a path uses, "\\" for a Windows path and "/" otherwise
+    @staticmethod
+    def get_separator(path):
+        return '\\' if path.count('\\') > path.count('/') else '/'
+
+    def to_real_separator(self, path):
+        return path.replace(self.plex_separator, self.real_separator) if self.plex_separator != self.real_separator else path
+
+    # Maps a directory with the longest prefix of the table it starts with
+    def map_directory(self, directory):
+        real_directory = self._directories.get(directory)
+        if real_directory is None:
+            prefix = directory
+            while prefix not in self._prefixes:
+                if not prefix:
+                    return directory  # Not under plex_source, left as is
+                prefix = prefix[:max(prefix.rfind('/'), prefix.rfind('\\'), 0)]
+            real_directory = self._prefixes[prefix] + self.to_real_separator(directory[len(prefix):])
+            with self._lock:
+                self._directories[directory] = real_directory
+        return real_directory
+
+    def map_path(self, file_path):
+        cut = max(file_path.rfind('/'), file_path.rfind('\\'))
+        if cut < 0:
+            return file_path
+        return self.map_directory(file_path[:cut]) + self.to_real_separator(file_path[cut:])
+
+    # Maps a batch of paths, dropping the ones not under plex_source
+    def map_paths(self, files):
+        plex_source = self.plex_source
+        map_path = self.map_path
+        return {file_path: map_path(file_path) for file_path in files if file_path.startswith(plex_source)}
+
+path_mapper = PathMapper(plex_source, real_source, plex_library_folders, nas_library_folders)
+
+# Modify a file path given by plex to link the actual file on the running system
+def edit_file_path(file_path):
+    return path_mapper.map_path(file_path)
+
 # Modify the files paths from the paths given by plex to link actual files on the running system
-def modify_file_paths(files, plex_source, real_source, plex_library_folders, nas_library_folders):
+@run_metrics.measure('path_mapping')
+def modify_file_paths(files):
     # Print and log a message indicating that file paths are being edited
     print("Editing file paths...")
     logging.info("Editing file paths...")
@@ -840,72 +2272,173 @@ def modify_file_paths(files, plex_source, real_source, plex_library_folders, nas
     if files is None:
         return []
 
-    # Filter the files based on those that start with the plex_source path
-    files = [file_path for file_path in files if file_path.startswith(plex_source)]
-
-    # Iterate over each file path and modify it accordingly
-    for i, file_path in enumerate(files):
-        # Log the original file path
-        logging.info(f"Original path: {file_path}")
-
-        # Replace the plex_source with the real_source in the file path
-        file_path = file_path.replace(plex_source, real_source, 1) # Replace the plex_source with the real_source, thanks to /u/planesrfun
-
-        # Determine which library folder is in the file path
-        for j, folder in enumerate(plex_library_folders):
-            if folder in file_path:
-                # Replace the plex library folder with the corresponding NAS library folder
-                file_path = file_path.replace(folder, nas_library_folders[j])
-                break
-
-        # Update the modified file path in the files list
-        files[i] = file_path
-
-        # Log the edited file path
-        logging.info(f"Edited path: {file_path}")
-
-    # Return the modified file paths or an empty list
-    return files or []
-
-def get_media_subtitles(media_files, files_to_skip=None, subtitle_extensions=[".srt", ".vtt", ".sbv", ".sub", ".idx"]):
-    print("Fetching subtitles...") 
-    logging.info("Fetching subtitles...")
+    # Only the files under the plex_source path are kept
+    mapped_paths = path_mapper.map_paths(files)
+    with path_maps_lock:
+        edited_file_paths.update(mapped_paths)
+    if logging.getLogger().isEnabledFor(logging.DEBUG):
+        for original_file_path, file_path in mapped_paths.items():
+            logging.debug(f"Edited path: {original_file_path} -> {file_path}")
+    logging.info(f"Edited {len(mapped_paths)} file paths.")
+
+    # Return the modified file paths, in the same order, or an empty list
+    return [mapped_paths[file_path] for file_path in files if file_path in mapped_paths] or []
+
+@run_metrics.measure('sidecars')
+@profiler.trace()
+def get_media_sidecars(media_files, files_to_skip=None, extensions=None):
+    print("Fetching sidecar files...") 
+    logging.info("Fetching sidecar files...")
     
+    if extensions is None:
+        extensions = sidecar_extensions
+    extensions = tuple(extension.lower() for extension in extensions)
     files_to_skip = set() if files_to_skip is None else set(files_to_skip)
-    processed_files = set()
     all_media_files = media_files.copy()
     
+    # Group the media by directory, so that each directory is listed only once
+    media_by_directory = {}
     for file in media_files:
-        if file in files_to_skip or file in processed_files:
+        if file in files_to_skip:
             continue
-        processed_files.add(file)
-        
-        directory_path = os.path.dirname(file)
-        if os.path.exists(directory_path): 
-            subtitle_files = find_subtitle_files(directory_path, file, subtitle_extensions)  
-            all_media_files.extend(subtitle_files)  
-            for subtitle_file in subtitle_files:  
-                logging.info(f"Subtitle found: {subtitle_file}")  
+        directory_path, file_name = os.path.split(file)
+        media_by_directory.setdefault(directory_path, {})[os.path.splitext(file_name)[0]] = file
+
+    listings = file_snapshot.list_directories(media_by_directory)
+    for directory_path, media_by_stem in media_by_directory.items():
+        listing = listings.get(directory_path)
+        if listing is None:
+            continue
+        media_names = {os.path.basename(file) for file in media_by_stem.values()}
+        for entry_name in sorted(listing):
+            if entry_name in media_names or not entry_name.lower().endswith(extensions):
+                continue
+            file = find_sidecar_media(entry_name, media_by_stem)
+            if file is None:
+                continue
+            sidecar_file = os.path.join(directory_path, entry_name)
+            all_media_files.append(sidecar_file)
+            with path_maps_lock:
+                sidecar_media[sidecar_file] = file
+            logging.info(f"Sidecar found: {sidecar_file}")
     
     return all_media_files or []
 
-def find_subtitle_files(directory_path, file, subtitle_extensions):
-    file_name, _ = os.path.splitext(os.path.basename(file))
+# Function to find the media a sidecar file belongs to: like before, any file whose name starts with the name of the media
+# (e.g. "Movie.en.srt", "Movie_en.srt" or "Movie-poster.jpg" for "Movie.mkv"), the longest media name winning when several match
+def find_sidecar_media(sidecar_name, media_by_stem):
+    stem = max((stem for stem in media_by_stem if sidecar_name.startswith(stem)), key=len, default=None)
+    return media_by_stem[stem] if stem is not None else None
 
-    try:
-        subtitle_files = [
-            entry.path
-            for entry in os.scandir(directory_path)
-            if entry.is_file() and entry.name.startswith(file_name) and entry.name != file and entry.name.endswith(tuple(subtitle_extensions))
-        ]
-    except PermissionError as e:
-        logging.error(f"Cannot access directory {directory_path}. Permission denied. Error: {e}")
-        subtitle_files = []
-    except OSError as e:
-        logging.error(f"Cannot access directory {directory_path}. Error: {e}")
-        subtitle_files = []
-
-    return subtitle_files or []
+# Snapshot of the files metadata shared by the filtering, sizing and move planning
+# Each directory is listed once with os.scandir, in parallel, and only the files of interest are stat'ed,
+# so every path is stat'ed at most once (through the slow Unraid FUSE for /mnt/user) until it gets invalidated.
+class FileSnapshot:
+    def __init__(self):
+        self._stats = {}  # Path -> os.stat_result, or None if the file doesn't exist
+        self._listings = {}  # Directory -> names of its entries, or None if the directory doesn't exist
+        self._lock = threading.Lock()
+
+    # Lists the directories of the given paths in parallel and stats the given paths
+    def prefetch(self, paths):
+        paths_by_directory = {}
+        for path in paths:
+            directory, name = os.path.split(path)
+            paths_by_directory.setdefault(directory, set()).add(name)
+        self._scan_directories(paths_by_directory)
+
+    # Returns the names of the entries of the given directories (None for the missing ones), listing them in parallel if needed
+    def list_directories(self, directories):
+        self._scan_directories({directory: set() for directory in directories})
+        with self._lock:
+            return {directory: self._listings.get(directory) for directory in directories}
+
+    def _scan_directories(self, paths_by_directory):
+        with self._lock:
+            # Skip what is already known: the directories already listed, unless some of the paths still have to be stat'ed
+            paths_by_directory = {
+                directory: {name for name in names if os.path.join(directory, name) not in self._stats}
+                for directory, names in paths_by_directory.items()
+            }
+            paths_by_directory = {directory: names for directory, names in paths_by_directory.items() if names or directory not in self._listings}
+        if paths_by_directory:
+            with ThreadPoolExecutor(max_workers=SNAPSHOT_WORKERS) as executor:
+                list(executor.map(lambda item: self._scan(*item), paths_by_directory.items()))
+
+    @profiler.trace('scan_directory')
+    def _scan(self, directory, names):
+        stats = {}
+        with self._lock:
+            listing = self._listings.get(directory, False)
+        if listing is not False:
+            # Already listed, only stat the paths
+            for name in names:
+                self.stat(os.path.join(directory, name))
+            return
+        try:
+            listing = set()
+            with os.scandir(directory) as entries:
+                for entry in entries:
+                    listing.add(entry.name)
+                    if entry.name in names:
+                        try:
+                            stats[entry.path] = entry.stat()
+                        except OSError:
+                            stats[entry.path] = None
+        except OSError:
+            listing = None  # The directory doesn't exist or can't be read
+        with self._lock:
+            self._listings[directory] = listing
+            self._stats.update(stats)
+            for name in names:
+                self._stats.setdefault(os.path.join(directory, name), None)
+
+    def stat(self, path):
+        with self._lock:
+            if path in self._stats:
+                return self._stats[path]
+            listing = self._listings.get(os.path.dirname(path), False)
+        if listing is None or (listing is not False and os.path.basename(path) not in listing):
+            result = None  # Not in the directory listing
+        else:
+            try:
+                result = os.stat(path)
+            except OSError:
+                result = None
+        with self._lock:
+            self._stats[path] = result
+        return result
+
+    def isfile(self, path):
+        stat_info = self.stat(path)
+        return stat_info is not None and stat.S_ISREG(stat_info.st_mode)
+
+    def getsize(self, path):
+        stat_info = self.stat(path)
+        return stat_info.st_size if stat_info else 0
+
+    def isdir(self, path):
+        path = path.rstrip('/\\') or path
+        with self._lock:
+            if path in self._listings:
+                return self._listings[path] is not None
+        return os.path.isdir(path)
+
+    # Forgets everything, e.g. when files may have been changed by something else since the snapshot was taken
+    def clear(self):
+        with self._lock:
+            self._stats.clear()
+            self._listings.clear()
+
+    # Forgets what is known about the given paths, e.g. after they were moved, created or removed
+    def invalidate(self, *paths):
+        with self._lock:
+            for path in paths:
+                self._stats.pop(path, None)
+                self._listings.pop(path.rstrip('/\\') or path, None)
+                self._listings.pop(os.path.dirname(path), None)
+
+file_snapshot = FileSnapshot()
 
 # Function to convert size to readable format
 def convert_bytes_to_readable_size(size_bytes):
@@ -936,16 +2469,17 @@ def get_free_space(dir):
 
 # Function to calculate size of the files contained in the given array
 def get_total_size_of_files(files):
-    total_size_bytes = sum(os.path.getsize(file) for file in files)  # Calculate the total size of the files in bytes
+    total_size_bytes = sum(file_snapshot.getsize(file) for file in files)  # Calculate the total size of the files in bytes
     return convert_bytes_to_readable_size(total_size_bytes)  # Convert the total size to a human-readable format
 
 # Function to filter the files, based on the destination
+@run_metrics.measure('filtering')
+@profiler.trace()
 def filter_files(files, destination, real_source, cache_dir, media_to_cache=None, files_to_skip=None):
     logging.info(f"Filtering media files for {destination}...")
 
     if files_to_skip:
-        # Assuming you have a function modify_file_paths() that returns modified file paths.
-        files_to_skip = modify_file_paths(files_to_skip, plex_source, real_source, plex_library_folders, nas_library_folders)
+        files_to_skip = modify_file_paths(files_to_skip)
 
     try:
         if media_to_cache is None:
@@ -954,11 +2488,9 @@ def filter_files(files, destination, real_source, cache_dir, media_to_cache=None
         processed_files = set()
         media_to = []
         cache_files_to_exclude = []
+        array_files = []  # Media found back on the array, e.g. moved by the Unraid mover
 
-        if not files:
-            return []
-
-        for file in files:
+        for file in files or []:
             if file in processed_files or (files_to_skip and file in files_to_skip):
                 continue
             processed_files.add(file)
@@ -971,16 +2503,20 @@ def filter_files(files, destination, real_source, cache_dir, media_to_cache=None
                 if should_add_to_array(file, cache_file_name, media_to_cache):
                     media_to.append(file)
                     logging.info(f"Adding file to array: {file}")
+                elif file not in media_to_cache and not file_snapshot.isfile(cache_file_name):
+                    array_files.append(file)
 
             elif destination == 'cache':
                 if should_add_to_cache(file, cache_file_name):
                     media_to.append(file)
                     logging.info(f"Adding file to cache: {file}")
 
-        if unraid:
-            with open(mover_cache_exclude_file, "w") as file:
-                for item in cache_files_to_exclude:
-                    file.write(str(item) + "\n")
+        if array_files and state_store:
+            # No need to check them again on the next runs
+            state_store.set_location(array_files, 'array')
+
+        if unraid and destination == 'cache':
+            write_mover_exclude_file(cache_files_to_exclude)
 
         return media_to or []
 
@@ -988,36 +2524,189 @@ def filter_files(files, destination, real_source, cache_dir, media_to_cache=None
         logging.error(f"Error occurred while filtering media files: {str(e)}")
         return []
 
+# Function to rebuild the mover exclusion file with every file kept on the cache: the media the state database knows
+# are there and the ones filtered for the cache by this process. Runs caching only a few files, like --sessions-only
+# or the daemon events, then keep the files cached by the previous runs excluded from the mover too.
+def write_mover_exclude_file(cache_files):
+    mover_excluded_files.update(cache_files)
+    excluded_files = set(mover_excluded_files)
+    if state_store:
+        excluded_files.update(get_cache_paths(file, real_source, cache_dir)[1] for file in state_store.get_media_in('cache'))
+    elif os.path.exists(mover_cache_exclude_file):
+        # Without the state database, the files excluded by the last full run are read back from the file itself
+        with open(mover_cache_exclude_file) as file:
+            excluded_files.update(line.rstrip("\n") for line in file if line.strip())
+    with open(mover_cache_exclude_file, "w") as file:
+        for item in sorted(excluded_files):
+            file.write(str(item) + "\n")
+
 def should_add_to_array(file, cache_file_name, media_to_cache):
     if file in media_to_cache:
         return False
 
-    array_file = file.replace("/mnt/user/", "/mnt/user0/", 1) if unraid else file
+    array_file = get_array_file(file)
 
-    if os.path.isfile(array_file):
+    if file_snapshot.isfile(array_file):
         # File already exists in the array
-        if os.path.isfile(cache_file_name):
+        if file_snapshot.isfile(cache_file_name):
             os.remove(cache_file_name)
+            file_snapshot.invalidate(cache_file_name)
             logging.info(f"Removed cache version of file: {cache_file_name}")
         return False  # No need to add to array
     return True  # Otherwise, the file should be added to the array
 
 # Revised function
 def should_add_to_cache(file, cache_file_name):
-    array_file = file.replace("/mnt/user/", "/mnt/user0/", 1) if unraid else file
+    array_file = get_array_file(file)
 
-    if os.path.isfile(cache_file_name) and os.path.isfile(array_file):
+    if file_snapshot.isfile(cache_file_name) and file_snapshot.isfile(array_file):
         # Uncomment the following line if you want to remove the array version when the file exists in the cache
         os.remove(array_file)
+        file_snapshot.invalidate(array_file)
         logging.info(f"Removed array version of file: {array_file}")
         return False
-    return not os.path.isfile(cache_file_name)
-
+    return not file_snapshot.isfile(cache_file_name)
+
+
+# Function to get how many bytes can still be cached, up to the high water mark and keeping the space reserve free
+def get_cache_budget(cache_dir):
+    total, used, free = shutil.disk_usage(cache_dir)
+    return min(int(total * cache_high_water_mark / 100) - used, free) - cache_space_reserve * (1024 ** 3)
+
+# Function to choose the files to cache within the space available, the ones expected to be watched the soonest first:
+# the onDeck media and their next episode, then the later episodes, then the watchlist.
+# Sidecar files are kept together with their media. Returns the files to move and the deferred ones.
+# The budget defaults to the space the cache has left.
+# The maps are read under their locks, as the fetch workers keep filling them while the cache pipeline plans its moves.
+def plan_cache_moves(files, cache_dir, budget=None):
+    with path_maps_lock:
+        edited_paths = dict(edited_file_paths)
+        media_files = {file: sidecar_media.get(file, file) for file in files}
+    with media_priorities_lock:
+        priorities = {edited_paths[file]: priority for file, priority in media_priorities.items() if file in edited_paths}
+    groups = {}  # Media file -> the media and its sidecar files
+    for file in files:
+        groups.setdefault(media_files[file], []).append(file)
+    ranked_groups = sorted(groups.items(), key=lambda group: (priorities.get(group[0], (PRIORITY_UNKNOWN, 0)), group[0]))
+
+    if budget is None:
+        budget = get_cache_budget(cache_dir)
+    planned_files = []
+    deferred_files = []
+    for media_file, group in ranked_groups:
+        group_size = sum(file_snapshot.getsize(file) for file in group)
+        if group_size <= budget:
+            planned_files.extend(group)
+            budget -= group_size
+        else:
+            deferred_files.extend(group)
+    return planned_files, deferred_files
+
+# Live ledger of the cache space, checked before each move starts so that parallel moves never
+# go past the budget, even when something else writes to the cache drive in the meantime.
+class SpaceLedger:
+    def __init__(self, path, budget):
+        self.path = path
+        self.budget = budget
+        self._lock = threading.Lock()
+
+    # Books the space for a file, returns False if it doesn't fit anymore
+    def reserve(self, size):
+        with self._lock:
+            free = shutil.disk_usage(self.path).free - cache_space_reserve * (1024 ** 3)
+            if size > self.budget or size > free:
+                return False
+            self.budget -= size
+            return True
+
+    # Gives back the space booked for a file that wasn't moved
+    def release(self, size):
+        with self._lock:
+            self.budget += size
+
+# Function to score the cached media for eviction, the higher the score the sooner it is moved back to the array
+# A media scores its hours since it was last referenced or played times its size in GB, so large media idle
+# for long go first, and the score doubles if it was played after it was last onDeck or on a watchlist.
+def score_cached_media(last_referenced, last_played, first_seen, size, now):
+    last_used = max(last_referenced or first_seen, last_played or 0)
+    idle_hours = max(now - last_used, 0) / 3600
+    score = idle_hours * size / (1024 ** 3)
+    if last_played and (last_referenced is None or last_played > last_referenced):
+        score *= 2
+    return score, idle_hours
+
+# Function to move cached media back to the array when the cache drive is above the high water mark,
+# the least valuable first, until it is below the low water mark. Media still wanted or being played are kept.
+@run_metrics.measure('eviction')
+def evict_cached_media(files_to_keep, real_source, cache_dir, unraid, debug):
+    global files_moved
+    total, used, free = shutil.disk_usage(cache_dir)
+    if used * 100 / total < eviction_high_water_mark:
+        return
+    to_free = used - int(total * eviction_low_water_mark / 100)
+    print(f"The cache is {used * 100 / total:.0f}% full, evicting media down to {eviction_low_water_mark}%...")
+    logging.info(f"The cache is {used * 100 / total:.0f}% full, evicting media down to {eviction_low_water_mark}%...")
+
+    files_to_keep = set(files_to_keep)
+    now = time.time()
+    candidates = []
+    cached_media = [(row, get_cache_paths(row[0], real_source, cache_dir)[1]) for row in state_store.get_cache_candidates()]
+    file_snapshot.prefetch(cache_file_name for row, cache_file_name in cached_media)
+    for (file, last_referenced, last_played, first_seen), cache_file_name in cached_media:
+        if file in files_to_keep or not file_snapshot.isfile(cache_file_name):
+            continue
+        size = file_snapshot.getsize(cache_file_name)
+        score, idle_hours = score_cached_media(last_referenced, last_played, first_seen, size, now)
+        candidates.append((score, file, size, idle_hours, last_played is not None))
+    candidates.sort(reverse=True)
+
+    evicted_files = []
+    freed = 0
+    for score, file, size, idle_hours, played in candidates:
+        if freed >= to_free:
+            break
+        evicted_files.append(file)
+        freed += size
+        logging.info(f"Evicting (score {score:.1f}, unused for {idle_hours:.0f} hours, {size / (1024 ** 3):.2f} GB{', watched' if played else ''}): {file}")
+
+    freed_size, freed_unit = convert_bytes_to_readable_size(freed)
+    if freed < to_free:
+        logging.warning(f"Only {freed_size:.2f} {freed_unit} of cached media can be evicted, the cache stays above {eviction_low_water_mark}%.")
+    if eviction_dry_run:
+        print(f"Eviction dry run: {len(evicted_files)} files ({freed_size:.2f} {freed_unit}) would be moved back to the array.")
+        logging.info(f"Eviction dry run: {len(evicted_files)} files ({freed_size:.2f} {freed_unit}) would be moved back to the array.")
+        return
+    if evicted_files:
+        summary_messages.append(f"Evicted {len(evicted_files)} files ({freed_size:.2f} {freed_unit}) from the cache.")
+        files_moved = True
+        # Sidecar files follow their media
+        evicted_files = get_media_sidecars(evicted_files)
+        move_media_files(evicted_files, real_source, cache_dir, unraid, debug, 'array', max_concurrent_moves_array, max_concurrent_moves_cache)
 
 # Check for free space before executing moving process
 def check_free_space_and_move_files(media_files, destination, real_source, cache_dir, unraid, debug):
     global files_moved, summary_messages
+    # Take the metadata of the media, their cache copy and their array copy in one pass
+    snapshot_paths = []
+    for file in media_files:
+        snapshot_paths += [file, get_cache_paths(file, real_source, cache_dir)[1]]
+        if unraid:
+            snapshot_paths.append(get_array_file(file))
+    file_snapshot.prefetch(snapshot_paths)
     media_files_filtered = filter_files(media_files, destination, real_source, cache_dir, media_to_cache, files_to_skip)  # Filter the media files based on certain criteria
+    space_ledger = None
+    deferred_message = None
+    if destination == 'cache':
+        # Only cache what fits, the rest is deferred to a later run
+        media_files_filtered, deferred_files = plan_cache_moves(media_files_filtered, cache_dir)
+        if deferred_files:
+            deferred_size, deferred_size_unit = get_total_size_of_files(deferred_files)
+            print(f"Not enough space on the cache for {len(deferred_files)} files ({deferred_size:.2f} {deferred_size_unit}), deferring them.")
+            logging.warning(f"Not enough space on the cache for {len(deferred_files)} files ({deferred_size:.2f} {deferred_size_unit}), deferring them.")
+            for file in deferred_files:
+                logging.info(f"Deferred: {file}")
+            deferred_message = f"{len(deferred_files)} files ({deferred_size:.2f} {deferred_size_unit}) were deferred, the cache is full."
+        space_ledger = SpaceLedger(cache_dir, get_cache_budget(cache_dir))
     total_size, total_size_unit = get_total_size_of_files(media_files_filtered)  # Get the total size of the filtered media files
     if total_size > 0:  # If there are media files to be moved
         logging.info(f"Total size of media files to be moved to {destination}: {total_size:.2f} {total_size_unit}")  # Log the total size of media files
@@ -1030,7 +2719,7 @@ def check_free_space_and_move_files(media_files, destination, real_source, cache
         free_space, free_space_unit = get_free_space(destination == 'cache' and cache_dir or real_source)  # Get the free space on the destination drive
         print(f"Free space on the {destination}: {free_space:.2f} {free_space_unit}")  # Print the free space on the destination drive
         logging.info(f"Free space on the {destination}: {free_space:.2f} {free_space_unit}")  # Log the free space on the destination drive
-        if total_size * (1024 ** {'KB': 0, 'MB': 1, 'GB': 2, 'TB': 3}[total_size_unit]) > free_space * (1024 ** {'KB': 0, 'MB': 1, 'GB': 2, 'TB': 3}[free_space_unit]):
+        if destination == 'array' and total_size * (1024 ** {'KB': 0, 'MB': 1, 'GB': 2, 'TB': 3}[total_size_unit]) > free_space * (1024 ** {'KB': 0, 'MB': 1, 'GB': 2, 'TB': 3}[free_space_unit]):
             # If the total size of media files is greater than the free space on the destination drive
             if not debug:
                 exit(f"Not enough space on {destination} drive.")
@@ -1040,7 +2729,7 @@ def check_free_space_and_move_files(media_files, destination, real_source, cache
                 logging.error(f"Not enough space on {destination} drive..")
         logging.info(f"Moving media to {destination}...")  # Log the start of the media moving process
         print(f"Moving media to {destination}...")  # Print the start of the media moving process
-        move_media_files(media_files_filtered, real_source, cache_dir, unraid, debug, destination, max_concurrent_moves_array, max_concurrent_moves_cache)  # Move the media files to the destination
+        move_media_files(media_files_filtered, real_source, cache_dir, unraid, debug, destination, max_concurrent_moves_array, max_concurrent_moves_cache, space_ledger)  # Move the media files to the destination
     else:
         print(f"Nothing to move to {destination}")  # If there are no media files to move, print a message
         logging.info(f"Nothing to move to {destination}")  # If there are no media files to move, log a message
@@ -1048,6 +2737,85 @@ def check_free_space_and_move_files(media_files, destination, real_source, cache
             summary_messages = ["There were no files to move to any destination."]
         else:
             summary_messages.append("")
+    if deferred_message:
+        summary_messages.append(deferred_message)
+
+# Moves the media to the cache while the rest is still being fetched: the media of each user go through the path mapping,
+# sidecar discovery, filtering and space planning as soon as they are fetched, and are moved right away, one batch at a time.
+# A priority is only moved once the higher ones are all fetched (finish()), so that the watchlist never takes the room of
+# an onDeck media. What doesn't fit or fails is left to the cache pass following the fetch, which also evicts first.
+class CachePipeline:
+    def __init__(self, real_source, cache_dir, priorities):
+        self.real_source = real_source
+        self.cache_dir = cache_dir
+        self.moved_files = []
+        self.moved_size = 0
+        self._fetching = set(priorities)  # Priorities still being fetched
+        self._held = []  # (files, priority) waiting for a higher priority to be fetched
+        self._seen = set()  # Media (and sidecars) already handled
+        self.space_ledger = SpaceLedger(cache_dir, get_cache_budget(cache_dir))  # Shared by the batches, so that they add up
+        self._queue = queue.Queue()
+        self._thread = threading.Thread(target=self._run, name='CachePipeline', daemon=True)
+        self._thread.start()
+
+    # Queues media fetched with the given priority (PRIORITY_ONDECK, PRIORITY_WATCHLIST), as Plex paths
+    def submit(self, files, priority):
+        self._queue.put((files, priority))
+
+    # Tells that all the media of the given priority were submitted
+    def finish(self, priority):
+        self._queue.put((None, priority))
+
+    # Waits for the moves of the media submitted, and returns the media moved
+    def close(self):
+        self._queue.put(None)
+        self._thread.join()
+        return self.moved_files
+
+    def _run(self):
+        while True:
+            item = self._queue.get()
+            if item is None:
+                # Everything was fetched
+                self._fetching.clear()
+            elif item[0] is None:
+                self._fetching.discard(item[1])
+            else:
+                self._held.append(item)
+            ready, held = [], []
+            for files, priority in self._held:
+                (held if any(fetching < priority for fetching in self._fetching) else ready).append((files, priority))
+            self._held = held
+            for files, priority in ready:
+                try:
+                    self._move(files)
+                except Exception as e:
+                    logging.error(f"Error moving the fetched media to the cache, they are left to the cache pass: {e}")
+            if item is None:
+                break
+
+    def _move(self, files):
+        files = modify_file_paths(files)
+        files = get_media_sidecars(files, files_to_skip=files_to_skip)
+        files = [file for file in dict.fromkeys(files) if file not in self._seen]
+        self._seen.update(files)
+        if not files:
+            return
+        snapshot_paths = []
+        for file in files:
+            snapshot_paths += [file, get_cache_paths(file, self.real_source, self.cache_dir)[1]]
+            if unraid:
+                snapshot_paths.append(get_array_file(file))
+        file_snapshot.prefetch(snapshot_paths)
+        files = filter_files(files, 'cache', self.real_source, self.cache_dir, files_to_skip=files_to_skip)
+        files, deferred_files = plan_cache_moves(files, self.cache_dir, self.space_ledger.budget)
+        for file in deferred_files:
+            logging.info(f"No room on the cache yet, left to the cache pass: {file}")
+        if files:
+            sizes = {file: file_snapshot.getsize(file) for file in files}
+            moved_files = move_media_files(files, self.real_source, self.cache_dir, unraid, debug, 'cache', max_concurrent_moves_array, max_concurrent_moves_cache, self.space_ledger)
+            self.moved_files += moved_files
+            self.moved_size += sum(sizes[file] for file in moved_files)
 
 # Function to check if given path exists, is a directory and the script has writing permissions
 def check_path_exists(path):
@@ -1067,7 +2835,7 @@ def check_path_exists(path):
         exit(f"Path {path} is not writable.")
 
 # Created the move command that gets executed from the function above
-def move_media_files(files, real_source, cache_dir, unraid, debug, destination, max_concurrent_moves_array, max_concurrent_moves_cache):
+def move_media_files(files, real_source, cache_dir, unraid, debug, destination, max_concurrent_moves_array, max_concurrent_moves_cache, space_ledger=None):
     # Print and log the destination directory
     print(f"Moving media files to {destination}...")
     logging.info(f"Moving media files to {destination}...")
@@ -1075,6 +2843,7 @@ def move_media_files(files, real_source, cache_dir, unraid, debug, destination,
     # Initialize the set of files to skip and the set of processed files
     processed_files = set()
     move_commands = []
+    moved_files = []
 
     # Iterate over each file to move
     for file_to_move in files:
@@ -1086,7 +2855,7 @@ def move_media_files(files, real_source, cache_dir, unraid, debug, destination,
         processed_files.add(file_to_move)
         
         # Get the user path, cache path, cache file name, and user file name
-        user_path, cache_path, cache_file_name, user_file_name = get_paths(file_to_move, real_source, cache_dir, unraid)
+        user_path, cache_path, cache_file_name, user_file_name = get_paths(file_to_move, real_source, cache_dir, unraid, destination)
         
         # Get the move command for the current file
         move = get_move_command(destination, cache_file_name, user_path, user_file_name, cache_path)
@@ -1094,12 +2863,20 @@ def move_media_files(files, real_source, cache_dir, unraid, debug, destination,
         # If a move command is obtained, append it to the list of move commands
         if move is not None:
             move_commands.append(move)
+            moved_files.append(file_to_move)
     
     # Execute the move commands
-    execute_move_commands(debug, move_commands, max_concurrent_moves_array, max_concurrent_moves_cache, destination)
+    results = execute_move_commands(debug, move_commands, max_concurrent_moves_array, max_concurrent_moves_cache, destination, space_ledger)
+
+    # Record the new location of the files that were moved successfully, and return them
+    moved_files = [file for file, result in zip(moved_files, results or []) if result == 0]
+    if results and state_store:
+        state_store.set_location(moved_files, destination)
+    return moved_files
 
 # Function to get the paths of the user and cache directories
-def get_paths(file_to_move, real_source, cache_dir, unraid):
+# With disk_direct_moves, the user paths of a move are on the array disk the file is read from (to the cache) or written to (to the array).
+def get_paths(file_to_move, real_source, cache_dir, unraid, destination=None):
     # Get the user path
     user_path = os.path.dirname(file_to_move)
     
@@ -1114,13 +2891,33 @@ def get_paths(file_to_move, real_source, cache_dir, unraid):
     
     # Modify the user path if unraid is True
     if unraid:
-        user_path = user_path.replace("/mnt/user/", "/mnt/user0/", 1)
+        user_path = user_path.replace(user_share, array_share, 1)
 
     # Get the user file name by joining the user path with the base name of the file to move
     user_file_name = os.path.join(user_path, os.path.basename(file_to_move))
-    
+
+    if unraid and disk_direct_moves and destination:
+        if destination == 'cache':
+            disk = get_array_disk(user_file_name)
+        elif file_snapshot.isfile(cache_file_name):
+            disk = array_allocator.get_disk(user_file_name, file_snapshot.getsize(cache_file_name))
+        else:
+            disk = None  # Nothing to move
+        if disk:
+            user_file_name = os.path.join(disk, user_file_name[len(array_share):])
+            user_path = os.path.dirname(user_file_name)
+
     return user_path, cache_path, cache_file_name, user_file_name
 
+# Function to get the path of the given /mnt/user file on the array: on the disk holding it with disk_direct_moves,
+# otherwise (or if no disk holds it) through /mnt/user0
+def get_array_file(file):
+    if not unraid:
+        return file
+    array_file = file.replace(user_share, array_share, 1)
+    disk = get_array_disk(array_file) if disk_direct_moves else None
+    return os.path.join(disk, array_file[len(array_share):]) if disk else array_file
+
 # Locates the given file in the cache
 def get_cache_paths(file, real_source, cache_dir):
     # Get the cache path by replacing the real source directory with the cache directory
@@ -1131,16 +2928,137 @@ def get_cache_paths(file, real_source, cache_dir):
     
     return cache_path, cache_file_name
 
-def move_file(move_cmd):
+# Suffixes of the files kept while copying, so that an interrupted copy can be resumed
+partial_suffix = ".plexcache.partial"
+progress_suffix = ".plexcache.progress"
+progress_interval = 1024 ** 3  # Save the progress of a copy every GB
+
+# Function to get the offset an interrupted copy can resume from, after checking it against the source file
+def get_resume_offset(src, src_stat, temp_file, progress_file):
+    try:
+        with open(progress_file, 'r') as f:
+            progress = json.load(f)
+    except (OSError, json.JSONDecodeError):
+        return 0
+    # The source must not have changed since the copy started
+    if progress.get('size') != src_stat.st_size or progress.get('mtime') != src_stat.st_mtime:
+        return 0
+    offset = progress.get('offset', 0)
+    if offset <= 0 or not os.path.isfile(temp_file) or os.path.getsize(temp_file) < offset:
+        return 0
+    # Verify that the last block copied matches the source
+    verify_size = min(offset, 1024 * 1024)
+    with open(src, 'rb') as src_file, open(temp_file, 'rb') as dest_file:
+        src_file.seek(offset - verify_size)
+        dest_file.seek(offset - verify_size)
+        if src_file.read(verify_size) != dest_file.read(verify_size):
+            return 0
+    return offset
+
+# Function to copy a chunk of a file at the given offset, returns the number of bytes copied
+def copy_chunk(src_fd, dest_fd, offset, count, method):
+    if method == 'copy_file_range':
+        return os.copy_file_range(src_fd, dest_fd, count, offset, offset)
+    if method == 'sendfile':
+        os.lseek(dest_fd, offset, os.SEEK_SET)
+        return os.sendfile(dest_fd, src_fd, offset, count)
+    return os.pwrite(dest_fd, os.pread(src_fd, count, offset), offset)
+
+# Function to get the copy methods to try, in order, falling back to the next one if the filesystems don't support it
+# read_write works everywhere, so it always stays the last fallback, even after a copy_method chosen in the settings
+def get_copy_methods():
+    if copy_method != 'auto':
+        return [copy_method] if copy_method == 'read_write' else [copy_method, 'read_write']
+    return [method for method, available in [
+        ('copy_file_range', hasattr(os, 'copy_file_range')),
+        ('sendfile', hasattr(os, 'sendfile')),
+        ('read_write', True)
+    ] if available]
+
+# Function to copy a file to dest_file through a temporary file, resuming a previously interrupted copy when possible
+# The destination is preallocated so that a full disk is reported straight away, and only renamed once complete.
+def copy_file_resumable(src, dest_file, src_stat, throttle=None):
+    temp_file = dest_file + partial_suffix
+    progress_file = dest_file + progress_suffix
+    size = src_stat.st_size
+    chunk_size = copy_chunk_size * 1024 * 1024
+    offset = get_resume_offset(src, src_stat, temp_file, progress_file)
+    if offset:
+        logging.info(f"Resuming the copy of {src} from {offset / (1024 ** 2):.0f} MB...")
+
+    src_fd = os.open(src, os.O_RDONLY)
+    try:
+        dest_fd = os.open(temp_file, os.O_WRONLY | os.O_CREAT | (0 if offset else os.O_TRUNC), 0o644)
+        try:
+            try:
+                if hasattr(os, 'posix_fallocate'):
+                    os.posix_fallocate(dest_fd, 0, size)
+            except OSError as e:
+                if e.errno == errno.ENOSPC:
+                    # Don't leave a partial file behind on a full disk
+                    os.close(dest_fd)
+                    dest_fd = None
+                    os.remove(temp_file)
+                    raise
+                # Otherwise preallocation isn't supported by this filesystem, copy without it
+            methods = get_copy_methods()
+            last_progress = offset
+            while offset < size:
+                try:
+                    copied = copy_chunk(src_fd, dest_fd, offset, min(chunk_size, size - offset), methods[0])
+                except OSError as e:
+                    if e.errno in (errno.EXDEV, errno.ENOSYS, errno.EOPNOTSUPP, errno.EINVAL) and len(methods) > 1:
+                        logging.debug(f"{methods[0]} is not supported for {src}, falling back to {methods[1]}")
+                        methods.pop(0)
+                        continue
+                    raise
+                if copied == 0:
+                    raise OSError(f"{src} is shorter than expected, it may have changed during the copy.")
+                offset += copied
+                if throttle:
+                    throttle(copied)
+                if offset - last_progress >= progress_interval:
+                    # Only record the progress once the data is on disk
+                    os.fsync(dest_fd)
+                    with open(progress_file, 'w') as f:
+                        json.dump({'size': size, 'mtime': src_stat.st_mtime, 'offset': offset}, f)
+                    last_progress = offset
+            os.fsync(dest_fd)
+        finally:
+            if dest_fd is not None:
+                os.close(dest_fd)
+    finally:
+        os.close(src_fd)
+
+    shutil.copystat(src, temp_file)
+    os.replace(temp_file, dest_file)
+    if os.path.exists(progress_file):
+        os.remove(progress_file)
+
+@profiler.trace()
+def move_file(move_cmd, throttle=None):
     src, dest = move_cmd
     try:
         if os_linux:
-            stat_info = os.stat(src)
+            stat_info = file_snapshot.stat(src)
+            if stat_info is None:
+                raise FileNotFoundError(f"No such file: '{src}'")
             uid = stat_info.st_uid
             gid = stat_info.st_gid
-            # Move the file first
-            shutil.move(src, dest)
+            dest_file = os.path.join(dest, os.path.basename(src))
+            if os.path.lexists(dest_file):
+                # Like shutil.move, never overwrite a file already at the destination
+                raise FileExistsError(f"Destination path '{dest_file}' already exists")
+            if stat_info.st_dev == os.stat(dest).st_dev:
+                # Same filesystem, a rename is enough
+                os.rename(src, dest_file)
+            else:
+                # Copy the file first (with its mode), the source is only removed once the copy is complete
+                copy_file_resumable(src, dest_file, stat_info, throttle)
+                os.unlink(src)
+            file_snapshot.invalidate(src, dest_file)
             # Then set the owner and group to the original values
+            os.chown(dest_file, uid, gid)
             os.chown(dest, uid, gid)
             original_umask = os.umask(0)
             os.chmod(dest, permissions)
@@ -1156,10 +3074,10 @@ def move_file(move_cmd):
 
 #Helper function to create directory and set permissions
 def create_directory_with_permissions(path, src_file_for_permissions):
-    if not os.path.exists(path):
+    if not file_snapshot.isdir(path):
         if os_linux:  # POSIX platform (Linux/Unix)
             # Get the permissions of the source file
-            stat_info = os.stat(src_file_for_permissions)
+            stat_info = file_snapshot.stat(src_file_for_permissions) or os.stat(src_file_for_permissions)
             mode = stat_info.st_mode
             uid = stat_info.st_uid
             gid = stat_info.st_gid
@@ -1170,33 +3088,288 @@ def create_directory_with_permissions(path, src_file_for_permissions):
             os.umask(original_umask)
         else:  # Windows platform
             os.makedirs(path, exist_ok=True)
+        file_snapshot.invalidate(path)
 
 #Function to get the move command for the given file
 def get_move_command(destination, cache_file_name, user_path, user_file_name, cache_path):
     move = None
     if destination == 'array':
         create_directory_with_permissions(user_path, cache_file_name)
-        if os.path.isfile(cache_file_name):
+        if file_snapshot.isfile(cache_file_name):
             move = (cache_file_name, user_path)
     elif destination == 'cache':
         create_directory_with_permissions(cache_path, user_file_name)
-        if not os.path.isfile(cache_file_name):
+        if not file_snapshot.isfile(cache_file_name):
             move = (user_file_name, cache_path)
     return move
 
 # Function to execute the given move commands
-def execute_move_commands(debug, move_commands, max_concurrent_moves_array, max_concurrent_moves_cache, destination):
+def execute_move_commands(debug, move_commands, max_concurrent_moves_array, max_concurrent_moves_cache, destination, space_ledger=None):
     if debug:
         for move_cmd in move_commands:
             print(move_cmd)  # Print the move command
             logging.info(move_cmd)  # Log the move command
     else:
         max_concurrent_moves = max_concurrent_moves_array if destination == 'array' else max_concurrent_moves_cache
-        with ThreadPoolExecutor(max_workers=max_concurrent_moves) as executor:
-            results = executor.map(move_file, move_commands)  # Move the files using multiple threads
-            errors = [result for result in results if result != 0]  # Collect any non-zero error codes
-            print(f"Finished moving files with {len(errors)} errors.")  # Print the number of errors encountered during file moves
-            logging.info(f"Finished moving files with {len(errors)} errors.")
+        move_throttle.start_monitor(plex)  # Slow down the moves while Plex is streaming from the same disks
+        try:
+            with run_metrics.phase(f'moves_{destination}'):
+                results = schedule_moves(move_commands, destination, max_concurrent_moves, space_ledger)  # Move the files using multiple threads
+        finally:
+            move_throttle.stop_monitor()
+        errors = [result for result in results if result not in (0, MOVE_DEFERRED)]  # Collect any error codes
+        deferred = results.count(MOVE_DEFERRED)
+        print(f"Finished moving files with {len(errors)} errors{f', {deferred} deferred for lack of space' if deferred else ''}.")  # Print the number of errors encountered during file moves
+        logging.info(f"Finished moving files with {len(errors)} errors{f', {deferred} deferred for lack of space' if deferred else ''}.")
+        return results
+
+# Bandwidth limiter for the moves, shared by all the move threads
+# Moves are capped to max_move_speed_cache/array, and slowed down to session_move_speed (or paused) while a Plex session
+# is reading from the same array disk or from the cache pool. The sessions are checked every session_poll_interval seconds.
+class MoveThrottle:
+    def __init__(self, speeds, session_speed, poll_interval):
+        self.speeds = speeds  # Destination -> MB/s, 0 for no limit
+        self.session_speed = session_speed
+        self.poll_interval = poll_interval
+        self.busy_resources = set()  # Array disks ('array' when unknown) and 'cache' Plex is currently reading from
+        self.bytes_moved = 0
+        self._next_free = {}  # Destination -> time at which the bandwidth is available again
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._monitor = None
+
+    # Returns the function a move calls after each chunk copied, slowing it down as needed
+    def for_move(self, destination, resources):
+        return lambda copied: self.consume(copied, destination, resources)
+
+    def consume(self, copied, destination, resources):
+        with self._lock:
+            self.bytes_moved += copied
+        while True:
+            busy = not self.busy_resources.isdisjoint(resources)
+            speed = self.session_speed if busy else self.speeds.get(destination, 0)
+            if not (busy and speed == 0):
+                break
+            self._stop.wait(1)  # Paused until the session is over
+            if self._stop.is_set():
+                break
+        if speed:
+            # Book the time this chunk takes at the allowed speed, after the chunks of the other moves
+            with self._lock:
+                now = time.monotonic()
+                self._next_free[destination] = max(self._next_free.get(destination, now), now) + copied / (speed * 1024 * 1024)
+                wait = self._next_free[destination] - now
+            time.sleep(wait)
+
+    # Finds the array disks and cache pool the active Plex sessions are reading from,
+    # a file on no known disk (or not on Unraid) counting as 'array'
+    def update_sessions(self, plex):
+        busy_resources = set()
+        for session in plex.sessions():
+            for media in session.media:
+                for part in media.parts:
+                    if not part.file or not part.file.startswith(plex_source):
+                        continue
+                    file = edit_file_path(part.file)
+                    if os.path.isfile(get_cache_paths(file, real_source, cache_dir)[1]):
+                        busy_resources.add('cache')
+                    else:
+                        busy_resources.add(get_array_disk(file.replace(user_share, array_share, 1)) or 'array')
+        if busy_resources != self.busy_resources:
+            if busy_resources:
+                logging.info(f"Plex is streaming from {', '.join(sorted(busy_resources))}, {'pausing' if self.session_speed == 0 else 'slowing down'} the moves using them.")
+            else:
+                logging.info("No more Plex sessions, moving at full speed.")
+        self.busy_resources = busy_resources
+
+    def check_sessions(self, plex):
+        try:
+            self.update_sessions(plex)
+        except Exception as e:
+            logging.error(f"Error checking the Plex sessions: {e}")
+
+    def _run_monitor(self, plex):
+        last_bytes_moved = self.bytes_moved
+        while not self._stop.wait(self.poll_interval):
+            self.check_sessions(plex)
+            moved = self.bytes_moved - last_bytes_moved
+            last_bytes_moved += moved
+            logging.info(f"Moved {moved / (1024 ** 2):.0f} MB in the last {self.poll_interval} seconds ({moved / (1024 ** 2) / self.poll_interval:.1f} MB/s).")
+
+    def start_monitor(self, plex):
+        self._stop.clear()
+        self.check_sessions(plex)
+        self._monitor = threading.Thread(target=self._run_monitor, args=(plex,), daemon=True)
+        self._monitor.start()
+
+    def stop_monitor(self):
+        self._stop.set()
+        if self._monitor:
+            self._monitor.join()
+            self._monitor = None
+
+move_throttle = MoveThrottle({'cache': max_move_speed_cache, 'array': max_move_speed_array}, session_move_speed, session_poll_interval)
+
+MOVE_DEFERRED = 2  # Result of a move skipped because it no longer fits on the cache
+
+# Function to list the array disks (/mnt/disk1, /mnt/disk2...) of an Unraid server
+def get_array_disks():
+    global array_disks
+    if array_disks is None:
+        array_disks = sorted(glob.glob(array_disks_pattern), key=lambda disk: int(re.sub(r'\D', '', disk)))
+    return array_disks
+
+# Function to find the array disk holding the given /mnt/user0 path, or the disk of a /mnt/diskN path, None if it isn't on the array
+def get_array_disk(path):
+    if not unraid:
+        return None
+    for disk in get_array_disks():
+        if path.startswith(disk + '/'):
+            return disk
+    if not path.startswith(array_share):
+        return None
+    relative_path = path[len(array_share):]
+    directory = os.path.dirname(relative_path)
+    # Files of the same directory are usually on the same disk, so check the last one found first
+    cached_disk = array_disk_cache.get(directory)
+    disks = get_array_disks()
+    if cached_disk:
+        disks = [cached_disk] + [disk for disk in disks if disk != cached_disk]
+    for disk in disks:
+        if os.path.exists(os.path.join(disk, relative_path)):
+            array_disk_cache[directory] = disk
+            return disk
+    return None
+
+# Function to get the array disk a move reads from (moves to the cache) or writes to (moves to the array)
+def get_move_disk(move_cmd, destination):
+    src, dest = move_cmd
+    # The destination directory was already created, on the disk picked for it by Unraid or by the array_allocator
+    return get_array_disk(src if destination == 'cache' else dest)
+
+# Function to convert the minimum free space of an Unraid share to bytes: in KB, or with a unit (e.g. "50GB")
+def get_share_floor(value):
+    match = re.fullmatch(r'\s*(\d+(?:\.\d+)?)\s*([KMGT]?)B?\s*', value or "0", re.IGNORECASE)
+    if not match:
+        return 0
+    return int(float(match[1]) * 1024 ** ("KMGT".index(match[2].upper() or "K") + 1))
+
+# Chooses the array disk a file moved back to the array is written to, the way shfs would for a write to /mnt/user0:
+# among the disks included in its share with room above the share's minimum free space, keeping the directories
+# below the split level on the disk already holding them, and following the allocation method of the share.
+# The files planned on a disk are deducted from its free space, so that the moves of a run are spread like Unraid would.
+class ArrayAllocator:
+    def __init__(self):
+        self._shares = {}  # Share name -> its settings
+        self._free = {}  # Array disk -> free bytes, less the files planned on it
+        self._sizes = {}  # Array disk -> size in bytes
+        self._lock = threading.Lock()
+
+    # Reads the settings of the given share from its Unraid config file, with Unraid's defaults
+    def get_share(self, share):
+        if share not in self._shares:
+            config = {}
+            try:
+                with open(os.path.join(unraid_shares_config, f"{share}.cfg")) as f:
+                    for line in f:
+                        key, _, value = line.strip().partition('=')
+                        config[key] = value.strip('"')
+            except OSError:
+                logging.debug(f"No Unraid config found for the share {share}, using the default allocation.")
+            self._shares[share] = {
+                'allocator': config.get('shareAllocator') or 'highwater',
+                'split_level': config.get('shareSplitLevel', ''),
+                'floor': get_share_floor(config.get('shareFloor')),
+                'include': {disk for disk in config.get('shareInclude', '').split(',') if disk},
+                'exclude': {disk for disk in config.get('shareExclude', '').split(',') if disk},
+            }
+        return self._shares[share]
+
+    # Returns the directory (relative to the array disks) that can't be split across disks, None if any can be
+    @staticmethod
+    def get_split_directory(relative_path, split_level):
+        share, *directories = os.path.dirname(relative_path).split('/')
+        if split_level == '':
+            return None  # Automatically split any directory as required
+        if split_level == '0':
+            return os.path.dirname(relative_path)  # Manual: the directory must already be on the disk
+        if len(directories) < int(split_level):
+            return None
+        return '/'.join([share] + directories[:int(split_level)])
+
+    def get_disk(self, array_file, size):
+        relative_path = array_file[len(array_share):]
+        share = self.get_share(relative_path.split('/')[0])
+        disks = [
+            disk for disk in get_array_disks()
+            if (not share['include'] or os.path.basename(disk) in share['include']) and os.path.basename(disk) not in share['exclude']
+        ]
+        split_directory = self.get_split_directory(relative_path, share['split_level'])
+        if split_directory:
+            holding_disks = [disk for disk in disks if os.path.isdir(os.path.join(disk, split_directory))]
+            disks = holding_disks or disks
+        with self._lock:
+            for disk in disks:
+                if disk not in self._free:
+                    usage = shutil.disk_usage(disk)
+                    self._free[disk], self._sizes[disk] = usage.free, usage.total
+            disks = [disk for disk in disks if self._free[disk] - size > share['floor']]
+            if not disks:
+                logging.debug(f"No array disk has room for {array_file}, leaving the choice to Unraid.")
+                return None
+            if share['allocator'] == 'fillup':
+                disk = disks[0]
+            elif share['allocator'] == 'mostfree':
+                disk = max(disks, key=lambda disk: self._free[disk])
+            else:
+                # High-water: the first disk with more free space than the mark, which starts at half the largest disk and halves
+                mark = max(self._sizes[disk] for disk in disks) / 2
+                while not any(self._free[disk] >= mark for disk in disks):
+                    mark /= 2
+                disk = next(disk for disk in disks if self._free[disk] >= mark)
+            self._free[disk] -= size
+        return disk
+
+array_allocator = ArrayAllocator()
+
+# Function to run the moves with a queue for each array disk, so that a disk only handles
+# max_concurrent_moves_per_disk moves at a time while the other disks work in parallel.
+# The moves of all the disks together are still limited to max_concurrent_moves, for the cache pool.
+def schedule_moves(move_commands, destination, max_concurrent_moves, space_ledger=None):
+    disk_queues = {}
+    for index, move_cmd in enumerate(move_commands):
+        disk_queues.setdefault(get_move_disk(move_cmd, destination), []).append(index)
+    pool_slots = threading.BoundedSemaphore(max_concurrent_moves)
+    results = [None] * len(move_commands)
+
+    def run_move(index, throttle):
+        with pool_slots:
+            size = file_snapshot.getsize(move_commands[index][0])
+            if space_ledger and not space_ledger.reserve(size):
+                logging.warning(f"Not enough space left on the cache, deferring: {move_commands[index][0]}")
+                results[index] = MOVE_DEFERRED
+            else:
+                results[index] = move_file(move_commands[index], throttle)
+                if space_ledger and results[index] != 0:
+                    space_ledger.release(size)
+            run_metrics.record_move(destination, size, results[index])
+
+    def run_disk_queue(disk, indexes):
+        # A move competes with the streams of its array disk (the whole 'array' if unknown), and the moves to the cache
+        # with the streams of the cache pool too; the moves to the array are left to the array side only
+        resources = (disk or 'array', 'cache') if destination == 'cache' else (disk or 'array',)
+        throttle = move_throttle.for_move(destination, resources)
+        # Move the files of a directory one after the other, for sequential reads and writes
+        indexes.sort(key=lambda index: move_commands[index][0])
+        # Files whose disk is unknown (or not on Unraid) are only limited by the cache pool
+        max_workers = max_concurrent_moves_per_disk if disk else max_concurrent_moves
+        logging.info(f"Moving {len(indexes)} files {'on ' + disk if disk else 'off the array disks'}...")
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            list(executor.map(lambda index: run_move(index, throttle), indexes))
+
+    with ThreadPoolExecutor(max_workers=max(len(disk_queues), 1)) as executor:
+        list(executor.map(lambda disk_queue: run_disk_queue(*disk_queue), disk_queues.items()))
+    return results
 
 def convert_time(execution_time_seconds):
     # Calculate days, hours, minutes, and seconds
@@ -1225,148 +3398,312 @@ def is_connected():
     except socket.error:
         return False
 
+# Function to move to the cache the next episodes of the given (username, episode) being played,
+# or of the episodes just finished (finished=True), without the finished episodes themselves
+def cache_next_episodes(plex, playing, finished=False):
+    main_username = account_cache.get_username(plex)
+    users = None
+    ondeck_files = []
+    for username, video in playing:
+        if username is None:
+            continue
+        if username != main_username:
+            if users is None:
+                users = {user.title: user for user in account_cache.get_users(plex)} if users_toggle else {}
+            if username not in users or users[username].server_token in skip_ondeck:
+                continue
+        logging.info(f"{username} {'finished' if finished else 'is playing'} {video.grandparentTitle} - {video.title}, fetching the next episodes...")
+        files = []
+        process_episode_ondeck(video, number_episodes, files, finished)
+        add_media_users(files, username)
+        ondeck_files.extend(files)
+    if not ondeck_files:
+        print("No episodes being played.")
+        logging.info("No episodes being played.")
+        return
+    ondeck_files = modify_file_paths(ondeck_files)
+    ondeck_files = get_media_sidecars(ondeck_files, files_to_skip=files_to_skip)
+    if state_store:  # A --sessions-only run leaves recording them to the next full run
+        state_store.update_media('ondeck', ondeck_files, get_media_users(ondeck_files))
+    check_free_space_and_move_files(ondeck_files, 'cache', real_source, cache_dir, unraid, debug)
+
+# Daemon mode: after the first run, the script stays connected to Plex and listens to its notifications.
+# When a user starts or stops playing an episode, only the next episodes of that user are worked out again and
+# moved to the cache, and the library indexes are refreshed when new episodes are added. Everything stays in memory.
+class PlaybackDaemon:
+    WATCHED_THRESHOLD = 0.9  # Part of an episode played for it to count as finished, like the Plex default
+
+    def __init__(self, plex):
+        self.plex = plex
+        self.events = queue.Queue()  # Filled by the websocket thread, handled one at a time by run()
+        self.sessions = {}  # sessionKey -> (username, ratingKey) of the media being played
+        self.view_offsets = {}  # sessionKey -> last position reported, in milliseconds
+        self._stop = threading.Event()
+
+    # Called by the AlertListener thread, the events are only queued so that the websocket is never blocked
+    def on_alert(self, data):
+        alert_type = data.get('type')
+        if alert_type == 'playing':
+            for notification in data.get('PlaySessionStateNotification', []):
+                self.events.put(('playing', str(notification.get('sessionKey')), notification.get('ratingKey'), notification.get('state'), notification.get('viewOffset') or 0))
+        elif alert_type == 'timeline':
+            # An episode (type 4) finished processing (state 5) after being added to the library
+            if any(entry.get('type') == 4 and entry.get('state') == 5 for entry in data.get('TimelineEntry', [])):
+                self.events.put(('library',))
+        elif alert_type == 'activity':
+            for notification in data.get('ActivityNotification', []):
+                if notification.get('event') == 'ended' and notification.get('Activity', {}).get('type') == 'library.update.section':
+                    self.events.put(('library',))
+
+    def on_error(self, error):
+        logging.error(f"Error in the Plex notifications: {error}")
+
+    def stop(self, *args):
+        self._stop.set()
+
+    def start_listener(self):
+        from plexapi.alert import AlertListener
+        listener = AlertListener(self.plex, callback=self.on_alert, callbackError=self.on_error)
+        listener.start()
+        return listener
+
+    def run(self):
+        if importlib.util.find_spec('websocket') is None:  # Needed by the AlertListener
+            logging.critical("The daemon mode needs the websocket-client package: pip install websocket-client")
+            exit("The daemon mode needs the websocket-client package: pip install websocket-client")
+        print("Daemon mode: waiting for playback events...")
+        logging.info("Daemon mode: waiting for playback events...")
+        signal.signal(signal.SIGTERM, self.stop)
+        listener = self.start_listener()
+        try:
+            while not self._stop.is_set():
+                try:
+                    event = self.events.get(timeout=1)
+                except queue.Empty:
+                    if not listener.is_alive():
+                        # The websocket was closed, e.g. Plex restarted
+                        logging.warning(f"Lost the connection to the Plex notifications, reconnecting in {DELAY} seconds...")
+                        self._stop.wait(DELAY)
+                        listener = self.start_listener()
+                    continue
+                try:
+                    self.handle(event)
+                except Exception as e:
+                    logging.error(f"Error handling the Plex event {event}: {e}")
+        except KeyboardInterrupt:
+            pass
+        finally:
+            listener.stop()
+        logging.info("Daemon mode stopped.")
+
+    def handle(self, event):
+        global files_to_skip
+        if event[0] == 'library':
+            logging.info("The library was updated, refreshing the episodes index.")
+            episode_index.invalidate()
+            return
+        _, session_key, rating_key, state, view_offset = event
+        if state == 'stopped':
+            session = self.sessions.pop(session_key, None)
+            view_offset = max(view_offset, self.view_offsets.pop(session_key, 0))
+            if session:
+                # The files of the stopped session can be moved again
+                files_to_skip = self.get_playing_files(self.plex.sessions())
+                # The next episodes to cache change if the episode was finished
+                self.update_user(*session, view_offset=view_offset)
+            return
+        if self.sessions.get(session_key, (None, None))[1] == rating_key:
+            self.view_offsets[session_key] = max(view_offset, self.view_offsets.get(session_key, 0))
+            return  # Still playing the same media, already handled
+        self.view_offsets[session_key] = view_offset
+        sessions = self.plex.sessions()
+        username = next((session.usernames[0] for session in sessions if str(session.sessionKey) == session_key and session.usernames), None)
+        self.sessions[session_key] = (username, rating_key)
+        # Don't move the files being played
+        files_to_skip = self.get_playing_files(sessions)
+        self.update_user(username, rating_key)
+
+    @staticmethod
+    def get_playing_files(sessions):
+        return [part.file for session in sessions for media in session.media for part in media.parts if part.file]
+
+    # Moves to the cache the next episodes after the given one, for the given user
+    # With the position the playback stopped at, the episode itself is left out if it was finished
+    def update_user(self, username, rating_key, view_offset=None):
+        try:
+            video = self.plex.fetchItem(int(rating_key))
+        except NotFound:
+            return
+        if not isinstance(video, Episode):
+            return
+        finished = view_offset is not None and bool(video.duration) and view_offset >= video.duration * self.WATCHED_THRESHOLD
+        # The files may have been changed by Plex or the mover since the last event
+        file_snapshot.clear()
+        cache_next_episodes(self.plex, [(username, video)], finished)
+
 # Checks if the paths exists and are accessible
 for path in [real_source, cache_dir]:
     check_path_exists(path)
 
-# Fetch OnDeck Media
-media_to_cache.extend(fetch_on_deck_media_main(plex, valid_sections, days_to_monitor, number_episodes, users_toggle, skip_ondeck))
-
-# Edit file paths for the above fetched media
-media_to_cache = modify_file_paths(media_to_cache, plex_source, real_source, plex_library_folders, nas_library_folders)
-
-# Fetches subtitles for the above fetched media
-media_to_cache.extend(get_media_subtitles(media_to_cache, files_to_skip=files_to_skip))
-
-# Watchlist logic:
-# It will check if there is internet connection as plexapi requires to use a method which uses their server rather than plex
-# If internet is not available or the cache is within the expiry date, it will use the cached file.
-if watchlist_toggle:
-    try:
-        # Load previously watched media from cache and get the last update time
-        watchlist_media_set, last_updated = load_media_from_cache(watchlist_cache_file)
-        current_watchlist_set = set()
-
-        if is_connected():
-            # To fetch the watchlist media, internet connection is required due to a plexapi limitation
-
-            # Check if the cache file doesn't exist, debug mode is enabled, or cache has expired
-            if skip_cache or (not watchlist_cache_file.exists()) or (debug) or (datetime.now() - datetime.fromtimestamp(watchlist_cache_file.stat().st_mtime) > timedelta(hours=watchlist_cache_expiry)):
-                print("Fetching watchlist media...")
-                logging.info("Fetching watchlist media...")
-
-                # Fetch the watchlist media from Plex server
-                fetched_watchlist = fetch_watchlist_media(plex, valid_sections, watchlist_episodes, users_toggle=users_toggle, skip_watchlist=skip_watchlist)
-
-                # Add new media paths to the cache
-                for file_path in fetched_watchlist:
-                    current_watchlist_set.add(file_path)
-                    if file_path not in watchlist_media_set:
-                        media_to_cache.append(file_path)
-
-                # Remove media that no longer exists in the watchlist
-                watchlist_media_set.intersection_update(current_watchlist_set)
-
-                # Add new media to the watchlist media set
-                watchlist_media_set.update(media_to_cache)
-
-                # Modify file paths and add subtitles
-                media_to_cache = modify_file_paths(media_to_cache, plex_source, real_source, plex_library_folders, nas_library_folders)
-                media_to_cache.extend(get_media_subtitles(media_to_cache, files_to_skip=files_to_skip))
-
-                # Update the cache file with the updated watchlist media set
-                with watchlist_cache_file.open('w') as f:
-                    json.dump({'media': list(media_to_cache), 'timestamp': datetime.now().timestamp()}, f)
+if sessions_only:
+    # Only the next episodes of the sessions read at startup, the rest is left to the full runs
+    cache_next_episodes(plex, playing_episodes)
+    profiler.snapshot('sessions_only')
+else:
+    import asyncio, sqlite3  # Only needed to fetch the media of all the users and to keep their state
+
+    state_store = StateStore(state_db_file)
+    state_store.migrate_json_cache(watchlist_cache_file, 'watchlist')
+    state_store.migrate_json_cache(watched_cache_file, 'watched')
+
+    # Work out which media have to be fetched from Plex, the others are loaded from the state database
+    # To fetch the watchlist media, internet connection is required due to a plexapi limitation
+    watchlist_last_updated = state_store.get_state('watchlist_updated')
+    watchlist_connected = watchlist_toggle and is_connected()
+    # Fetch the watchlist if it was never fetched, debug mode is enabled, or cache has expired
+    fetch_watchlist = watchlist_connected and (skip_cache or (watchlist_last_updated is None) or (debug) or (datetime.now() - datetime.fromtimestamp(watchlist_last_updated) > timedelta(hours=watchlist_cache_expiry)))
+    watched_last_updated = state_store.get_state('watched_updated')
+    fetch_watched = watched_move and (skip_cache or watched_last_updated is None or debug or (datetime.now() - datetime.fromtimestamp(watched_last_updated) > timedelta(hours=watched_cache_expiry)))
+
+    # Fetch the onDeck, watchlist and watched media of all the users at once
+    print("Fetching onDeck media...")
+    logging.info("Fetching onDeck media...")
+    if fetch_watchlist:
+        print("Fetching watchlist media...")
+        logging.info("Fetching watchlist media...")
+    if fetch_watched:
+        print("Fetching watched media...")
+        logging.info("Fetching watched media...")
+    # The onDeck media, then the watchlist, start moving to the cache while the rest is fetched
+    cache_pipeline = None
+    if stream_cache_moves and not debug:
+        cache_pipeline = CachePipeline(real_source, cache_dir, [PRIORITY_ONDECK, PRIORITY_WATCHLIST] if fetch_watchlist else [PRIORITY_ONDECK])
+    ondeck_media, fetched_watchlist, fetched_watched, history_cursor = asyncio.run(fetch_media(plex, fetch_watchlist, fetch_watched, watched_last_updated, state_store.get_state('history_cursor'), cache_pipeline))
+    if cache_pipeline and cache_pipeline.close():
+        moved_size, moved_size_unit = convert_bytes_to_readable_size(cache_pipeline.moved_size)
+        print(f"Moved {len(cache_pipeline.moved_files)} files ({moved_size:.2f} {moved_size_unit}) to the cache while fetching.")
+        logging.info(f"Moved {len(cache_pipeline.moved_files)} files ({moved_size:.2f} {moved_size_unit}) to the cache while fetching.")
+        summary_messages.append(f"Total size of media files moved to cache while fetching: {moved_size:.2f} {moved_size_unit}")
+        files_moved = True
+    profiler.snapshot('fetch')
+    if ondeck_media is not None:
+        media_to_cache.extend(ondeck_media)
+
+        # Edit file paths for the above fetched media
+        media_to_cache = modify_file_paths(media_to_cache)
+
+        # Fetches the sidecar files of the above fetched media
+        media_to_cache.extend(get_media_sidecars(media_to_cache, files_to_skip=files_to_skip))
+
+        # Save the current onDeck media, replacing the ones that are no longer onDeck
+        state_store.update_media('ondeck', media_to_cache, get_media_users(media_to_cache), replace=True)
+    else:
+        # The onDeck media could not be fetched, the ones of the previous run are kept, their paths are already edited
+        print("Loading onDeck media from cache...")
+        logging.info("Loading onDeck media from cache...")
+        media_to_cache.extend(state_store.get_media('ondeck'))
+    profiler.snapshot('ondeck')
+
+    # Watchlist logic:
+    # If internet is not available or the cache is within the expiry date, it will use the media saved in the state database.
+    if watchlist_toggle:
+        try:
+            if fetched_watchlist is not None:
+                # Modify file paths and add the sidecar files
+                watchlist_media = modify_file_paths(fetched_watchlist)
+                watchlist_media = get_media_sidecars(watchlist_media, files_to_skip=files_to_skip)
+                media_to_cache.extend(watchlist_media)
+
+                # Save the watchlist media, removing the media that no longer exists in the watchlist
+                new_watchlist_media = state_store.update_media('watchlist', watchlist_media, get_media_users(watchlist_media), replace=True)
+                logging.info(f"Found {len(new_watchlist_media)} new watchlist media.")
             else:
+                if not watchlist_connected:
+                    # Handle no internet connection scenario
+                    print("Unable to connect to the internet, skipping fetching new watchlist media due to plexapi limitation.")
+                    logging.warning("Unable to connect to the internet, skipping fetching new watchlist media due to plexapi limitation.")
+
                 # Load watchlist media from cache
                 print("Loading watchlist media from cache...")
                 logging.info("Loading watchlist media from cache...")
-                media_to_cache.extend(watchlist_media_set)
-        else:
-            # Handle no internet connection scenario
-            print("Unable to connect to the internet, skipping fetching new watchlist media due to plexapi limitation.")
-            logging.warning("Unable to connect to the internet, skipping fetching new watchlist media due to plexapi limitation.")
-            
-            # Load watchlist media from cache
-            print("Loading watchlist media from cache...")
-            logging.info("Loading watchlist media from cache...")
-            media_to_cache.extend(watchlist_media_set)
-    except Exception as e:
-        # Handle any exceptions that occur while processing the watchlist
-        print("An error occurred while processing the watchlist.")
-        logging.error("An error occurred while processing the watchlist: %s", str(e))
-
-# Watched media logic
-if watched_move:
-    try:
-        # Load watched media from cache
-        watched_media_set, last_updated = load_media_from_cache(watched_cache_file)
-        current_media_set = set()
+                media_to_cache.extend(state_store.get_media('watchlist'))
+        except Exception as e:
+            # Handle any exceptions that occur while processing the watchlist
+            print("An error occurred while processing the watchlist.")
+            logging.error("An error occurred while processing the watchlist: %s", str(e))
+        profiler.snapshot('watchlist')
 
-        # Check if cache file doesn't exist or debug mode is enabled
-        if skip_cache or not watched_cache_file.exists() or debug or (datetime.now() - datetime.fromtimestamp(watched_cache_file.stat().st_mtime) > timedelta(hours=watched_cache_expiry)):
-            print("Fetching watched media...")
-            logging.info("Fetching watched media...")
+    if cache_pipeline and cache_pipeline.moved_files:
+        # The media moved while fetching were not in the state database yet when their location was recorded
+        state_store.set_location(cache_pipeline.moved_files, 'cache')
 
-            # Get watched media from Plex server
-            fetched_media = get_watched_media(plex, valid_sections, last_updated, users_toggle=users_toggle)
-            
-            # Add fetched media to the current media set
-            for file_path in fetched_media:
-                current_media_set.add(file_path)
+    # Watched media logic
+    if watched_move:
+        try:
+            if fetched_watched is not None:
+                # Modify file paths and add the sidecar files
+                media_to_array = modify_file_paths(fetched_watched)
+                media_to_array = get_media_sidecars(media_to_array, files_to_skip)
 
-                # Check if file is not already in the watched media set
-                if file_path not in watched_media_set:
-                    media_to_array.append(file_path)
+                # Save the newly watched media and the play history cursor to the state database
+                state_store.update_media('watched', media_to_array, get_media_users(media_to_array))
+                if history_cursor:
+                    state_store.set_state('history_cursor', history_cursor)
 
-            # Add new media to the watched media set
-            watched_media_set.update(media_to_array)
-            
-            # Modify file paths and add subtitles
-            media_to_array = modify_file_paths(media_to_array, plex_source, real_source, plex_library_folders, nas_library_folders)
-            media_to_array.extend(get_media_subtitles(media_to_array, files_to_skip))
+            else:
+                print("Loading watched media from cache...")
+                logging.info("Loading watched media from cache...")
+                # Add the watched media still on the cache, e.g. whose move failed, rather than the whole history
+                media_to_array.extend(state_store.get_media('watched', location='cache'))
 
-            # Save updated watched media set to cache file
-            with watched_cache_file.open('w') as f:
-                json.dump({'media': list(media_to_array), 'timestamp': datetime.now().timestamp()}, f)
+        except Exception as e:
+            # Handle any exceptions that occur while processing the watched media
+            print("An error occurred while processing the watched media.")
+            logging.error("An error occurred while processing the watched media: %s", str(e))
+        profiler.snapshot('watched')
 
-        else:
-            print("Loading watched media from cache...")
-            logging.info("Loading watched media from cache...")
-            # Add watched media from cache to the media array
-            media_to_array.extend(watched_media_set)
+        try:
+            # Check free space and move files
+            check_free_space_and_move_files(media_to_array, 'array', real_source, cache_dir, unraid, debug)
+        except Exception as e:
+            if not debug:
+                logging.critical(f"Error checking free space and moving media files to the array: {str(e)}")
+                exit(f"Error: {str(e)}")
+            else:
+                logging.error(f"Error checking free space and moving media files to the array: {str(e)}")
+                print(f"Error: {str(e)}")
+        profiler.snapshot('moves_array')
 
+    # Making room on the cache drive if needed
+    try:
+        evict_cached_media(media_to_cache + modify_file_paths(files_to_skip), real_source, cache_dir, unraid, debug)
     except Exception as e:
-        # Handle any exceptions that occur while processing the watched media
-        print("An error occurred while processing the watched media.")
-        logging.error("An error occurred while processing the watched media: %s", str(e))
+        logging.error(f"Error evicting media from the cache: {str(e)}")
+        print(f"Error: {str(e)}")
+    profiler.snapshot('eviction')
 
+    # Moving the files to the cache drive
     try:
-        # Check free space and move files
-        check_free_space_and_move_files(media_to_array, 'array', real_source, cache_dir, unraid, debug)
+        check_free_space_and_move_files(media_to_cache, 'cache', real_source, cache_dir, unraid, debug)
     except Exception as e:
         if not debug:
-            logging.critical(f"Error checking free space and moving media files to the array: {str(e)}")
+            logging.critical(f"Error checking free space and moving media files to the cache: {str(e)}")
             exit(f"Error: {str(e)}")
         else:
-            logging.error(f"Error checking free space and moving media files to the array: {str(e)}")
+            logging.error(f"Error checking free space and moving media files to the cache: {str(e)}")
             print(f"Error: {str(e)}")
+    profiler.snapshot('moves_cache')
 
-# Moving the files to the cache drive
-try:
-    check_free_space_and_move_files(media_to_cache, 'cache', real_source, cache_dir, unraid, debug)
-except Exception as e:
-    if not debug:
-        logging.critical(f"Error checking free space and moving media files to the cache: {str(e)}")
-        exit(f"Error: {str(e)}")
-    else:
-        logging.error(f"Error checking free space and moving media files to the cache: {str(e)}")
-        print(f"Error: {str(e)}")
+# Keep running and caching the next episodes as soon as they are needed
+if daemon:
+    PlaybackDaemon(plex).run()
 
 end_time = time.time()  # record end time
 execution_time_seconds = end_time - start_time  # calculate execution time
 execution_time = convert_time(execution_time_seconds)
 
+if rate_limiter.throttled_requests:
+    summary_messages.append(f"{rate_limiter.throttled_requests} requests were rate limited, {convert_time(rate_limiter.throttled_seconds) or 'less than a second'} lost to throttling.")
 summary_messages.append(f"The script took approximately {execution_time} to execute.")
 summary_message = '  '.join(summary_messages)
 
@@ -1379,5 +3716,10 @@ print("Thank you for using bexem's script: \nhttps://github.com/bexem/PlexCache"
 logging.info("Thank you for using bexem's script: https://github.com/bexem/PlexCache")
 logging.info("Also special thanks to: - /u/teshiburu2020 - /u/planesrfun - /u/trevski13 - /u/extrobe - /u/dsaunier-sunlight")
 logging.info("*** The End ***")
+run_metrics.completed = True
+write_run_metrics()
+profiler.write(trace_file)
+if state_store:
+    state_store.close()
 logging.shutdown()
 print("*** The End ***")
\ No newline at end of file
@@ -0,0 +1,737 @@
+import argparse, base64, hashlib, json, os, random, re, runpy, signal, socket, sqlite3, struct, subprocess, sys, tempfile, threading, time, platform
+from datetime import datetime
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlsplit, urlunsplit, parse_qs
+from xml.sax.saxutils import quoteattr
+
+# End-to-end benchmark of PlexCache against a local stand-in for the Plex server and plex.tv
+# It serves a synthetic library (users x shows x episodes, movies, watchlists and play history), runs plexcache.py
+# in debug mode against it (fetch, path mapping, filtering and planning, no file is moved) and reports the wall time,
+# the requests made to each endpoint and the peak memory. The results are appended to a JSON file to compare versions.
+#
+#   python plexcache_benchmark.py --users 10 --shows 200 --episodes 40
+#   python plexcache_benchmark.py --users 50 --shows 1000 --episodes 60 --latency 20 --runs 2
+#
+# With --database, the same library is also written as a Plex library database, which plexcache.py then reads the
+# onDeck and watched media from instead of the API.
+#
+# With --daemon, plexcache.py is also run in daemon mode: the stand-in pushes the alerts of a user playing an episode,
+# of a new episode being added and of the episode being stopped once finished through its notifications websocket,
+# and the episodes the daemon then moves to the cache are checked in its log.
+#
+# With --ondeck-failure, plexcache.py is run once more while the onDeck requests of a user fail, which must keep the
+# onDeck media of the previous run in its state database.
+
+script_folder = os.path.dirname(os.path.abspath(__file__))
+plexcache_script = os.path.join(script_folder, "plexcache.py")
+results_filename = os.path.join(script_folder, "plexcache_benchmark_results.json")
+
+ADMIN_TOKEN = "benchmark-admin-token"
+MACHINE_IDENTIFIER = "benchmark-machine-identifier"
+MOVIES_SECTION = 1
+SHOWS_SECTION = 2
+EPISODES_PER_SEASON = 10
+EPISODE_SIZE = 2 * 1024 ** 3
+EPISODE_DURATION = 45 * 60 * 1000  # In milliseconds
+MOVIE_SIZE = 8 * 1024 ** 3
+NUMBER_EPISODES = 5  # Next episodes plexcache.py caches after an onDeck episode
+WEBSOCKET_GUID = "258EAFA5-E914-47DA-95CA-C5AB0DC85B11"
+DAEMON_TIMEOUT = 60  # Seconds the daemon has to handle each alert
+
+# Synthetic library and users, generated from a seed so that every run of a configuration gets the same data
+class SyntheticLibrary:
+    def __init__(self, users, shows, episodes, movies, ondeck, watchlist, seed):
+        rng = random.Random(seed)
+        self.shows = shows
+        self.episodes = episodes
+        self.movies = movies
+        self.updated_at = int(time.time()) - 86400
+        # Account 1 is the server owner, the other accounts are home users sharing the server
+        self.accounts = {1: "admin"}
+        self.accounts.update({account_id: f"user{account_id - 1}" for account_id in range(2, users + 2)})
+        self.progress = {}  # Account id -> {show: number of episodes watched}
+        self.movies_watched = {}  # Account id -> set of movies watched
+        self.watchlists = {}  # Account id -> list of ('show' or 'movie', index)
+        self.plays = []  # (history id, viewedAt, account id, ratingKey, section id), newest first
+        now = int(time.time())
+        for account_id in self.accounts:
+            shows_started = rng.sample(range(shows), min(ondeck, shows))
+            self.progress[account_id] = {show: rng.randint(1, max(episodes - 1, 1)) for show in shows_started}
+            self.movies_watched[account_id] = set(rng.sample(range(movies), min(ondeck, movies)))
+            self.watchlists[account_id] = [('show', show) for show in rng.sample(range(shows), min(watchlist, shows))]
+            self.watchlists[account_id] += [('movie', movie) for movie in rng.sample(range(movies), min(watchlist // 2, movies))]
+            for show, watched in self.progress[account_id].items():
+                for episode in range(watched):
+                    self.plays.append((now - rng.randint(3600, 30 * 86400), account_id, self.episode_key(show, episode), SHOWS_SECTION))
+            for movie in self.movies_watched[account_id]:
+                self.plays.append((now - rng.randint(3600, 30 * 86400), account_id, self.movie_key(movie), MOVIES_SECTION))
+        self.plays.sort()
+        self.plays = [(history_id, *play) for history_id, play in enumerate(self.plays, start=1)]
+        self.plays.reverse()
+
+    @staticmethod
+    def show_key(show):
+        return 100000 + show
+
+    def episode_key(self, show, episode):
+        return 1000000 + show * 1000 + episode
+
+    @staticmethod
+    def movie_key(movie):
+        return 200000 + movie
+
+    def show_path(self, show):
+        return f"/media/tv/Show {show:05d}"
+
+    def episode_path(self, show, episode):
+        season, number = divmod(episode, EPISODES_PER_SEASON)
+        return f"{self.show_path(show)}/Season {season + 1:02d}/Show {show:05d} - S{season + 1:02d}E{number + 1:02d}.mkv"
+
+    def movie_path(self, movie):
+        return f"/media/movies/Movie {movie:05d} (2000)/Movie {movie:05d} (2000).mkv"
+
+    # Returns ('show', show), ('episode', (show, episode)) or ('movie', movie) for the given ratingKey
+    def item(self, rating_key):
+        if 1000000 <= rating_key and (rating_key - 1000000) // 1000 < self.shows and (rating_key - 1000000) % 1000 < self.episodes:
+            return 'episode', divmod(rating_key - 1000000, 1000)
+        if 200000 <= rating_key < 200000 + self.movies:
+            return 'movie', rating_key - 200000
+        if 100000 <= rating_key < 100000 + self.shows:
+            return 'show', rating_key - 100000
+        return None, None
+
+    def files(self):
+        for show in range(self.shows):
+            for episode in range(self.episodes):
+                yield self.episode_path(show, episode), EPISODE_SIZE
+        for movie in range(self.movies):
+            yield self.movie_path(movie), MOVIE_SIZE
+
+# Functions to build the XML answered by the stand-in server
+def xml_element(tag, attributes, children=""):
+    attributes = " ".join(f"{key}={quoteattr(str(value))}" for key, value in attributes.items() if value is not None)
+    return f"<{tag} {attributes}>{children}</{tag}>" if children else f"<{tag} {attributes}/>"
+
+def media_xml(file_path, size):
+    return xml_element("Media", {"id": 1, "container": "mkv"}, xml_element("Part", {"id": 1, "file": file_path, "size": size, "container": "mkv"}))
+
+def show_xml(library, show, account_id):
+    watched = library.progress[account_id].get(show, 0)
+    guids = xml_element("Guid", {"id": f"tvdb://{700000 + show}"})
+    return xml_element("Directory", {
+        "ratingKey": library.show_key(show), "key": f"/library/metadata/{library.show_key(show)}/children", "guid": f"plex://show/{show:024x}",
+        "type": "show", "title": f"Show {show:05d}", "librarySectionID": SHOWS_SECTION, "leafCount": library.episodes,
+        "viewedLeafCount": watched, "childCount": (library.episodes - 1) // EPISODES_PER_SEASON + 1,
+    }, guids)
+
+# With a session key, the episode as listed in the sessions, being played by the given account
+def episode_xml(library, show, episode, account_id, last_viewed_at=None, session_key=None):
+    season, number = divmod(episode, EPISODES_PER_SEASON)
+    rating_key = library.episode_key(show, episode)
+    played = episode < library.progress[account_id].get(show, 0)
+    session = ""
+    if session_key is not None:
+        session = (xml_element("User", {"id": account_id, "title": library.accounts[account_id]})
+                   + xml_element("Player", {"machineIdentifier": f"player-{session_key}", "state": "playing"}))
+    return xml_element("Video", {
+        "ratingKey": rating_key, "key": f"/library/metadata/{rating_key}", "guid": f"plex://episode/{rating_key:024x}",
+        "type": "episode", "title": f"Episode {number + 1}", "index": number + 1, "parentIndex": season + 1,
+        "grandparentTitle": f"Show {show:05d}", "grandparentRatingKey": library.show_key(show),
+        "grandparentKey": f"/library/metadata/{library.show_key(show)}", "parentRatingKey": 500000 + show * 100 + season,
+        "librarySectionID": SHOWS_SECTION, "viewCount": 1 if played else None, "lastViewedAt": last_viewed_at,
+        "duration": EPISODE_DURATION, "sessionKey": session_key,
+    }, media_xml(library.episode_path(show, episode), EPISODE_SIZE) + session)
+
+def movie_xml(library, movie, account_id, last_viewed_at=None):
+    rating_key = library.movie_key(movie)
+    played = movie in library.movies_watched[account_id]
+    guids = xml_element("Guid", {"id": f"tmdb://{900000 + movie}"})
+    return xml_element("Video", {
+        "ratingKey": rating_key, "key": f"/library/metadata/{rating_key}", "guid": f"plex://movie/{movie:024x}",
+        "type": "movie", "title": f"Movie {movie:05d}", "year": 2000, "librarySectionID": MOVIES_SECTION,
+        "viewCount": 1 if played else None, "lastViewedAt": last_viewed_at,
+    }, guids + media_xml(library.movie_path(movie), MOVIE_SIZE))
+
+def container_xml(items, total_size=None, **attributes):
+    attributes.update({"size": len(items), "totalSize": total_size if total_size is not None else len(items)})
+    return xml_element("MediaContainer", attributes, "".join(items) or " ")
+
+# Handler of the stand-in server, answering for the Plex server, plex.tv and its providers
+# The child process sends the plex.tv requests here, with their original host in the X-Benchmark-Host header.
+class StandInHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, format, *args):
+        pass
+
+    def do_GET(self):
+        self.handle_request()
+
+    def do_POST(self):
+        self.handle_request()
+
+    def do_PUT(self):
+        self.handle_request()
+
+    def handle_request(self):
+        server = self.server
+        url = urlsplit(self.path)
+        query = {key: values[0] for key, values in parse_qs(url.query).items()}
+        host = self.headers.get("X-Benchmark-Host", "pms")
+        token = self.headers.get("X-Plex-Token") or query.get("X-Plex-Token")
+        if url.path == "/:/websockets/notifications" and self.headers.get("Upgrade", "").lower() == "websocket" and token in server.tokens:
+            return self.notifications()
+        endpoint = f"{self.command} {host}{re.sub(r'/[0-9,]+(?=/|$)', '/{id}', url.path)}"
+        started = time.perf_counter()
+        if server.latency:
+            time.sleep(server.latency)
+        try:
+            if host == "pms":
+                status, body = self.pms(url.path.rstrip("/") or "/", query, token)
+            else:
+                status, body = self.plex_tv(host, url.path.rstrip("/") or "/", token)
+        except Exception as e:
+            status, body = 500, f"<Response code=\"500\" status={quoteattr(str(e))}/>"
+        server.record(endpoint, status, time.perf_counter() - started)
+        data = body.encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "text/xml;charset=utf-8")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    # Notifications websocket: the alerts pushed with StandInServer.push_alert are sent to every connected listener
+    def notifications(self):
+        accept = base64.b64encode(hashlib.sha1((self.headers["Sec-WebSocket-Key"] + WEBSOCKET_GUID).encode()).digest()).decode()
+        self.send_response(101)
+        self.send_header("Upgrade", "websocket")
+        self.send_header("Connection", "Upgrade")
+        self.send_header("Sec-WebSocket-Accept", accept)
+        self.end_headers()
+        self.server.record("GET pms/:/websockets/notifications", 101, 0)
+        self.server.add_listener(self.wfile)
+        try:
+            # Read the frames of the listener until it closes the connection
+            while True:
+                header = self.rfile.read(2)
+                if len(header) < 2:
+                    break
+                opcode, length = header[0] & 0x0F, header[1] & 0x7F
+                if length == 126:
+                    length = struct.unpack("!H", self.rfile.read(2))[0]
+                elif length == 127:
+                    length = struct.unpack("!Q", self.rfile.read(8))[0]
+                self.rfile.read((4 if header[1] & 0x80 else 0) + length)  # The mask and payload
+                if opcode == 8:  # Close
+                    self.server.send_frame(self.wfile, b"", opcode=8)
+                    break
+        finally:
+            self.server.remove_listener(self.wfile)
+        self.close_connection = True
+
+    def page(self, items):
+        start = int(self.headers.get("X-Plex-Container-Start", 0))
+        size = int(self.headers.get("X-Plex-Container-Size", len(items) or 1))
+        return container_xml(items[start:start + size], total_size=len(items))
+
+    def pms(self, path, query, token):
+        library = self.server.library
+        account_id = self.server.tokens.get(token)
+        if account_id is None:
+            return 401, "<html><head><title>Unauthorized</title></head></html>"
+        if (path, account_id) in self.server.failing:
+            return 500, "<html><head><title>Internal Server Error</title></head></html>"
+        if path == "/":
+            return 200, container_xml([], machineIdentifier=MACHINE_IDENTIFIER, friendlyName="PlexCache Benchmark",
+                                      myPlexUsername=library.accounts[1], platform="Linux", version="1.40.0.0")
+        if path == "/status/sessions":
+            sessions = [episode_xml(library, show, episode, account, session_key=session_key)
+                        for session_key, (account, show, episode) in self.server.sessions.items()]
+            return 200, container_xml(sessions)
+        if path == "/library":
+            return 200, container_xml([xml_element("Directory", {"key": "sections", "title": "Library Sections"})])
+        if path == "/library/sections":
+            sections = [
+                xml_element("Directory", {"key": MOVIES_SECTION, "type": "movie", "title": "Movies", "agent": "tv.plex.agents.movie", "updatedAt": library.updated_at},
+                            xml_element("Location", {"id": 1, "path": "/media/movies"})),
+                xml_element("Directory", {"key": SHOWS_SECTION, "type": "show", "title": "TV Shows", "agent": "tv.plex.agents.series", "updatedAt": library.updated_at},
+                            xml_element("Location", {"id": 2, "path": "/media/tv"})),
+            ]
+            return 200, container_xml(sections)
+        if path == "/accounts":
+            return 200, container_xml([xml_element("Account", {"id": account, "name": name}) for account, name in library.accounts.items()])
+        if path == "/library/onDeck":
+            last_viewed_at = int(time.time()) - 86400
+            items = [episode_xml(library, show, watched, account_id, last_viewed_at)
+                     for show, watched in library.progress[account_id].items() if watched < library.episodes]
+            return 200, self.page(items)
+        if re.fullmatch(r"/library/sections/\d+/collections", path):
+            return 200, self.page([])
+        match = re.fullmatch(r"/library/sections/(\d+)/all", path)
+        if match and query.get("includeMeta") == "1":
+            # The filters plexapi validates the searches with
+            libtype, type_number = ("show", 2) if int(match.group(1)) == SHOWS_SECTION else ("movie", 1)
+            meta = xml_element("Meta", {}, xml_element("Type", {"key": f"{path}?type={type_number}", "type": libtype, "title": libtype, "active": 1},
+                                                       xml_element("Field", {"key": "unwatched", "title": "Unplayed", "type": "boolean"}))
+                               + xml_element("FieldType", {"type": "boolean"}, xml_element("Operator", {"key": "=", "title": "is"})))
+            return 200, xml_element("MediaContainer", {"size": 0}, meta)
+        if match:
+            section = int(match.group(1))
+            unwatched = query.get("unwatched") == "0"  # Only the played items
+            if section == SHOWS_SECTION:
+                items = [show_xml(library, show, account_id) for show in range(library.shows)
+                         if not unwatched or library.progress[account_id].get(show)]
+            else:
+                items = [movie_xml(library, movie, account_id) for movie in range(library.movies)
+                         if not unwatched or movie in library.movies_watched[account_id]]
+            return 200, self.page(items)
+        if path == "/status/sessions/history/all":
+            min_viewed_at = int(query.get("viewedAt>", 0))
+            plays = [xml_element("Video", {
+                "historyKey": f"/status/sessions/history/{history_id}", "ratingKey": rating_key, "key": f"/library/metadata/{rating_key}",
+                "type": "episode" if section == SHOWS_SECTION else "movie", "viewedAt": viewed_at, "accountID": account,
+                "librarySectionID": section,
+            }) for history_id, viewed_at, account, rating_key, section in library.plays if viewed_at > min_viewed_at]
+            return 200, self.page(plays)
+        match = re.fullmatch(r"/library/metadata/([\d,]+)(/allLeaves|/children)?", path)
+        if match:
+            items = []
+            for rating_key in match.group(1).split(","):
+                kind, item = library.item(int(rating_key))
+                if kind == 'show' and match.group(2) == "/allLeaves":
+                    items.extend(episode_xml(library, item, episode, account_id) for episode in range(library.episodes))
+                elif kind == 'show':
+                    items.append(show_xml(library, item, account_id))
+                elif kind == 'episode':
+                    items.append(episode_xml(library, *item, account_id))
+                elif kind == 'movie':
+                    items.append(movie_xml(library, item, account_id))
+            if not items:
+                return 404, "<html><head><title>Not Found</title></head></html>"
+            return 200, self.page(items)
+        return 404, "<html><head><title>Not Found</title></head></html>"
+
+    def plex_tv(self, host, path, token):
+        library = self.server.library
+        account_id = self.server.tokens.get(token)
+        if host.endswith("metadata.provider.plex.tv") and path == "/":
+            return 200, container_xml([], machineIdentifier="metadata", friendlyName="Plex Metadata", platform="Linux", version="1.0.0")
+        if account_id is None:
+            return 401, "<html><head><title>Unauthorized</title></head></html>"
+        if path == "/api/v2/user":
+            return 200, xml_element("user", {
+                "id": account_id, "uuid": f"uuid-{account_id}", "title": library.accounts[account_id], "username": library.accounts[account_id],
+                "authToken": token, "scrobbleTypes": "1,2", "home": 1,
+            }, xml_element("subscription", {"active": 1, "status": "Active", "plan": "lifetime"}) + xml_element("profile", {"autoSelectAudio": 1}))
+        if path == "/api/users":
+            users = [xml_element("User", {"id": account, "title": name, "username": name, "home": 1},
+                                 xml_element("Server", {"id": account, "machineIdentifier": MACHINE_IDENTIFIER, "name": "PlexCache Benchmark"}))
+                     for account, name in library.accounts.items() if account != 1]
+            return 200, container_xml(users)
+        if path == f"/api/servers/{MACHINE_IDENTIFIER}/shared_servers":
+            shared = [xml_element("SharedServer", {"id": account, "userID": account, "accessToken": user_token})
+                      for user_token, account in self.server.tokens.items() if account != 1 and user_token.startswith("benchmark-server-")]
+            return 200, container_xml(shared)
+        match = re.fullmatch(r"/api/home/users/(\d+)/switch", path)
+        if match:
+            return 201, xml_element("user", {"authenticationToken": f"benchmark-home-{match.group(1)}"})
+        if re.fullmatch(r"/library/sections/watchlist/\w+", path):
+            items = [show_xml(library, item, 1) if kind == 'show' else movie_xml(library, item, 1) for kind, item in library.watchlists[account_id]]
+            return 200, self.page(items)
+        return 404, "<html><head><title>Not Found</title></head></html>"
+
+# Stand-in server, counting the requests and their latency for each endpoint
+class StandInServer(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self, library, latency):
+        super().__init__(("127.0.0.1", 0), StandInHandler)
+        self.library = library
+        self.latency = latency
+        # Every account has a token for the server and one for plex.tv once switched to it
+        self.tokens = {ADMIN_TOKEN: 1}
+        for account_id in library.accounts:
+            if account_id != 1:
+                self.tokens[f"benchmark-server-{account_id}"] = account_id
+                self.tokens[f"benchmark-home-{account_id}"] = account_id
+        self.requests = {}
+        self.sessions = {}  # Session key -> (account id, show, episode) being played
+        self.failing = set()  # (Path, account id) of the requests answered with an error
+        self.listeners = []  # Connections of the notifications websocket
+        self._lock = threading.Lock()
+        self._send_lock = threading.Lock()
+
+    def add_listener(self, wfile):
+        with self._lock:
+            self.listeners.append(wfile)
+
+    def remove_listener(self, wfile):
+        with self._lock:
+            self.listeners.remove(wfile)
+
+    # Sends a websocket frame, unmasked as sent by a server
+    def send_frame(self, wfile, payload, opcode=1):
+        length = len(payload)
+        if length < 126:
+            header = struct.pack("!BB", 0x80 | opcode, length)
+        elif length < 65536:
+            header = struct.pack("!BBH", 0x80 | opcode, 126, length)
+        else:
+            header = struct.pack("!BBQ", 0x80 | opcode, 127, length)
+        with self._send_lock:
+            wfile.write(header + payload)
+
+    # Pushes a notification to the listeners, like Plex does on /:/websockets/notifications
+    def push_alert(self, alert):
+        payload = json.dumps({"NotificationContainer": alert}).encode("utf-8")
+        with self._lock:
+            listeners = list(self.listeners)
+        for wfile in listeners:
+            self.send_frame(wfile, payload)
+
+    def record(self, endpoint, status, duration):
+        with self._lock:
+            stats = self.requests.setdefault(endpoint, {"count": 0, "errors": 0, "seconds": 0.0})
+            stats["count"] += 1
+            stats["errors"] += status >= 400
+            stats["seconds"] += duration
+
+    def reset(self):
+        with self._lock:
+            requests = self.requests
+            self.requests = {}
+        return requests
+
+    @property
+    def url(self):
+        return f"http://127.0.0.1:{self.server_address[1]}"
+
+# Function to write the settings of the benchmarked run, with the library files mapped to a temporary folder
+def write_settings(folder, server_url, real_source, cache_dir, users, database_file=None):
+    settings = {
+        "PLEX_URL": server_url,
+        "PLEX_TOKEN": ADMIN_TOKEN,
+        "plex_source": "/media/",
+        "plex_library_folders": ["movies", "tv"],
+        "nas_library_folders": ["movies", "tv"],
+        "real_source": real_source,
+        "cache_dir": cache_dir,
+        "valid_sections": [MOVIES_SECTION, SHOWS_SECTION],
+        "number_episodes": NUMBER_EPISODES,
+        "users_toggle": users > 0,
+        "watchlist_toggle": True,
+        "watchlist_episodes": 5,
+        "watchlist_cache_expiry": 48,
+        "days_to_monitor": 183,
+        "watched_move": True,
+        "watched_cache_expiry": 48,
+        "max_concurrent_moves_array": 2,
+        "max_concurrent_moves_cache": 5,
+        "skip_ondeck": [],
+        "skip_watchlist": [],
+        "exit_if_active_session": False,
+    }
+    if database_file:
+        settings["plex_database_file"] = database_file
+    with open(os.path.join(folder, "plexcache_settings.json"), "w") as f:
+        json.dump(settings, f, indent=4)
+
+# Function to write the library as a Plex library database, with the tables and columns plexcache.py reads
+def write_library_database(library, database_file):
+    connection = sqlite3.connect(database_file)
+    connection.execute("PRAGMA journal_mode=WAL")  # Like Plex
+    connection.executescript("""
+        CREATE TABLE accounts (id INTEGER PRIMARY KEY, name VARCHAR(255));
+        CREATE TABLE library_sections (id INTEGER PRIMARY KEY, name VARCHAR(255), section_type INTEGER);
+        CREATE TABLE metadata_items (id INTEGER PRIMARY KEY, library_section_id INTEGER, parent_id INTEGER, metadata_type INTEGER,
+                                     guid VARCHAR(255), title VARCHAR(255), "index" INTEGER, deleted_at INTEGER);
+        CREATE TABLE media_items (id INTEGER PRIMARY KEY, library_section_id INTEGER, metadata_item_id INTEGER, deleted_at INTEGER);
+        CREATE TABLE media_parts (id INTEGER PRIMARY KEY, media_item_id INTEGER, file VARCHAR(255), size INTEGER, deleted_at INTEGER);
+        CREATE TABLE metadata_item_settings (id INTEGER PRIMARY KEY, account_id INTEGER, guid VARCHAR(255), view_offset INTEGER,
+                                             view_count INTEGER, last_viewed_at INTEGER);
+        CREATE TABLE metadata_item_views (id INTEGER PRIMARY KEY, account_id INTEGER, guid VARCHAR(255), metadata_type INTEGER,
+                                          library_section_id INTEGER, viewed_at INTEGER);
+        CREATE INDEX index_metadata_items_on_parent_id ON metadata_items (parent_id);
+        CREATE INDEX index_media_items_on_metadata_item_id ON media_items (metadata_item_id);
+        CREATE INDEX index_media_parts_on_media_item_id ON media_parts (media_item_id);
+        CREATE INDEX index_metadata_item_settings_on_guid ON metadata_item_settings (guid);
+    """)
+    connection.executemany("INSERT INTO accounts VALUES (?, ?)", library.accounts.items())
+    connection.executemany("INSERT INTO library_sections VALUES (?, ?, ?)", [(MOVIES_SECTION, "Movies", 1), (SHOWS_SECTION, "TV Shows", 2)])
+    items = []
+    files = []
+    for show in range(library.shows):
+        items.append((library.show_key(show), SHOWS_SECTION, None, 2, f"plex://show/{show:024x}", f"Show {show:05d}", None))
+        for season in range((library.episodes - 1) // EPISODES_PER_SEASON + 1):
+            items.append((500000 + show * 100 + season, SHOWS_SECTION, library.show_key(show), 3, f"plex://season/{show:020x}{season:04x}", f"Season {season + 1}", season + 1))
+        for episode in range(library.episodes):
+            season, number = divmod(episode, EPISODES_PER_SEASON)
+            rating_key = library.episode_key(show, episode)
+            items.append((rating_key, SHOWS_SECTION, 500000 + show * 100 + season, 4, f"plex://episode/{rating_key:024x}", f"Episode {number + 1}", number + 1))
+            files.append((rating_key, SHOWS_SECTION, library.episode_path(show, episode), EPISODE_SIZE))
+    for movie in range(library.movies):
+        items.append((library.movie_key(movie), MOVIES_SECTION, None, 1, f"plex://movie/{movie:024x}", f"Movie {movie:05d}", None))
+        files.append((library.movie_key(movie), MOVIES_SECTION, library.movie_path(movie), MOVIE_SIZE))
+    connection.executemany('INSERT INTO metadata_items (id, library_section_id, parent_id, metadata_type, guid, title, "index") VALUES (?, ?, ?, ?, ?, ?, ?)', items)
+    connection.executemany("INSERT INTO media_items (id, library_section_id, metadata_item_id) VALUES (?, ?, ?)",
+                           [(media_id, section, rating_key) for media_id, (rating_key, section, _, _) in enumerate(files, start=1)])
+    connection.executemany("INSERT INTO media_parts (id, media_item_id, file, size) VALUES (?, ?, ?, ?)",
+                           [(media_id, media_id, file_path, size) for media_id, (_, _, file_path, size) in enumerate(files, start=1)])
+    guids = {rating_key: guid for rating_key, _, _, _, guid, _, _ in items}
+    connection.executemany("INSERT INTO metadata_item_settings (account_id, guid, view_offset, view_count, last_viewed_at) VALUES (?, ?, 0, 1, ?)",
+                           [(account_id, guids[rating_key], viewed_at) for _, viewed_at, account_id, rating_key, _ in library.plays])
+    connection.executemany("INSERT INTO metadata_item_views VALUES (?, ?, ?, ?, ?, ?)",
+                           [(history_id, account_id, guids[rating_key], 4 if section == SHOWS_SECTION else 1, section, viewed_at)
+                            for history_id, viewed_at, account_id, rating_key, section in library.plays])
+    connection.commit()
+    connection.close()
+
+# Function to create the library files, sparse so that they take no space
+def create_library_files(library, real_source):
+    for file_path, size in library.files():
+        path = os.path.join(real_source, file_path[len("/media/"):])
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, "wb") as f:
+            f.truncate(size)
+
+# Function run in the child process: sends the plex.tv requests to the stand-in server, then runs plexcache.py
+def run_child(server_url, profile, daemon):
+    import requests.adapters
+    server = urlsplit(server_url)
+    send = requests.adapters.HTTPAdapter.send
+
+    def send_to_stand_in(adapter, request, **kwargs):
+        url = urlsplit(request.url)
+        if url.hostname and url.hostname.endswith("plex.tv"):
+            request.headers["X-Benchmark-Host"] = url.hostname
+            request.url = urlunsplit((server.scheme, server.netloc, url.path, url.query, url.fragment))
+        return send(adapter, request, **kwargs)
+
+    requests.adapters.HTTPAdapter.send = send_to_stand_in
+    socket.gethostbyname = lambda host: "127.0.0.1"  # The internet connection check
+    sys.argv = [plexcache_script, "--debug"] + (["--profile"] if profile else [])
+    if daemon:
+        # The daemon scenario checks the episodes logged, which the default level leaves out
+        import logging
+        logging.getLogger().setLevel(logging.INFO)
+        sys.argv.append("--daemon")
+    runpy.run_path(plexcache_script, run_name="__main__")
+
+# Function to run plexcache.py once in a child process, returning its wall time, peak memory and exit code
+# With a scenario, plexcache.py runs in daemon mode: the scenario is called with the process, which is then stopped.
+def run_plexcache(server, folder, log_filename, profile, scenario=None):
+    env = dict(os.environ, PLEXCACHE_FOLDER=folder)
+    arguments = ["--child", server.url] + (["--profile"] if profile else []) + (["--daemon"] if scenario else [])
+    started = time.perf_counter()
+    with open(log_filename, "w") as log:
+        process = subprocess.Popen([sys.executable, os.path.abspath(__file__)] + arguments, env=env, stdout=log, stderr=subprocess.STDOUT)
+        if scenario:
+            try:
+                scenario(process)
+            finally:
+                process.send_signal(signal.SIGTERM)
+                threading.Timer(DAEMON_TIMEOUT, process.kill).start()  # In case the daemon doesn't stop
+        _, status, usage = os.wait4(process.pid, 0)
+    wall_time = time.perf_counter() - started
+    process.returncode = os.waitstatus_to_exitcode(status)
+    # ru_maxrss is in kilobytes on Linux and in bytes on macOS
+    peak_memory = usage.ru_maxrss / (1024 ** 2 if platform.system() == "Darwin" else 1024)
+    return wall_time, peak_memory, process.returncode
+
+# Daemon scenario: the server owner plays the next episode of a show, stops it once finished, then an episode is
+# added to the library. Returns the checks that failed, reading the log of the daemon: the next episodes are moved
+# to the cache while the episode is played, and again after it is finished, but not the finished episode itself.
+def run_daemon_scenario(server, library, folder, real_source, process):
+    plexcache_log = os.path.join(folder, "plexcache_log_latest.log")
+
+    def read_log(offset):
+        with open(plexcache_log, "rb") as f:
+            f.seek(offset)
+            return f.read().decode("utf-8", "replace")
+
+    def wait_for(condition):
+        deadline = time.monotonic() + DAEMON_TIMEOUT
+        while process.poll() is None and time.monotonic() < deadline:
+            if condition():
+                return True
+            time.sleep(0.1)
+        return False
+
+    # The daemon connects to the notifications once its first run is over
+    if not wait_for(lambda: server.listeners):
+        return ["the daemon did not connect to the notifications websocket"]
+    offset = os.path.getsize(plexcache_log)
+    episodes_left = {show: library.progress[1].get(show, 0) for show in range(library.shows)}
+    show = next((show for show, episode in episodes_left.items() if episode + NUMBER_EPISODES < library.episodes), None)
+    if show is None:
+        return ["no show has enough episodes left for the daemon scenario"]
+    episode = episodes_left[show]
+    title = f"{library.accounts[1]} %s Show {show:05d} - Episode {episode % EPISODES_PER_SEASON + 1}"
+
+    def playing(state, view_offset):
+        return {"type": "playing", "size": 1, "PlaySessionStateNotification": [
+            {"sessionKey": "1", "ratingKey": str(library.episode_key(show, episode)), "state": state, "viewOffset": view_offset}]}
+
+    server.sessions["1"] = (1, show, episode)
+    server.push_alert(playing("playing", 60000))
+    if not wait_for(lambda: title % "is playing" in read_log(offset)):
+        return ["the playing episode was not handled"]
+    server.push_alert(playing("playing", EPISODE_DURATION * 95 // 100))
+    del server.sessions["1"]
+    server.push_alert(playing("stopped", EPISODE_DURATION * 95 // 100))
+    server.push_alert({"type": "timeline", "size": 1, "TimelineEntry": [
+        {"identifier": "com.plexapp.plugins.library", "sectionID": str(SHOWS_SECTION), "itemID": str(library.episode_key(show, episode)), "type": 4, "state": 5}]})
+    # The alerts are handled in order, so the stopped episode is done once the library update is
+    if not wait_for(lambda: "The library was updated" in read_log(offset)):
+        return ["the new episode was not handled"]
+
+    log = read_log(offset)
+    stopped_at = log.find(title % "finished")
+    if stopped_at < 0:
+        return ["the stopped episode was not seen as finished"]
+    paths = [os.path.join(real_source, library.episode_path(show, number)[len("/media/"):]) for number in range(episode, episode + NUMBER_EPISODES + 1)]
+    failures = []
+    for name, section in (("playing", log[:stopped_at]), ("finished", log[stopped_at:])):
+        cached = set(re.findall(r"Adding file to cache: (.*)", section))
+        if paths[0] in cached:
+            failures.append(f"{name}: the episode itself was moved to the cache")
+        missing = [path for path in paths[1:] if path not in cached]
+        if missing:
+            failures.append(f"{name}: {len(missing)} of the next episodes were not moved to the cache")
+    return failures
+
+# Function to read the media of an origin ('ondeck', 'watchlist' or 'watched') from the state database of plexcache.py
+def read_state_media(folder, origin):
+    connection = sqlite3.connect(os.path.join(folder, "plexcache_state.db"))
+    try:
+        return {row[0] for row in connection.execute("SELECT path FROM media_origins WHERE origin = ?", (origin,))}
+    finally:
+        connection.close()
+
+# Function to get the version of PlexCache being benchmarked
+def get_version():
+    try:
+        return subprocess.run(["git", "describe", "--always", "--dirty"], cwd=script_folder, capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return "unknown"
+
+# Function to print how a run compares to the same run of the last benchmark with the same configuration
+def compare_with_previous(results, config, run):
+    for previous in reversed(results):
+        if previous["config"] != config:
+            continue
+        for previous_run in previous["runs"]:
+            if previous_run["name"] == run["name"]:
+                for key in ("wall_time", "requests_total", "peak_memory_mb"):
+                    if previous_run[key]:
+                        change = (run[key] - previous_run[key]) * 100 / previous_run[key]
+                        print(f"    {key}: {previous_run[key]:.2f} -> {run[key]:.2f} ({change:+.1f}%) vs {previous['version']}")
+                return
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark PlexCache against a synthetic Plex server.")
+    parser.add_argument("--users", type=int, default=5, help="Number of users besides the server owner")
+    parser.add_argument("--shows", type=int, default=100, help="Number of shows in the library")
+    parser.add_argument("--episodes", type=int, default=30, help="Number of episodes of each show")
+    parser.add_argument("--movies", type=int, default=100, help="Number of movies in the library")
+    parser.add_argument("--ondeck", type=int, default=5, help="Number of shows and movies each user has started")
+    parser.add_argument("--watchlist", type=int, default=10, help="Number of shows on each user's watchlist (and half as many movies)")
+    parser.add_argument("--latency", type=float, default=0, help="Latency added to every request, in milliseconds")
+    parser.add_argument("--runs", type=int, default=2, help="Number of runs, the first one starts without any cache")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--output", default=results_filename, help="JSON file the results are appended to")
+    parser.add_argument("--keep", action="store_true", help="Keep the temporary folder with the logs of the runs")
+    parser.add_argument("--database", action="store_true", help="Read the onDeck and watched media from a Plex library database instead of the API")
+    parser.add_argument("--profile", action="store_true", help="Run plexcache.py in profile mode, keeping its traces (implies --keep)")
+    parser.add_argument("--daemon", action="store_true", help="Also run plexcache.py in daemon mode and check how it handles playback alerts")
+    parser.add_argument("--ondeck-failure", action="store_true", help="Also run plexcache.py while a user's onDeck requests fail and check the onDeck media are kept")
+    parser.add_argument("--child", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+    if args.child:
+        return run_child(args.child, args.profile, args.daemon)
+    args.keep = args.keep or args.profile
+
+    config = {key: value for key, value in vars(args).items() if key not in ("runs", "output", "keep", "child", "profile")}
+    print(f"Generating the library: {args.users + 1} users, {args.shows} shows x {args.episodes} episodes, {args.movies} movies...")
+    library = SyntheticLibrary(args.users, args.shows, args.episodes, args.movies, args.ondeck, args.watchlist, args.seed)
+    server = StandInServer(library, args.latency / 1000)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+
+    runs = []
+    with tempfile.TemporaryDirectory(prefix="plexcache_benchmark_") as temp_folder:
+        folder = tempfile.mkdtemp(prefix="plexcache_benchmark_") if args.keep else temp_folder
+        real_source = os.path.join(folder, "user")
+        cache_dir = os.path.join(folder, "cache")
+        os.makedirs(cache_dir)
+        create_library_files(library, real_source)
+        database_file = None
+        if args.database:
+            database_file = os.path.join(folder, "com.plexapp.plugins.library.db")
+            write_library_database(library, database_file)
+        write_settings(folder, server.url, real_source, cache_dir, args.users, database_file)
+        scenarios = [("cold" if index == 0 else f"warm{index}", None) for index in range(args.runs)]
+        if args.daemon:
+            scenarios.append(("daemon", lambda process: checks_failed.extend(run_daemon_scenario(server, library, folder, real_source, process))))
+        if args.ondeck_failure:
+            scenarios.append(("ondeck_failure", None))
+        for name, scenario in scenarios:
+            checks_failed = []
+            checked = scenario is not None or name == "ondeck_failure"
+            if name == "ondeck_failure":
+                # The onDeck requests of the last user fail, so the onDeck media of the previous run must be kept
+                ondeck_media = read_state_media(folder, "ondeck") if args.runs else set()
+                server.failing.add(("/library/onDeck", max(library.accounts)))
+            server.reset()
+            wall_time, peak_memory, exit_code = run_plexcache(server, folder, os.path.join(folder, f"{name}.log"), args.profile, scenario)
+            requests = server.reset()
+            if name == "ondeck_failure":
+                server.failing.clear()
+                if not ondeck_media:
+                    checks_failed.append("no onDeck media were stored by a previous run")
+                elif read_state_media(folder, "ondeck") != ondeck_media:
+                    checks_failed.append("the onDeck media of the previous run were not kept")
+            run = {
+                "name": name,
+                "wall_time": round(wall_time, 3),
+                "peak_memory_mb": round(peak_memory, 1),
+                "exit_code": exit_code,
+                "requests_total": sum(stats["count"] for stats in requests.values()),
+                "request_errors": sum(stats["errors"] for stats in requests.values()),
+                "requests": {endpoint: {"count": stats["count"], "errors": stats["errors"], "seconds": round(stats["seconds"], 3)}
+                             for endpoint, stats in sorted(requests.items())},
+            }
+            if checked:
+                run["checks_failed"] = checks_failed
+            runs.append(run)
+            print(f"\n{name}: {run['wall_time']:.2f}s, {run['requests_total']} requests ({run['request_errors']} errors), "
+                  f"peak memory {run['peak_memory_mb']:.0f} MB, exit code {exit_code}")
+            if checked:
+                print(f"    Checks failed: {', '.join(checks_failed)}" if checks_failed else "    All the checks passed")
+            for endpoint, stats in sorted(requests.items(), key=lambda item: -item[1]["count"]):
+                errors = f" ({stats['errors']} errors)" if stats["errors"] else ""
+                print(f"    {stats['count']:6d}  {endpoint}{errors}")
+            if exit_code != 0:
+                with open(os.path.join(folder, f"{name}.log")) as f:
+                    print(f.read()[-3000:])
+    server.shutdown()
+    if args.keep:
+        print(f"The logs of the runs were kept in {folder}")
+
+    results = []
+    if os.path.exists(args.output):
+        with open(args.output) as f:
+            results = json.load(f)
+    print()
+    for run in runs:
+        print(f"{run['name']}:")
+        compare_with_previous(results, config, run)
+    results.append({"timestamp": datetime.now().isoformat(timespec="seconds"), "version": get_version(),
+                    "python": platform.python_version(), "config": config, "runs": runs})
+    with open(args.output, "w") as f:
+        json.dump(results, f, indent=4)
+    print(f"Results saved to {args.output}")
+    if any(run.get("checks_failed") for run in runs):
+        sys.exit("The checks failed.")
+
+if __name__ == "__main__":
+    main()
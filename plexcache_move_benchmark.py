@@ -0,0 +1,352 @@
+import argparse, ast, json, logging, os, platform, resource, shutil, sys, tempfile, threading, time
+from datetime import datetime
+from itertools import product
+
+from plexcache_benchmark import get_version
+
+# Benchmark of the PlexCache moves on a simulated Unraid layout
+# It builds user, user0, cache and diskN folders standing in for /mnt/user, /mnt/user0, /mnt/cache and /mnt/diskN:
+# the files are written on the disks (one show or movie per disk, like a split level) and hard linked into user0.
+# The move functions of plexcache.py (get_paths, get_move_command, schedule_moves, move_file and the copy engine) are
+# loaded without running the script, then the files are moved to the cache and back to the array for every combination
+# of copy method, chunk size, concurrency, moves per disk and disk-direct moves (through the diskN folders rather than user0). MB/s, files/s, the p50/p99 latency of a file and the CPU
+# use are reported for each one, and appended to a JSON file to compare versions.
+#
+# Moves within a filesystem are renames, so the cache should be on another filesystem than the array folders: by default
+# it goes to /dev/shm when that is a separate tmpfs. Use --root and --cache-root to benchmark real disks (or loop mounts).
+# The video files are scaled down by --scale so that the benchmark fits in memory, and unless --drop-caches is given
+# (as root) the files are mostly read from the page cache: the numbers compare configurations rather than disks.
+#
+# With --check-planner, the files are not moved: plan_cache_moves is run again and again on the files, as the cache
+# pipeline does while the fetch workers keep writing the priorities, and every plan has to be the expected one.
+#
+#   python plexcache_move_benchmark.py
+#   python plexcache_move_benchmark.py --check-planner
+#   python plexcache_move_benchmark.py --root /mnt/disk1/bench --cache-root /mnt/cache/bench --scale 0.05 --drop-caches
+
+script_folder = os.path.dirname(os.path.abspath(__file__))
+plexcache_script = os.path.join(script_folder, "plexcache.py")
+results_filename = os.path.join(script_folder, "plexcache_move_benchmark_results.json")
+
+SUBTITLE_SIZE = 60 * 1024
+EPISODE_SIZE = 2 * 1024 ** 3
+REMUX_SIZE = 60 * 1024 ** 3
+WRITE_BLOCK_SIZE = 1024 * 1024
+
+# Names of plexcache.py the moves depend on, loaded along with its imports
+MOVE_ENGINE = [
+    "SNAPSHOT_WORKERS", "permissions", "API_LATENCY_BUCKETS", "RunMetrics", "run_metrics", "PROFILE_TOP_ALLOCATORS", "Profiler",
+    "describe_span_argument", "profiler", "FileSnapshot", "get_paths",
+    "partial_suffix", "progress_suffix", "progress_interval", "get_resume_offset", "copy_chunk", "get_copy_methods",
+    "copy_file_resumable", "move_file", "create_directory_with_permissions", "get_move_command", "MoveThrottle", "MOVE_DEFERRED",
+    "get_array_disks", "get_array_disk", "get_move_disk", "get_share_floor", "ArrayAllocator", "schedule_moves",
+    "media_priorities_lock", "path_maps_lock", "PRIORITY_UNKNOWN", "set_media_priority", "plan_cache_moves",
+]
+PLANNER_CHECK_SECONDS = 3
+
+# Function to load the move functions of plexcache.py without running the script (which connects to Plex on import)
+def load_move_engine():
+    with open(plexcache_script) as f:
+        tree = ast.parse(f.read(), plexcache_script)
+    nodes = []
+    found = set()
+    for node in tree.body:
+        if isinstance(node, (ast.Import, ast.ImportFrom)):
+            nodes.append(node)
+            continue
+        if isinstance(node, (ast.FunctionDef, ast.ClassDef)):
+            name = node.name
+        elif isinstance(node, ast.Assign) and isinstance(node.targets[0], ast.Name):
+            name = node.targets[0].id
+        else:
+            continue
+        if name in MOVE_ENGINE and name not in found:
+            nodes.append(node)
+            found.add(name)
+    missing = [name for name in MOVE_ENGINE if name not in found]
+    if missing:
+        raise RuntimeError(f"Not found in {plexcache_script}: {', '.join(missing)}")
+    engine = {"__name__": "plexcache_move_engine", "profile": False}
+    exec(compile(ast.Module(body=nodes, type_ignores=[]), plexcache_script, "exec"), engine)
+    return engine
+
+# Simulated Unraid layout: the files of the array live on the disks and are hard linked into user0
+class UnraidLayout:
+    def __init__(self, folder, cache_root, disks, shows, episodes, remuxes, scale):
+        self.user_share = os.path.join(folder, "user") + os.sep
+        self.array_share = os.path.join(folder, "user0") + os.sep
+        self.disks = [os.path.join(folder, f"disk{disk}") for disk in range(1, disks + 1)]
+        self.real_source = os.path.join(self.user_share, "media")
+        self.cache_dir = os.path.join(cache_root, "media")
+        self.files = []  # (path relative to the share, size, disk)
+        for show in range(shows):
+            disk = self.disks[show % disks]
+            for episode in range(1, episodes + 1):
+                name = f"tv/Show {show + 1:02d}/Season 01/Show {show + 1:02d} - S01E{episode:02d}"
+                self.files.append((f"media/{name}.mkv", max(int(EPISODE_SIZE * scale), 1), disk))
+                self.files.append((f"media/{name}.en.srt", SUBTITLE_SIZE, disk))
+        for remux in range(remuxes):
+            disk = self.disks[(shows + remux) % disks]
+            name = f"movies/Remux {remux + 1:02d} (2020)/Remux {remux + 1:02d} (2020)"
+            self.files.append((f"media/{name}.mkv", max(int(REMUX_SIZE * scale), 1), disk))
+            self.files.append((f"media/{name}.en.srt", SUBTITLE_SIZE, disk))
+        self.total_size = sum(size for _, size, _ in self.files)
+
+    def create(self):
+        block = os.urandom(WRITE_BLOCK_SIZE)
+        os.makedirs(self.real_source, exist_ok=True)
+        os.makedirs(self.cache_dir, exist_ok=True)
+        for relative_path, size, disk in self.files:
+            disk_file = os.path.join(disk, relative_path)
+            os.makedirs(os.path.dirname(disk_file), exist_ok=True)
+            # Real data rather than sparse files, as the moves copy every byte
+            with open(disk_file, "wb") as f:
+                for offset in range(0, size, WRITE_BLOCK_SIZE):
+                    f.write(block[:min(WRITE_BLOCK_SIZE, size - offset)])
+            os.makedirs(os.path.dirname(os.path.join(self.array_share, relative_path)), exist_ok=True)
+        for disk in self.disks:
+            os.makedirs(disk, exist_ok=True)
+
+    # Puts every file back on the array, with an empty cache
+    def reset(self):
+        shutil.rmtree(self.cache_dir)
+        os.makedirs(self.cache_dir)
+        for relative_path, _, disk in self.files:
+            array_file = os.path.join(self.array_share, relative_path)
+            disk_file = os.path.join(disk, relative_path)
+            if not os.path.exists(disk_file):
+                # Written to another disk by a disk-direct move, or only left in user0 (the disk copy was moved to the cache)
+                other_files = [os.path.join(other_disk, relative_path) for other_disk in self.disks if other_disk != disk]
+                other_file = next((file for file in other_files if os.path.exists(file)), None)
+                os.makedirs(os.path.dirname(disk_file), exist_ok=True)
+                if other_file:
+                    os.rename(other_file, disk_file)
+                else:
+                    os.link(array_file, disk_file)
+            if os.path.lexists(array_file):
+                os.remove(array_file)
+            os.link(os.path.join(disk, relative_path), array_file)
+
+    # Paths of the files as PlexCache sees them, on /mnt/user
+    def user_files(self):
+        return [os.path.join(self.user_share, relative_path) for relative_path, _, _ in self.files]
+
+# Logging handler keeping the errors of the moves, to show why a configuration failed
+class ErrorCollector(logging.Handler):
+    def __init__(self):
+        super().__init__(logging.ERROR)
+        self.messages = []
+
+    def emit(self, record):
+        self.messages.append(record.getMessage())
+
+error_collector = ErrorCollector()
+
+# Function to empty the page cache so that the files are read from the disks, needs root
+def drop_caches():
+    os.sync()
+    with open("/proc/sys/vm/drop_caches", "w") as f:
+        f.write("3")
+
+def percentile(values, percent):
+    if not values:
+        return 0
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * percent / 100))]
+
+# Function to move the files to the given destination through schedule_moves and measure it
+def run_moves(engine, layout, files, destination, max_concurrent_moves):
+    move_commands = []
+    for file in files:
+        user_path, cache_path, cache_file_name, user_file_name = engine["get_paths"](file, layout.real_source, layout.cache_dir, True, destination)
+        move = engine["get_move_command"](destination, cache_file_name, user_path, user_file_name, cache_path)
+        if move is not None:
+            move_commands.append(move)
+    engine["file_snapshot"].clear()
+    engine["file_snapshot"].prefetch([move_cmd[0] for move_cmd in move_commands])
+    sizes = [engine["file_snapshot"].getsize(move_cmd[0]) for move_cmd in move_commands]
+
+    latencies = []
+    error_collector.messages = []
+    move_file = engine["move_file"]
+    def timed_move_file(move_cmd, throttle=None):
+        start = time.perf_counter()
+        result = move_file(move_cmd, throttle)
+        latencies.append(time.perf_counter() - start)
+        return result
+    engine["move_file"] = timed_move_file
+    usage_before = resource.getrusage(resource.RUSAGE_SELF)
+    start = time.perf_counter()
+    try:
+        results = engine["schedule_moves"](move_commands, destination, max_concurrent_moves)
+    finally:
+        engine["move_file"] = move_file
+    wall_time = time.perf_counter() - start
+    usage_after = resource.getrusage(resource.RUSAGE_SELF)
+    bytes_moved = sum(size for size, result in zip(sizes, results) if result == 0)
+    files_moved = results.count(0)
+    cpu_time = (usage_after.ru_utime - usage_before.ru_utime) + (usage_after.ru_stime - usage_before.ru_stime)
+    return {
+        "destination": destination,
+        "files": len(move_commands),
+        "errors": len(move_commands) - files_moved,
+        "wall_time": round(wall_time, 3),
+        "mb_per_second": round(bytes_moved / (1024 ** 2) / wall_time, 1) if wall_time else 0,
+        "files_per_second": round(files_moved / wall_time, 1) if wall_time else 0,
+        "latency_p50_ms": round(percentile(latencies, 50) * 1000, 1),
+        "latency_p99_ms": round(percentile(latencies, 99) * 1000, 1),
+        "cpu_percent": round(cpu_time * 100 / wall_time, 1) if wall_time else 0,
+        "first_error": error_collector.messages[0] if error_collector.messages else None,
+    }
+
+# Function to run plan_cache_moves on the video files while another thread keeps adding priorities, like the fetch
+# workers do while the cache pipeline plans a batch. The first half of the files by priority exactly fills the budget,
+# so every plan has to be that half. Returns the number of plans and the ones that failed or were wrong.
+def check_planner(engine, layout):
+    files = {f"/media/{relative_path}": os.path.join(disk, relative_path) for relative_path, _, disk in layout.files if relative_path.endswith(".mkv")}
+    engine.update({"edited_file_paths": dict(files), "sidecar_media": {}, "media_priorities": {}, "file_snapshot": engine["FileSnapshot"]()})
+    for position, plex_path in enumerate(files):
+        engine["set_media_priority"]([plex_path], 0, position)
+    files = list(files.values())
+    expected = sorted(files[:len(files) // 2])
+    budget = sum(os.path.getsize(file) for file in expected)
+
+    stop = threading.Event()
+    def write_priorities():
+        position = 0
+        while not stop.is_set():
+            engine["set_media_priority"]([f"/media/other/{position + number}.mkv" for number in range(100)], 1, position)
+            position += 100
+
+    writer = threading.Thread(target=write_priorities)
+    writer.start()
+    plans = failures = 0
+    deadline = time.monotonic() + PLANNER_CHECK_SECONDS
+    try:
+        while time.monotonic() < deadline:
+            plans += 1
+            try:
+                planned_files, _ = engine["plan_cache_moves"](files[::-1], layout.cache_dir, budget)
+                failures += sorted(planned_files) != expected
+            except RuntimeError as e:
+                failures += 1
+                error_collector.messages.append(str(e))
+    finally:
+        stop.set()
+        writer.join()
+    return plans, failures
+
+# Function to pick a cache folder on another filesystem than the array folders, so that the moves copy the files
+def get_default_cache_root(root):
+    if os.path.isdir("/dev/shm") and os.stat("/dev/shm").st_dev != os.stat(root).st_dev:
+        return "/dev/shm"
+    return root
+
+def parse_list(value, item_type=int):
+    return [item_type(item) for item in value.split(",") if item]
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the PlexCache moves on a simulated Unraid layout.")
+    parser.add_argument("--disks", type=int, default=4, help="Number of array disks")
+    parser.add_argument("--shows", type=int, default=6, help="Number of shows, each one on a single disk")
+    parser.add_argument("--episodes", type=int, default=4, help="Episodes (2 GB, with a subtitle) of each show")
+    parser.add_argument("--remuxes", type=int, default=2, help="Movie remuxes (60 GB, with a subtitle)")
+    parser.add_argument("--scale", type=float, default=0.001, help="Factor applied to the size of the video files")
+    parser.add_argument("--concurrency", default="1,2,4,8", help="Values of max_concurrent_moves to compare")
+    parser.add_argument("--per-disk", default="1,2", help="Values of max_concurrent_moves_per_disk to compare")
+    parser.add_argument("--methods", default="copy_file_range,sendfile,read_write", help="Values of copy_method to compare")
+    parser.add_argument("--chunk-sizes", default="64", help="Values of copy_chunk_size (MB) to compare")
+    parser.add_argument("--disk-direct", default="0,1", help="Values of disk_direct_moves (0 or 1) to compare")
+    parser.add_argument("--cache-only", action="store_true", help="Only measure the moves to the cache, not back to the array")
+    parser.add_argument("--root", default=tempfile.gettempdir(), help="Folder the array folders are created in")
+    parser.add_argument("--cache-root", help="Folder the cache folder is created in (default: /dev/shm when it is another filesystem)")
+    parser.add_argument("--drop-caches", action="store_true", help="Empty the page cache before each run (needs root)")
+    parser.add_argument("--check-planner", action="store_true", help="Only check the planning of the moves to the cache while priorities are written")
+    parser.add_argument("--output", default=results_filename, help="JSON file the results are appended to")
+    args = parser.parse_args()
+
+    methods = [method for method in parse_list(args.methods, str) if method == "read_write" or hasattr(os, method)]
+    configurations = list(product(methods, parse_list(args.chunk_sizes), parse_list(args.concurrency), parse_list(args.per_disk), parse_list(args.disk_direct)))
+    config = {key: value for key, value in vars(args).items() if key not in ("output", "root", "cache_root")}
+
+    engine = load_move_engine()
+    folder = tempfile.mkdtemp(prefix="plexcache_move_benchmark_", dir=args.root)
+    cache_folder = tempfile.mkdtemp(prefix="plexcache_move_benchmark_", dir=args.cache_root or get_default_cache_root(args.root))
+    runs = []
+    try:
+        layout = UnraidLayout(folder, cache_folder, args.disks, args.shows, args.episodes, args.remuxes, args.scale)
+        for path in (folder, cache_folder):
+            free = shutil.disk_usage(path).free
+            if free < layout.total_size * 1.1:
+                sys.exit(f"Not enough space in {path}: {layout.total_size / 1024 ** 2:.0f} MB needed, {free / 1024 ** 2:.0f} MB free. Lower --scale.")
+        same_filesystem = os.stat(folder).st_dev == os.stat(cache_folder).st_dev
+        if same_filesystem:
+            print("Warning: the cache is on the same filesystem as the array, the moves are renames. Use --cache-root.")
+        config["same_filesystem"] = same_filesystem
+        print(f"Creating {len(layout.files)} files ({layout.total_size / 1024 ** 2:.0f} MB) on {args.disks} disks in {folder}...")
+        layout.create()
+        logging.basicConfig(filename=os.path.join(folder, "moves.log"), level=logging.INFO, format="%(asctime)s - %(levelname)s - %(message)s")
+        logging.getLogger().addHandler(error_collector)
+        engine.update({
+            "os_linux": True,
+            "unraid": True,
+            "user_share": layout.user_share,
+            "array_share": layout.array_share,
+            "array_disks_pattern": os.path.join(folder, "disk[0-9]*"),
+            "array_disks": None,
+            "unraid_shares_config": os.path.join(folder, "shares"),  # None, the shares use Unraid's default allocation
+            "move_throttle": engine["MoveThrottle"]({}, 0, 1),  # No limit and no Plex sessions
+        })
+
+        if args.check_planner:
+            plans, failures = check_planner(engine, layout)
+            print(f"Planned the moves {plans} times while writing priorities, {failures} plans failed or were wrong.")
+            if error_collector.messages:
+                print(f"    {error_collector.messages[0]}")
+            if failures:
+                sys.exit("The planner check failed.")
+            return
+
+        print(f"\n{'method':16s}{'chunk':>6s}{'moves':>6s}{'/disk':>6s}{'direct':>7s}  {'to':6s}{'MB/s':>9s}{'files/s':>9s}{'p50 ms':>9s}{'p99 ms':>9s}{'CPU %':>7s}{'errors':>7s}")
+        for method, chunk_size, concurrency, per_disk, disk_direct in configurations:
+            engine.update({"copy_method": method, "copy_chunk_size": chunk_size, "max_concurrent_moves_per_disk": per_disk,
+                           "disk_direct_moves": bool(disk_direct), "array_disk_cache": {}, "file_snapshot": engine["FileSnapshot"](),
+                           "array_allocator": engine["ArrayAllocator"]()})
+            layout.reset()
+            if args.drop_caches:
+                drop_caches()
+            destinations = ["cache"] if args.cache_only else ["cache", "array"]
+            for destination in destinations:
+                run = run_moves(engine, layout, layout.user_files(), destination, concurrency)
+                run.update({"copy_method": method, "copy_chunk_size": chunk_size, "max_concurrent_moves": concurrency,
+                            "max_concurrent_moves_per_disk": per_disk, "disk_direct_moves": bool(disk_direct)})
+                runs.append(run)
+                print(f"{method:16s}{chunk_size:6d}{concurrency:6d}{per_disk:6d}{'yes' if disk_direct else 'no':>7s}  {destination:6s}{run['mb_per_second']:9.1f}{run['files_per_second']:9.1f}"
+                      f"{run['latency_p50_ms']:9.1f}{run['latency_p99_ms']:9.1f}{run['cpu_percent']:7.1f}{run['errors']:7d}")
+                if run["first_error"]:
+                    print(f"    {run['first_error']}")
+    finally:
+        shutil.rmtree(folder, ignore_errors=True)
+        shutil.rmtree(cache_folder, ignore_errors=True)
+
+    for destination in ("cache", "array"):
+        destination_runs = [run for run in runs if run["destination"] == destination and run["files"] and not run["errors"]]
+        if destination_runs:
+            best = max(destination_runs, key=lambda run: run["mb_per_second"])
+            print(f"\nFastest to the {destination}: copy_method {best['copy_method']}, copy_chunk_size {best['copy_chunk_size']}, "
+                  f"max_concurrent_moves {best['max_concurrent_moves']}, max_concurrent_moves_per_disk {best['max_concurrent_moves_per_disk']}, "
+                  f"disk_direct_moves {str(best['disk_direct_moves']).lower()} "
+                  f"({best['mb_per_second']:.1f} MB/s)")
+
+    results = []
+    if os.path.exists(args.output):
+        with open(args.output) as f:
+            results = json.load(f)
+    results.append({"timestamp": datetime.now().isoformat(timespec="seconds"), "version": get_version(),
+                    "python": platform.python_version(), "config": config, "runs": runs})
+    with open(args.output, "w") as f:
+        json.dump(results, f, indent=4)
+    print(f"Results saved to {args.output}")
+
+if __name__ == "__main__":
+    main()